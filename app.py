@@ -4,17 +4,27 @@ Jinja2 Documentation:    http://jinja.pocoo.org/2/documentation/
 Werkzeug Documentation:  http://werkzeug.pocoo.org/documentation/
 """
 
+import os
+import zlib
 from collections import OrderedDict
 
 import arrow
-from flask import Flask, render_template, redirect, url_for, make_response
+from flask import Flask, Response, abort, jsonify, render_template, redirect, request, safe_join, send_file, \
+    stream_with_context, url_for
 from rq import Queue, Connection
-from rq.registry import FinishedJobRegistry, StartedJobRegistry
 from rq_dashboard import RQDashboard
 
+import store
 import tasks
 import worker
-from export_catalog import export_catalog_xml
+from ed_catalog import PARSER_ENGINES
+from export_artifacts import etag
+from export_catalog import iter_export_catalog_xml
+from history import NEW_ITEM_FIELD, REPORT_FIELDS
+from job_list import DEFAULT_LIMITS, list_jobs
+from products import SOURCE_VALUES, STOCK_VALUES, browse_products, parse_filters, parse_limit
+from progress import get_progress, iter_progress_events
+from sync import get_sync, recent_sync_ids, start_sync
 
 app = Flask(__name__)
 
@@ -28,6 +38,16 @@ RQDashboard(app)
 redis_client = worker.redis_client
 
 
+@app.before_first_request
+def create_indexes():
+    store.ensure_indexes()
+
+
+@app.template_filter('datetime')
+def format_datetime(timestamp):
+    return arrow.get(timestamp).to('local').format('YYYY-MM-DD HH:mm:ss')
+
+
 @app.route('/')
 def home():
     """Render website's home page."""
@@ -36,9 +56,15 @@ def home():
 
 @app.route('/catalog/ed', methods=['POST'])
 def update_ed_catalog():
+    # optional, the worker's default is used if not given
+    parser_engine = request.form.get('parser_engine') or None
+    if parser_engine is not None and parser_engine not in PARSER_ENGINES:
+        abort(400)
     with Connection(redis_client):
         q = Queue()
-        q.enqueue(tasks.update_ed_catalog, timeout=app.config['JOB_TIMEOUT'])
+        q.enqueue(tasks.update_ed_catalog, parser_engine=parser_engine,
+                  profile=request.form.get('profile') == 'on',
+                  timeout=app.config['JOB_TIMEOUT'])
         return redirect(url_for('jobs'))
 
 
@@ -50,54 +76,272 @@ def update_shoptet_catalog():
         return redirect(url_for('jobs'))
 
 
+@app.route('/catalog/sync', methods=['POST'])
+def sync_catalog():
+    """
+    Updates both catalogs in parallel and then exports the import XML.
+    Needs at least two workers for the updates to run concurrently.
+    """
+    sync_id = start_sync(redis_client, app.config['JOB_TIMEOUT'])
+    return redirect(url_for('sync_details', sync_id=sync_id))
+
+
+@app.route('/sync/')
+def syncs():
+    return render_template('syncs.html', syncs=[get_sync(redis_client, sync_id)
+                                                for sync_id in recent_sync_ids(redis_client)])
+
+
+@app.route('/sync/<sync_id>')
+def sync_details(sync_id):
+    sync = get_sync(redis_client, sync_id)
+    if sync is None:
+        abort(404)
+    stages = OrderedDict()
+    with Connection(redis_client):
+        q = Queue()
+        for (stage, name) in [('ed', 'Update from ED'), ('shoptet', 'Update from Shoptet'), ('export', 'Export')]:
+            job_id = sync.get('%s_job_id' % stage)
+            stages[name] = q.fetch_job(job_id) if job_id else None
+    progress = get_progress(redis_client, [job.id for job in stages.values() if job])
+    statuses = dict((name, job.get_status()) for (name, job) in stages.items() if job)
+    # the progress is streamed only until the export is built or the sync fails
+    live_progress = not sync.get('artifact') and (
+        any(status in ('queued', 'started') for status in statuses.values()) or
+        (stages['Export'] is None and
+         all(statuses.get(name) == 'finished' for name in ('Update from ED', 'Update from Shoptet'))))
+    return render_template('sync.html', sync=sync, stages=stages, statuses=statuses, progress=progress,
+                           live_progress=live_progress)
+
+
+@app.route('/exports/<file_name>')
+def exported_catalog(file_name):
+    """Downloads a catalog XML exported by a sync."""
+    path = safe_join(os.path.abspath(tasks.export_dir), file_name)
+    if not os.path.isfile(path):
+        abort(404)
+    return send_file(path, mimetype='text/xml', as_attachment=True)
+
+
+@app.route('/catalog/export', methods=['POST'])
+def build_export():
+    with Connection(redis_client):
+        q = Queue()
+        q.enqueue(tasks.export_catalog_job, timeout=app.config['JOB_TIMEOUT'])
+        return redirect(url_for('jobs'))
+
+
 @app.route('/catalog')
 def export_catalog():
-    catalog_xml = export_catalog_xml()
-    response = make_response(catalog_xml)
-    date = arrow.get().format('YYYY-MM-DD_HH-mm-ss')
-    file_name = 'shoptet_catalog_import_%s.xml' % date
+    """
+    Serves the precomputed export of the current data version, gzipped if
+    the client accepts it. Supports conditional (ETag) and range requests.
+    If the data has changed since the last export (eg. by an update which
+    is not part of a full sync), the export is generated live.
+
+    With ?since=<change sequence> only the products changed after that
+    sequence are exported. The X-Change-Seq header tells the sequence to
+    pass in the next request.
+    """
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            abort(400)
+        return export_catalog_tracked(since)
+    artifact = tasks.export_artifacts.get(store.get_item_store().get_data_version())
+    if artifact is None:
+        return export_catalog_tracked()
+    use_gzip = 'gzip' in request.accept_encodings
+    file_name = artifact['gzip_file_name'] if use_gzip else artifact['file_name']
+    path = os.path.join(tasks.export_artifacts.artifact_dir, file_name)
+    response = send_file(path, mimetype='text/xml', conditional=False)
+    response.set_etag(etag(artifact, use_gzip))
+    response.headers["Content-Disposition"] = "attachment; filename=%s" % artifact['file_name']
+    response.headers["Content-Type"] = "text/xml; charset=utf-8"
+    response.headers["Vary"] = "Accept-Encoding"
+    # revalidate each time, a new export may have been built meanwhile
+    response.headers["Cache-Control"] = "no-cache"
+    if artifact.get('change_seq') is not None:
+        response.headers["X-Change-Seq"] = str(artifact['change_seq'])
+    if use_gzip:
+        response.headers["Content-Encoding"] = "gzip"
+    return response.make_conditional(request, accept_ranges=True, complete_length=os.path.getsize(path))
+
+
+def export_catalog_tracked(since=None):
+    """
+    Streams all the products or those changed after the since change
+    sequence along with the sequence to pass next time.
+    """
+    # read before the export, the changes made meanwhile (or by the ingests
+    # still running) are in the next delta
+    change_seq = store.get_item_store().get_committed_change_seq()
+    file_name = 'shoptet_catalog_delta_%d_%d.xml' % (since, change_seq) if since is not None else None
+    response = export_catalog_live(since, file_name)
+    response.headers["X-Change-Seq"] = str(change_seq)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def export_catalog_live(since=None, file_name=None):
+    """
+    Streams the catalog XML as it is being generated (when the export of
+    the current data has not been built). It is compressed on the fly if
+    the client accepts gzip.
+    """
+    chunks = stream_with_context(iter_export_catalog_xml(since))
+    use_gzip = 'gzip' in request.accept_encodings
+    if use_gzip:
+        chunks = gzip_chunks(chunks)
+    response = Response(chunks)
+    if file_name is None:
+        date = arrow.get().format('YYYY-MM-DD_HH-mm-ss')
+        file_name = 'shoptet_catalog_import_%s.xml' % date
     response.headers["Content-Disposition"] = "attachment; filename=%s" % file_name
     response.headers["Content-Type"] = "text/xml; charset=utf-8"
+    response.headers["Vary"] = "Accept-Encoding"
+    if use_gzip:
+        response.headers["Content-Encoding"] = "gzip"
     return response
 
 
+def gzip_chunks(chunks, compress_level=6):
+    """Compresses a stream of text chunks into a stream of gzip chunks."""
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@app.route('/products')
+def products():
+    """
+    Page of the merged products sorted by code. Filters: manufacturer,
+    status (ED), stock (in/out), visible (true/false), source
+    (ed/shoptet/both) and q (words of the name or the code).
+    The next page starts ?after=<the last code>.
+    """
+    page = product_page()
+    return render_template('products.html', stock_values=STOCK_VALUES, source_values=SOURCE_VALUES, **page)
+
+
+@app.route('/products.json')
+def products_json():
+    """The same page of products as JSON."""
+    page = product_page()
+    return jsonify(products=page['products'], next_after=page['next_after'], next_url=page['next_url'])
+
+
+def product_page():
+    try:
+        filters = parse_filters(request.args)
+        limit = parse_limit(request.args.get('limit'))
+    except ValueError:
+        abort(400)
+    products, next_after = browse_products(store.get_item_store(), filters, request.args.get('after'), limit)
+    next_url = None
+    if next_after is not None:
+        args = request.args.to_dict()
+        args['after'] = next_after
+        next_url = url_for(request.endpoint, **args)
+    return {'products': products, 'next_after': next_after, 'next_url': next_url, 'args': request.args}
+
+
+@app.route('/changes')
+def changes():
+    """
+    Report of the new products and the price, stock and VAT changes made
+    by an ED ingest run (the latest one by default), optionally of a single
+    field. With ?code=<code> the history of a single product.
+    """
+    item_store = store.get_item_store()
+    code = request.args.get('code')
+    if code:
+        return render_template('changes.html', code=code, item_changes=item_store.find_item_changes(code))
+    runs = item_store.change_runs(limit=30)
+    run = request.args.get('run', type=int) or (runs[0] if runs else None)
+    field = request.args.get('field')
+    if field is not None and field not in REPORT_FIELDS:
+        abort(400)
+    limit = request.args.get('limit', 100, type=int)
+    counts = item_store.count_changes(run) if run else {}
+    # new products first, then the fields in the order of REPORT_FIELDS
+    sections = OrderedDict(
+        (report_field, item_store.find_changes(run, report_field, limit))
+        for report_field in REPORT_FIELDS
+        if counts.get(report_field) and field in (None, report_field))
+    return render_template('changes.html', run=run, runs=runs, counts=counts, sections=sections,
+                           new_item_field=NEW_ITEM_FIELD)
+
+
 @app.route('/jobs/<job_id>')
 def cancel_job(job_id):
     with Connection(redis_client):
         q = Queue()
         job = q.fetch_job(job_id)
-        return render_template('job_details.html', job=job)
+        return render_template('job_details.html', job=job, progress=get_progress(redis_client, [job_id]))
+
+
+@app.route('/jobs/events')
+def job_events():
+    """
+    Server-Sent Events with the progress of all running jobs or of the job
+    given by the job_id parameter.
+    """
+    events = iter_progress_events(redis_client, request.args.get('job_id'))
+    response = Response(events, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # do not let a proxy (eg. nginx) buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @app.route('/jobs/<job_id>/cancel')
 def job_details(job_id):
+    # a running job polls this flag and stops itself
+    redis_client.set(tasks.cancel_key(job_id), 1, ex=app.config['JOB_TIMEOUT'])
     with Connection(redis_client):
         q = Queue()
         job = q.fetch_job(job_id)
-        job.cancel()
+        if job is not None:
+            job.cancel()
         return redirect(url_for('jobs'))
 
 
 @app.route('/jobs/')
 def jobs():
-    with Connection(redis_client):
-        q = Queue()
-        # possibly also use DeferredJobRegistry()
-        jobs = OrderedDict([
-            (name,
-             [q.fetch_job(job_id) for job_id in registry.get_job_ids()]
-             ) for (name, registry) in
-            [('Waiting', q),
-             ('Running', StartedJobRegistry()),
-             ('Finished', FinishedJobRegistry()),
-             ('Failed', Queue('failed'))]])
-        return render_template('jobs.html', jobs=jobs)
+    """
+    A page of the jobs of each state, or with ?state=<state>&page=<n>
+    further pages of a single state.
+    """
+    state = request.args.get('state')
+    if state is not None and state not in DEFAULT_LIMITS:
+        abort(400)
+    page = max(request.args.get('page', 1, type=int), 1)
+    # possibly also use DeferredJobRegistry()
+    pages = list_jobs(redis_client, [state] if state else None, page)
+    progress = get_progress(redis_client, [job.id for job_page in pages.values() for job in job_page.jobs])
+    # each open progress stream occupies a web worker thread
+    live_progress = any(pages[state].jobs for state in ('Waiting', 'Running') if state in pages)
+    return render_template('jobs.html', pages=pages, progress=progress, live_progress=live_progress)
 
 
 @app.route('/test/<file_name>')
 def send_zip_file(file_name):
-    """Useful for testing with locally available data."""
-    return app.send_static_file(file_name)
+    """
+    Useful for testing with locally available data. Supports conditional
+    and range requests like a real server so that the download cache can
+    be tested against it.
+    """
+    path = safe_join(app.static_folder, file_name)
+    if not os.path.isfile(path):
+        abort(404)
+    response = send_file(path, conditional=False)
+    return response.make_conditional(request, accept_ranges=True, complete_length=os.path.getsize(path))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,657 @@
+"""
+Benchmarks of the ED -> Shoptet catalog pipeline.
+
+Usage:
+
+    python benchmark.py parsers resources/test/edsystem_catalog_small.xml
+    python benchmark.py download http://localhost:5000/test/edsystem_public_catalog_small.zip
+    python benchmark.py shards catalog.xml --mongo-uri mongodb://localhost/s3dt_benchmark -w 1 2 4 8
+    python benchmark.py suite -n 10000 180000 1000000 --mongo-uri mongodb://localhost/s3dt_benchmark -o new.json
+    python benchmark.py compare old.json new.json
+    python benchmark.py schema catalog.xml --mongo-uri mongodb://localhost/s3dt_benchmark
+    python benchmark.py convert -n 100000
+    python benchmark.py storage catalog.xml mongodb://localhost/s3dt_benchmark sqlite:///tmp/s3dt_benchmark.db
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import bson
+from lxml import etree
+from pymongo import UpdateOne
+
+import ed_catalog
+import export_catalog
+import migrate_schema
+import parallel_ingest
+import store
+import synthetic_catalog
+from bulk_writer import BulkWriter
+from item_store import MongoItemStore, check_item_store
+from xml_validation import SHOPTET_SCHEMA_PATH, relax_ng_schema, validate_relax_ng, validate_relax_ng_items
+
+SUITE_SIZES = [10000, 180000, 1000000]
+
+
+def parse_all_items(catalog_path, engine):
+    items = []
+    with open(catalog_path, 'rb') as catalog_xml:
+        ed_catalog.process_catalog(catalog_xml, items.append, engine)
+    return items
+
+
+def benchmark_parsers(catalog_path, repeat=1):
+    """
+    Parses the catalog by each of the parser engines, checks they produce
+    the same items and measures their throughput.
+    """
+    results = {}
+    reference_items = None
+    for engine in ed_catalog.PARSER_ENGINES:
+        start = time.time()
+        for _ in range(repeat):
+            items = parse_all_items(catalog_path, engine)
+        elapsed = (time.time() - start) / repeat
+        if reference_items is None:
+            reference_items = items
+        results[engine] = {
+            'items': len(items),
+            'elapsed_time': elapsed,
+            'items_per_sec': len(items) / elapsed if elapsed > 0 else None,
+            'matches_reference': items == reference_items,
+        }
+    return results
+
+
+def benchmark_download(catalog_url, chunk_size=64 * 1024):
+    """
+    Downloads the catalog and reads the whole XML stream. Measures the
+    download throughput and the peak memory allocated meanwhile.
+    """
+    counter = ed_catalog.Counter()
+    xml_size = 0
+    tracemalloc.start()
+    start = time.time()
+    with ed_catalog.fetch_ed_catalog(catalog_url, counter) as catalog_file, \
+            ed_catalog.open_catalog_xml(catalog_file) as catalog_xml:
+        while True:
+            data = catalog_xml.read(chunk_size)
+            if not data:
+                break
+            xml_size += len(data)
+    elapsed = time.time() - start
+    _, peak_traced_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'bytes_downloaded': counter.bytes_downloaded,
+        'download_time': counter.download_time,
+        'download_throughput': counter.download_throughput(),
+        'xml_bytes': xml_size,
+        'elapsed_time': elapsed,
+        'peak_traced_memory': peak_traced_memory,
+        'peak_rss': peak_rss(),
+    }
+
+
+def benchmark_shards(catalog_path, mongo_uri, worker_counts, parser_engine='lxml'):
+    """
+    Ingests the catalog with each number of worker processes into an empty
+    collection, measures the throughput and checks the stored documents are
+    the same as from the single-process ingest.
+
+    Requires a real MongoDB since the workers are separate processes.
+    """
+    item_store = MongoItemStore(store.get_database(mongo_uri))
+    item_collection = item_store.collection
+    reference_docs = None
+    results = {}
+    for num_workers in worker_counts:
+        item_store.drop()
+        counter = ed_catalog.Counter(report=lambda counter: None, report_period=10 ** 9)
+        start = time.time()
+        if num_workers == 1:
+            with open(catalog_path, 'rb') as catalog_xml:
+                ed_catalog.load_catalog_to_mongo(catalog_xml, item_store, counter, parser_engine=parser_engine)
+        else:
+            parallel_ingest.load_catalog_file_parallel(
+                catalog_path, mongo_uri, counter, num_workers, parser_engine=parser_engine)
+        elapsed = time.time() - start
+        docs = list(item_collection.find({}, {'_id': 0}).sort('code', 1))
+        if reference_docs is None:
+            reference_docs = docs
+        results[num_workers] = {
+            'items': counter.total,
+            'selected_items': counter.selected,
+            'elapsed_time': elapsed,
+            'items_per_sec': counter.total / elapsed if elapsed > 0 else None,
+            'matches_reference': docs == reference_docs,
+        }
+    item_store.drop()
+    return results
+
+
+def benchmark_suite(sizes, work_dir, mongo_uri=None, parser_engine='lxml', selected_ratio=0.5,
+                    schema_path=SHOPTET_SCHEMA_PATH):
+    """
+    Generates a synthetic catalog of each size and measures the stages
+    of the ED -> Shoptet pipeline on it. Each size runs in a fresh process
+    so that its peak RSS is not inflated by the previous sizes.
+
+    mongo_uri - MongoDB URI of a scratch database (its items are dropped!),
+        mongomock is used if None (which is much slower for large sizes)
+    """
+    results = OrderedDict()
+    for size in sizes:
+        with ProcessPoolExecutor(1) as executor:
+            results[str(size)] = executor.submit(
+                benchmark_catalog_size, size, work_dir, mongo_uri, parser_engine,
+                selected_ratio, schema_path).result()
+    return OrderedDict([
+        ('commit', git_commit()),
+        ('python', platform.python_version()),
+        ('parser_engine', parser_engine),
+        ('mongo', 'mongod' if mongo_uri else 'mongomock'),
+        ('results', results),
+    ])
+
+
+def benchmark_catalog_size(size, work_dir, mongo_uri, parser_engine, selected_ratio, schema_path):
+    xml_path = os.path.join(work_dir, 'ed_catalog_%d.xml' % size)
+    zip_path = os.path.join(work_dir, 'ed_catalog_%d.zip' % size)
+    export_path = os.path.join(work_dir, 'shoptet_catalog_%d.xml' % size)
+    print('generating a catalog of %d products' % size)
+    synthetic_catalog.write_catalog_files(xml_path, size, selected_ratio, zip_path=zip_path)
+
+    stages = OrderedDict()
+
+    def measure(name, function):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        items = result.pop('items')
+        stages[name] = stage_result(items, elapsed, **result)
+        print('%s: %d items in %.3f sec' % (name, items, elapsed))
+
+    def process_xml():
+        counter = quiet_counter()
+        with open(xml_path, 'rb') as catalog_xml:
+            ed_catalog.process_catalog(catalog_xml, lambda item: counter.item_selected(), parser_engine,
+                                       item_filter=ed_catalog.DEFAULT_CATEGORY_FILTER,
+                                       item_visited=counter.item_visited)
+        return {'items': counter.total, 'selected_items': counter.selected,
+                'input_bytes': os.path.getsize(xml_path)}
+
+    def process_zip():
+        counter = quiet_counter()
+        with open(zip_path, 'rb') as catalog_file, ed_catalog.open_catalog_xml(catalog_file) as catalog_xml:
+            ed_catalog.process_catalog(catalog_xml, lambda item: counter.item_selected(), parser_engine,
+                                       item_filter=ed_catalog.DEFAULT_CATEGORY_FILTER,
+                                       item_visited=counter.item_visited)
+        return {'items': counter.total, 'selected_items': counter.selected,
+                'input_bytes': os.path.getsize(zip_path)}
+
+    measure('process_catalog_xml', process_xml)
+    measure('process_catalog_zip', process_zip)
+    # only the conversion itself is timed, not the parsing
+    stages['convert_item'] = benchmark_convert_items(xml_path, parser_engine)
+    stages['convert_items'] = benchmark_batch_convert(xml_path, parser_engine)
+    for stage in ('convert_item', 'convert_items'):
+        print('%s: %d items in %.3f sec' % (stage, stages[stage]['items'], stages[stage]['elapsed_time']))
+
+    item_store = benchmark_store(mongo_uri)
+    item_store.drop()
+
+    def mongo_load():
+        counter = quiet_counter()
+        with open(xml_path, 'rb') as catalog_xml:
+            ed_catalog.load_catalog_to_mongo(catalog_xml, item_store, counter, parser_engine=parser_engine)
+        return {'items': counter.total, 'written_items': counter.inserted + counter.updated,
+                'write_batches': counter.batches, 'mean_batch_latency': counter.mean_batch_latency(),
+                'mean_document_bytes': mean_document_size(item_store.collection)}
+
+    measure('mongo_load', mongo_load)
+    add_shoptet_items(item_store, export_codes(item_store))
+
+    def export():
+        with open(export_path, 'w', encoding='utf-8') as output_xml:
+            export_catalog.export_catalog_from_mongo(item_store, output_xml)
+        return {'items': item_store.collection.find({'has_export': True}).count(),
+                'output_bytes': os.path.getsize(export_path)}
+
+    measure('export_catalog_from_mongo', export)
+
+    def validate():
+        schema = relax_ng_schema(schema_path)
+        try:
+            validate_relax_ng(export_path, schema)
+            error = None
+        except etree.DocumentInvalid as e:
+            error = str(e)
+        return {'items': stages['export_catalog_from_mongo']['items'], 'valid': error is None, 'error': error}
+
+    measure('validate_relax_ng', validate)
+
+    def validate_items():
+        validator = validate_relax_ng_items(export_path, relax_ng_schema(schema_path))
+        return {'items': validator.valid + validator.invalid, 'invalid_items': validator.invalid}
+
+    measure('validate_relax_ng_items', validate_items)
+    item_store.drop()
+    return stages
+
+
+def benchmark_convert_items(xml_path, parser_engine):
+    converted = [0]
+    elapsed = [0.0]
+
+    def convert(item):
+        start = time.time()
+        ed_catalog.convert_item(item)
+        elapsed[0] += time.time() - start
+        converted[0] += 1
+
+    with open(xml_path, 'rb') as catalog_xml:
+        ed_catalog.process_catalog(catalog_xml, convert, parser_engine,
+                                   item_filter=ed_catalog.DEFAULT_CATEGORY_FILTER)
+    return stage_result(converted[0], elapsed[0])
+
+
+def benchmark_batch_convert(xml_path, parser_engine):
+    items = []
+    with open(xml_path, 'rb') as catalog_xml:
+        ed_catalog.process_catalog(catalog_xml, items.append, parser_engine,
+                                   item_filter=ed_catalog.DEFAULT_CATEGORY_FILTER)
+    start = time.time()
+    ed_catalog.convert_items(items)
+    return stage_result(len(items), time.time() - start)
+
+
+def benchmark_convert(num_items, seed=0, repeat=3):
+    """
+    Checks that ed_catalog.convert_items() gives the same output as
+    convert_item() on generated items and compares their throughput.
+    """
+    items = synthetic_catalog.generate_convert_items(num_items, seed)
+    reference = [ed_catalog.convert_item(item) for item in items]
+    converted = ed_catalog.convert_items(items)
+    mismatches = [item['Code'] for (item, expected, actual) in zip(items, reference, converted)
+                  if json.dumps(expected) != json.dumps(actual)]
+
+    def measure(convert):
+        start = time.time()
+        for _ in range(repeat):
+            convert()
+        return (time.time() - start) / repeat
+
+    item_time = measure(lambda: [ed_catalog.convert_item(item) for item in items])
+    batch_time = measure(lambda: ed_catalog.convert_items(items))
+    return OrderedDict([
+        ('items', len(items)),
+        ('convert_item_per_sec', len(items) / item_time if item_time > 0 else None),
+        ('convert_items_per_sec', len(items) / batch_time if batch_time > 0 else None),
+        ('speedup', item_time / batch_time if batch_time > 0 else None),
+        ('mismatches', mismatches[:100]),
+        ('matches_reference', not mismatches),
+    ])
+
+
+def benchmark_schema(catalog_path, mongo_uri=None, parser_engine='lxml'):
+    """
+    Compares the size of the stored documents and the export time of the
+    old schema (the whole raw ED item stored) and of the compact one.
+    The items are stored in the old schema and migrated by migrate_schema.
+    """
+    item_store = benchmark_store(mongo_uri)
+    item_store.drop()
+    item_collection = item_store.collection
+    with open(catalog_path, 'rb') as catalog_xml, BulkWriter(item_collection) as writer:
+        def store_old_item(ed_item):
+            writer.add(UpdateOne({'code': ed_item['Code']}, {'$set': {
+                'code': ed_item['Code'],
+                'ed': ed_item,
+                'ed_digest': ed_catalog.item_digest(ed_item),
+                'shoptet_from_ed': ed_catalog.convert_item(ed_item)}}, upsert=True))
+        ed_catalog.process_catalog(catalog_xml, store_old_item, parser_engine,
+                                   item_filter=ed_catalog.DEFAULT_CATEGORY_FILTER)
+    codes = [doc['code'] for doc in item_collection.find({}, {'_id': 0, 'code': 1}).sort('code', 1)]
+    add_shoptet_items(item_store, codes)
+    raw_sizes = [len(ed_catalog.compress_ed_item(doc['ed'])) for doc in item_collection.find({}, {'ed': 1})]
+
+    def export(items):
+        start = time.time()
+        catalog_xml = export_catalog.export_catalog(items, None)
+        return catalog_xml, time.time() - start
+
+    # the query and the projection of the exporter before the compact schema
+    old_items = item_collection.find(
+        {'shoptet_from_ed': {'$ne': None}},
+        {'_id': 0, 'code': 1, 'shoptet_from_ed': 1, 'shoptet': 1}).sort('code', 1)
+    old_xml, old_export_time = export(old_items)
+    old_size = mean_document_size(item_collection)
+
+    start = time.time()
+    migrated_count = migrate_schema.migrate_items(item_collection)
+    migration_time = time.time() - start
+    new_xml, new_export_time = export(export_catalog.find_export_items(item_store))
+    new_size = mean_document_size(item_collection)
+    item_store.drop()
+    return OrderedDict([
+        ('items', migrated_count),
+        ('old_document_bytes', old_size),
+        ('new_document_bytes', new_size),
+        ('compressed_raw_item_bytes', sum(raw_sizes) / len(raw_sizes) if raw_sizes else 0),
+        ('old_export_time', old_export_time),
+        ('new_export_time', new_export_time),
+        ('migration_time', migration_time),
+        ('export_matches', old_xml == new_xml),
+    ])
+
+
+def mean_document_size(item_collection):
+    """Mean size of the stored documents in BSON in bytes."""
+    sizes = [len(bson.BSON.encode(doc)) for doc in item_collection.find()]
+    return sum(sizes) / len(sizes) if sizes else 0
+
+
+def export_codes(item_store):
+    return [item['code'] for item in item_store.export_scan()]
+
+
+def add_shoptet_items(item_store, codes, every=4):
+    """
+    Marks every n-th of the (sorted) ED item codes as existing in Shoptet,
+    so that the export produces both the new and the updated variants
+    of SHOPITEM.
+    """
+    with item_store.writer() as writer:
+        for (i, code) in enumerate(codes[::every]):
+            shoptet_item = {
+                'CODE': code,
+                'VISIBLE': i % 2 == 0,
+                'AVAILABILITY_IN_STOCK': ['', 'Ihned k odeslání', 'Skladem u dodavatele'][i % 3]}
+            writer.add((code, {'shoptet': shoptet_item}))
+
+
+def benchmark_store(mongo_uri):
+    """MongoItemStore of the URI or of mongomock if None."""
+    if mongo_uri:
+        return MongoItemStore(store.get_database(mongo_uri))
+    try:
+        import mongomock
+    except ImportError:
+        print('Either pass --mongo-uri or install mongomock (see requirements.dev.txt).')
+        raise
+    return MongoItemStore(mongomock.MongoClient().s3dt_benchmark)
+
+
+BROWSE_FILTERS = [{}, {'manufacturer': 'MakerBot'}, {'status': 'Novinka'}, {'stock': 'in'}, {'visible': True},
+                  {'source': 'ed'}, {'source': 'shoptet'}, {'source': 'both'}]
+# prefixes of the words of the synthetic product names
+SEARCH_TEXTS = ['tisk', 'filament pla', 'prusa 12', 'ultim']
+
+
+def benchmark_storage(catalog_path, store_uris, parser_engine='lxml', lookups=1000):
+    """
+    Checks each store by item_store.check_item_store() and measures the
+    stages of the pipeline which access it - the initial load, the reload
+    of the unchanged catalog, lookups by codes, a page of each browse
+    filter and the export. The exports must be the same for all the stores.
+
+    store_uris - MongoDB or sqlite:// URIs of scratch databases (their data
+        is dropped!), 'mongomock' for an in-memory MongoDB
+    """
+    results = OrderedDict()
+    reference_xml = None
+    for uri in store_uris:
+        item_store = benchmark_store(None) if uri == 'mongomock' else store.get_item_store(uri)
+        check_item_store(item_store)
+        stages = OrderedDict()
+
+        def load():
+            counter = quiet_counter()
+            start = time.time()
+            with open(catalog_path, 'rb') as catalog_xml:
+                ed_catalog.load_catalog_to_mongo(catalog_xml, item_store, counter, parser_engine=parser_engine)
+            return stage_result(counter.total, time.time() - start,
+                                written_items=counter.inserted + counter.updated)
+
+        stages['load'] = load()
+        stages['reload_unchanged'] = load()
+
+        codes = export_codes(item_store)
+        add_shoptet_items(item_store, codes)
+        lookup_codes = codes[::max(1, len(codes) // lookups)]
+        start = time.time()
+        for i in range(0, len(lookup_codes), 100):
+            item_store.get_by_codes(lookup_codes[i:i + 100])
+        stages['get_by_codes'] = stage_result(len(lookup_codes), time.time() - start)
+
+        # a page of each browse filter from the middle of the catalog
+        after = codes[len(codes) // 2] if codes else None
+        start = time.time()
+        for filters in BROWSE_FILTERS:
+            item_store.browse(filters, after)
+        stages['browse'] = stage_result(len(BROWSE_FILTERS), time.time() - start)
+        start = time.time()
+        for text in SEARCH_TEXTS:
+            item_store.browse({'text': text}, after)
+        stages['search'] = stage_result(len(SEARCH_TEXTS), time.time() - start)
+
+        start = time.time()
+        catalog_xml = export_catalog.export_catalog(export_catalog.find_export_items(item_store), None)
+        stages['export'] = stage_result(len(codes), time.time() - start)
+        if reference_xml is None:
+            reference_xml = catalog_xml
+        stages['export_matches'] = catalog_xml == reference_xml
+        item_store.drop()
+        results[uri] = stages
+        print('%s: %s' % (uri, ', '.join('%s %.3f sec' % (name, stage['elapsed_time'])
+                                         for (name, stage) in stages.items() if isinstance(stage, dict))))
+    return results
+
+
+def quiet_counter():
+    return ed_catalog.Counter(report=lambda counter: None, report_period=10 ** 9)
+
+
+def stage_result(items, elapsed, **extra):
+    result = OrderedDict([
+        ('items', items),
+        ('elapsed_time', elapsed),
+        ('items_per_sec', items / elapsed if elapsed > 0 else None),
+        # the peak of the whole process so far, not just of this stage
+        ('peak_rss', peak_rss()),
+    ])
+    result.update(sorted(extra.items()))
+    return result
+
+
+def compare_results(baseline, current, threshold=0.1):
+    """
+    Compares two results of benchmark_suite(). Returns a list of the
+    regressions - a stage of a size whose throughput dropped or whose
+    peak RSS grew by more than the threshold (relative).
+    """
+    regressions = []
+    for (size, stages) in current['results'].items():
+        baseline_stages = baseline['results'].get(size, {})
+        for (stage, result) in stages.items():
+            baseline_result = baseline_stages.get(stage)
+            if baseline_result is None:
+                continue
+            old_rate, new_rate = baseline_result['items_per_sec'], result['items_per_sec']
+            if old_rate and new_rate is not None and new_rate < old_rate * (1 - threshold):
+                regressions.append((size, stage, 'items_per_sec', old_rate, new_rate))
+            old_rss, new_rss = baseline_result['peak_rss'], result['peak_rss']
+            if new_rss > old_rss * (1 + threshold):
+                regressions.append((size, stage, 'peak_rss', old_rss, new_rss))
+    return regressions
+
+
+def print_comparison(baseline, current):
+    print('%-10s %-28s %14s %14s %8s' % ('size', 'stage', 'items/sec', 'was', 'change'))
+    for (size, stages) in current['results'].items():
+        for (stage, result) in stages.items():
+            baseline_result = baseline['results'].get(size, {}).get(stage)
+            if baseline_result is None or not baseline_result['items_per_sec'] or result['items_per_sec'] is None:
+                continue
+            old_rate, new_rate = baseline_result['items_per_sec'], result['items_per_sec']
+            print('%-10s %-28s %14.1f %14.1f %+7.1f%%' % (
+                size, stage, new_rate, old_rate, 100.0 * (new_rate - old_rate) / old_rate))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes (Linux reports KiB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of the ED -> Shoptet catalog pipeline.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    parsers_parser = subparsers.add_parser(
+        'parsers', help='Compare the ED catalog parser engines (parity and items/sec)')
+    parsers_parser.add_argument('catalog', help='Path to catalog in ED XML format')
+    parsers_parser.add_argument('-r', '--repeat', type=int, default=1,
+                                help='Number of repetitions')
+
+    download_parser = subparsers.add_parser(
+        'download', help='Measure throughput and memory of the ED catalog download')
+    download_parser.add_argument('url', help='URL of the ED catalog (XML or ZIP)')
+
+    shards_parser = subparsers.add_parser(
+        'shards', help='Measure scaling of the parallel ingest with the number of workers')
+    shards_parser.add_argument('catalog', help='Path to catalog in ED XML format')
+    shards_parser.add_argument('--mongo-uri', required=True,
+                               help='MongoDB URI of a scratch database (its items are dropped!)')
+    shards_parser.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 2, 4],
+                               help='Numbers of worker processes to compare')
+    shards_parser.add_argument('-e', '--engine', default='lxml', choices=ed_catalog.PARSER_ENGINES)
+
+    suite_parser = subparsers.add_parser(
+        'suite', help='Measure all pipeline stages on synthetic catalogs')
+    suite_parser.add_argument('-n', '--sizes', type=int, nargs='+', default=SUITE_SIZES,
+                              help='Numbers of products of the generated catalogs')
+    suite_parser.add_argument('--mongo-uri',
+                              help='MongoDB URI of a scratch database (its items are dropped!), '
+                                   'mongomock is used if not given')
+    suite_parser.add_argument('-e', '--engine', default='lxml', choices=ed_catalog.PARSER_ENGINES)
+    suite_parser.add_argument('-s', '--selected-ratio', type=float, default=0.5,
+                              help='Fraction of products in the 3D print category')
+    suite_parser.add_argument('-w', '--work-dir',
+                              help='Directory for the generated files (kept), a temporary one by default')
+    suite_parser.add_argument('-o', '--output', help='Path to the results JSON')
+
+    schema_parser = subparsers.add_parser(
+        'schema', help='Compare the document size and export time of the old and the compact schema')
+    schema_parser.add_argument('catalog', help='Path to catalog in ED XML format')
+    schema_parser.add_argument('--mongo-uri',
+                               help='MongoDB URI of a scratch database (its items are dropped!), '
+                                    'mongomock is used if not given')
+    schema_parser.add_argument('-e', '--engine', default='lxml', choices=ed_catalog.PARSER_ENGINES)
+
+    convert_parser = subparsers.add_parser(
+        'convert', help='Check convert_items() against convert_item() on generated items and compare their speed')
+    convert_parser.add_argument('-n', '--items', type=int, default=100000, help='Number of generated items')
+    convert_parser.add_argument('--seed', type=int, default=0)
+    convert_parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of repetitions')
+
+    storage_parser = subparsers.add_parser(
+        'storage', help='Check the item stores and compare their load, lookup and export times')
+    storage_parser.add_argument('catalog', help='Path to catalog in ED XML format')
+    storage_parser.add_argument('uris', metavar='URI', nargs='+',
+                                help='MongoDB or sqlite:// URI of a scratch database (its data is dropped!), '
+                                     'mongomock for an in-memory MongoDB')
+    storage_parser.add_argument('-e', '--engine', default='lxml', choices=ed_catalog.PARSER_ENGINES)
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='Compare two suite results and flag the regressions')
+    compare_parser.add_argument('baseline', help='Results JSON of the baseline commit')
+    compare_parser.add_argument('current', help='Results JSON of the current commit')
+    compare_parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                                help='Relative change considered a regression')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.command == 'parsers':
+        results = benchmark_parsers(args.catalog, args.repeat)
+        print(json.dumps(results, indent=2, sort_keys=True))
+        if not all(result['matches_reference'] for result in results.values()):
+            print('Parser engines produced different items!')
+            sys.exit(1)
+    elif args.command == 'download':
+        print(json.dumps(benchmark_download(args.url), indent=2, sort_keys=True))
+    elif args.command == 'shards':
+        results = benchmark_shards(args.catalog, args.mongo_uri, args.workers, args.engine)
+        print(json.dumps(results, indent=2, sort_keys=True))
+        if not all(result['matches_reference'] for result in results.values()):
+            print('Parallel ingest produced different documents!')
+            sys.exit(1)
+    elif args.command == 'suite':
+        work_dir = args.work_dir or tempfile.mkdtemp(prefix='s3dt_benchmark_')
+        os.makedirs(work_dir, exist_ok=True)
+        try:
+            results = benchmark_suite(args.sizes, work_dir, args.mongo_uri, args.engine, args.selected_ratio)
+        finally:
+            if not args.work_dir:
+                shutil.rmtree(work_dir)
+        results_json = json.dumps(results, indent=2)
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                output_file.write(results_json)
+        print(results_json)
+    elif args.command == 'schema':
+        results = benchmark_schema(args.catalog, args.mongo_uri, args.engine)
+        print(json.dumps(results, indent=2))
+        if not results['export_matches']:
+            print('The compact schema produced a different export!')
+            sys.exit(1)
+    elif args.command == 'convert':
+        results = benchmark_convert(args.items, args.seed, args.repeat)
+        print(json.dumps(results, indent=2))
+        if not results['matches_reference']:
+            print('convert_items() produced different items!')
+            sys.exit(1)
+    elif args.command == 'storage':
+        results = benchmark_storage(args.catalog, args.uris, args.engine)
+        print(json.dumps(results, indent=2))
+        if not all(stages['export_matches'] for stages in results.values()):
+            print('The stores produced different exports!')
+            sys.exit(1)
+    elif args.command == 'compare':
+        with open(args.baseline) as baseline_file, open(args.current) as current_file:
+            baseline, current = json.load(baseline_file), json.load(current_file)
+        print_comparison(baseline, current)
+        regressions = compare_results(baseline, current, args.threshold)
+        for (size, stage, metric, old_value, new_value) in regressions:
+            print('REGRESSION: %s products, %s, %s: %.1f -> %.1f' % (size, stage, metric, old_value, new_value))
+        if regressions:
+            sys.exit(1)
+    else:
+        print('Unknown command, see --help')
+        sys.exit(2)
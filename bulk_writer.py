@@ -0,0 +1,103 @@
+"""
+Batched writes to MongoDB.
+
+Instead of one round trip per document the operations (eg. `UpdateOne`)
+are collected and sent in batches via an unordered `bulk_write()`.
+"""
+
+import time
+
+from pymongo.errors import BulkWriteError
+
+# code of the write error of a unique index violation (E11000)
+DUPLICATE_KEY_ERROR = 11000
+
+
+class BulkWriter(object):
+    """
+    Collects write operations and flushes them to a collection in batches.
+
+    collection - MongoDB collection
+    batch_size - maximum number of operations in a single bulk_write()
+    counter - optional Counter which gets notified about each flushed batch
+
+    Can be used as a context manager which flushes the last partial batch.
+    """
+
+    def __init__(self, collection, batch_size=1000, counter=None):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.counter = counter
+        self.operations = []
+        # documents inserted or actually modified by the flushed batches
+        self.changed_count = 0
+
+    def add(self, operation):
+        self.operations.append(operation)
+        if len(self.operations) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.operations:
+            return
+        operations, self.operations = self.operations, []
+        start = time.time()
+        changed_count, error_count = self.write_batch(operations)
+        self.changed_count += changed_count
+        latency = time.time() - start
+        if self.counter is not None:
+            self.counter.batch_flushed(len(operations), latency, error_count, changed_count)
+
+    def write_batch(self, operations):
+        """
+        Writes the operations, returns the number of documents inserted
+        or modified and the number of failed operations.
+        """
+        changed_count, write_errors = self.bulk_write(operations)
+        print_write_errors(write_errors, len(operations))
+        return changed_count, len(write_errors)
+
+    def bulk_write(self, operations, retries=1):
+        """
+        Writes the operations, returns the number of documents inserted
+        or modified and the write errors (with the index of the failed
+        operation).
+
+        The operations which failed on a duplicate key are retried. Two
+        concurrent upserts of the same new document (eg. by the ED and the
+        Shoptet ingest) may both try to insert it, the unique index rejects
+        one of them, which then updates the inserted document instead.
+        """
+        try:
+            # unordered: the server may apply the operations in parallel and
+            # a failed operation does not prevent the others from being applied
+            result = self.collection.bulk_write(operations, ordered=False)
+            return result.inserted_count + result.upserted_count + (result.modified_count or 0), []
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            changed_count = e.details.get('nInserted', 0) + e.details.get('nUpserted', 0) + \
+                e.details.get('nModified', 0)
+        duplicates = [error for error in write_errors if error.get('code') == DUPLICATE_KEY_ERROR]
+        if not duplicates or retries <= 0:
+            return changed_count, write_errors
+        print('bulk write: retrying %d operations failed on a duplicate key' % len(duplicates))
+        retried_count, retry_errors = self.bulk_write([operations[error['index']] for error in duplicates],
+                                                      retries - 1)
+        # the indexes of the retried operations within the whole batch
+        write_errors = [error for error in write_errors if error.get('code') != DUPLICATE_KEY_ERROR] + \
+            [dict(error, index=duplicates[error['index']]['index']) for error in retry_errors]
+        return changed_count + retried_count, write_errors
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+
+def print_write_errors(write_errors, operation_count):
+    if write_errors:
+        print('bulk write: %d of %d operations failed' % (len(write_errors), operation_count))
+        for error in write_errors:
+            print('  #%d: %s' % (error.get('index'), error.get('errmsg')))
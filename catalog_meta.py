@@ -0,0 +1,94 @@
+"""
+Counters of the catalog data kept in the meta collection of the database.
+
+data version - incremented by each ingest which changed some documents,
+    the export artifacts are keyed by it
+change sequence - allocated by each ingest, the documents whose exported
+    price, stock, VAT or visibility it changed are marked by it, so that
+    a delta export can select the products changed since a given sequence
+committed change sequence - the sequence up to which all the ingests have
+    finished, ingests run concurrently and finish in any order, so only
+    this one is safe as the cursor of the delta export
+
+The sequences of the running ingests are kept as pending in the change
+sequence document. An ingest killed without committing its sequence holds
+the committed one back for PENDING_TIMEOUT seconds.
+"""
+
+import time
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+DATA_VERSION_ID = 'data_version'
+CHANGE_SEQ_ID = 'change_seq'
+
+PENDING_TIMEOUT = 24 * 3600
+
+
+def get_data_version(db):
+    return _get_counter(db, DATA_VERSION_ID)
+
+
+def bump_data_version(db):
+    """Marks that the data has changed. Returns the new version."""
+    return _increment_counter(db, DATA_VERSION_ID)
+
+
+def get_change_seq(db):
+    """The last allocated change sequence (0 if none yet)."""
+    return _get_counter(db, CHANGE_SEQ_ID)
+
+
+def next_change_seq(db):
+    """
+    Allocates a new change sequence for an ingest, which must commit it
+    once finished (see commit_change_seq()).
+    """
+    while True:
+        doc = db.meta.find_one({'_id': CHANGE_SEQ_ID})
+        if doc is None:
+            try:
+                db.meta.insert_one({'_id': CHANGE_SEQ_ID, 'version': 1, 'pending': [_pending(1)]})
+                return 1
+            except DuplicateKeyError:
+                continue
+        # the sequence is allocated and marked pending atomically,
+        # retried if another ingest allocated one meanwhile
+        change_seq = doc['version'] + 1
+        result = db.meta.update_one(
+            {'_id': CHANGE_SEQ_ID, 'version': doc['version']},
+            {'$set': {'version': change_seq}, '$push': {'pending': _pending(change_seq)}})
+        if result.matched_count:
+            return change_seq
+
+
+def commit_change_seq(db, change_seq):
+    """Marks that the ingest which allocated change_seq has finished (or failed)."""
+    db.meta.update_one({'_id': CHANGE_SEQ_ID}, {'$pull': {'pending': {'seq': change_seq}}})
+
+
+def get_committed_change_seq(db):
+    """The last change sequence up to which all the ingests have finished."""
+    doc = db.meta.find_one({'_id': CHANGE_SEQ_ID})
+    if doc is None:
+        return 0
+    started_after = time.time() - PENDING_TIMEOUT
+    pending = [p['seq'] for p in doc.get('pending', []) if p['started'] > started_after]
+    return min(pending) - 1 if pending else doc['version']
+
+
+def _pending(change_seq):
+    return {'seq': change_seq, 'started': time.time()}
+
+
+def _get_counter(db, counter_id):
+    doc = db.meta.find_one({'_id': counter_id})
+    return doc['version'] if doc else 0
+
+
+def _increment_counter(db, counter_id):
+    doc = db.meta.find_one_and_update(
+        {'_id': counter_id}, {'$inc': {'version': 1}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+    return doc['version']
@@ -0,0 +1,204 @@
+"""
+On-disk cache of downloaded files keyed by URL.
+
+The ETag and Last-Modified of each response are stored along with the file
+and sent as conditional request headers the next time, so that an unchanged
+file is not downloaded again. Interrupted downloads are resumed via HTTP
+Range requests. The least recently used files are evicted when the cache
+grows over its size limit.
+
+A downloaded file is reported as changed until its consumer (eg. an ingest
+into a given store) commits it once processed successfully. So a file whose
+processing failed is processed again the next time even if the server
+responds 304 Not Modified, then it is read from the cache.
+"""
+
+import hashlib
+import json
+import os
+import time
+from collections import namedtuple
+from contextlib import closing
+
+import requests
+
+# status - one of:
+#   'not_modified' - the server responded 304, the cached file is used
+#   'unchanged' - the file was downloaded, but it is identical to the cached one
+#   'downloaded' - a new or modified file was downloaded
+#   'resumed' - same as 'downloaded', but continued from an interrupted download
+# changed - False if the cached file has already been committed by the consumer
+# key - identifies the consumer of the file
+CachedDownload = namedtuple('CachedDownload', ['path', 'status', 'changed', 'digest', 'url', 'key'])
+
+
+class DownloadCache(object):
+    """
+    cache_dir - directory where the files are stored
+    max_size - maximum total size of the cached files in bytes
+    """
+
+    def __init__(self, cache_dir, max_size=1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def fetch(self, url, counter=None, chunk_size=64 * 1024, key='', force=False):
+        """
+        Makes sure the current version of the file at URL is in the cache.
+        Returns CachedDownload. Reports the bytes transferred, the elapsed
+        time and the cache status to the counter.
+
+        key - identifies the consumer of the file, see commit()
+        force - report the file as changed even if it has been committed
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        data_path, part_path = self._data_path(url), self._part_path(url)
+        meta = self._load_meta(url) if os.path.exists(data_path) else None
+        part_meta = self._load_json(part_path + '.json') if os.path.exists(part_path) else None
+
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        resume_from = os.path.getsize(part_path) if part_meta is not None else 0
+        if resume_from > 0 and (part_meta.get('etag') or part_meta.get('last_modified')):
+            headers['Range'] = 'bytes=%d-' % resume_from
+            # the server sends the whole file if it has changed meanwhile
+            headers['If-Range'] = part_meta.get('etag') or part_meta.get('last_modified')
+
+        start = time.time()
+        size = 0
+        with closing(requests.get(url, headers=headers, stream=True)) as response:
+            print('response: %s' % response)
+            if response.status_code == 304:
+                status = 'not_modified'
+            else:
+                response.raise_for_status()
+                is_resumed = response.status_code == 206 and \
+                    self._content_range_start(response) == resume_from
+                if not is_resumed and response.status_code != 200:
+                    raise IOError('Unexpected response to a range request: %s' % response)
+                status = 'resumed' if is_resumed else 'downloaded'
+                self._save_json(part_path + '.json', {
+                    'url': url,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified')})
+                digest = hashlib.sha1()
+                with open(part_path, 'r+b' if is_resumed else 'wb') as part_file:
+                    if is_resumed:
+                        _update_digest(digest, part_file, chunk_size)
+                        part_file.seek(resume_from)
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        part_file.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                part_meta = self._load_json(part_path + '.json')
+        elapsed = time.time() - start
+
+        if status == 'not_modified':
+            meta['last_access'] = time.time()
+        else:
+            digest = digest.hexdigest()
+            if meta is not None and meta.get('digest') == digest:
+                status = 'unchanged'
+            os.replace(part_path, data_path)
+            os.remove(part_path + '.json')
+            meta = {
+                'url': url,
+                'etag': part_meta['etag'],
+                'last_modified': part_meta['last_modified'],
+                'digest': digest,
+                'size': os.path.getsize(data_path),
+                'last_access': time.time(),
+                # key -> digest of the file committed by each consumer
+                'committed': meta.get('committed', {}) if meta is not None else {}}
+        self._save_json(self._meta_path(url), meta)
+        print('download cache: %s, %d bytes in %.3f sec' % (status, size, elapsed))
+        if counter is not None:
+            counter.download_finished(size, elapsed, status)
+
+        self.evict(keep=data_path)
+        changed = force or meta.get('committed', {}).get(key) != meta['digest']
+        return CachedDownload(data_path, status, changed, meta['digest'], url, key)
+
+    def commit(self, download):
+        """
+        Marks the fetched file as processed by its consumer (download.key),
+        so that it is not reported as changed until it is modified.
+        """
+        meta = self._load_meta(download.url)
+        if meta is None or meta.get('digest') != download.digest:
+            # evicted or replaced meanwhile
+            return
+        meta.setdefault('committed', {})[download.key] = download.digest
+        self._save_json(self._meta_path(download.url), meta)
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used files until the total size
+        fits the limit. The file at path keep is never removed.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json') or name.endswith('.part.json'):
+                continue
+            meta = self._load_json(os.path.join(self.cache_dir, name))
+            entries.append((meta.get('last_access', 0), meta.get('size', 0), meta['url']))
+        total_size = sum(size for (_, size, _) in entries)
+        for (_, size, url) in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if self._data_path(url) == keep:
+                continue
+            print('download cache: evicting', url)
+            for path in (self._data_path(url), self._meta_path(url)):
+                if os.path.exists(path):
+                    os.remove(path)
+            total_size -= size
+
+    def _load_meta(self, url):
+        meta_path = self._meta_path(url)
+        return self._load_json(meta_path) if os.path.exists(meta_path) else None
+
+    def _key(self, url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def _data_path(self, url):
+        return os.path.join(self.cache_dir, self._key(url) + '.data')
+
+    def _part_path(self, url):
+        return os.path.join(self.cache_dir, self._key(url) + '.part')
+
+    def _meta_path(self, url):
+        return os.path.join(self.cache_dir, self._key(url) + '.json')
+
+    @staticmethod
+    def _content_range_start(response):
+        # eg. 'bytes 1000-1999/2000'
+        content_range = response.headers.get('Content-Range', '')
+        try:
+            return int(content_range.split(' ')[1].split('-')[0])
+        except (IndexError, ValueError):
+            return None
+
+    @staticmethod
+    def _load_json(path):
+        with open(path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def _save_json(path, data):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+
+def _update_digest(digest, input_file, chunk_size):
+    while True:
+        chunk = input_file.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
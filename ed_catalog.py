@@ -1,30 +1,63 @@
-import os
+import hashlib
+import io
+import json
 import re
+import resource
+import shutil
+import tempfile
+import time
+import zlib
 from collections import OrderedDict
+from contextlib import closing, contextmanager
 from decimal import Decimal, ROUND_HALF_UP
-from zipfile import ZipFile
+from functools import lru_cache
+from zipfile import ZipFile, is_zipfile
 
 import requests
 import xmltodict
-from pymongo import MongoClient
-from werkzeug.contrib.iterio import IterIO
+from lxml import etree
 
+import store
+from history import HistoryWriter
+from pipeline import END, Pipeline, QueueReader, QueueWriter
+from zip_stream import LOCAL_FILE_HEADER_SIGNATURE, ZipStreamReader
 
-def download_ed_catalog(catalog_url):
-    print('download_ed_catalog({})', catalog_url)
-    catalog_res = requests.get(catalog_url, stream=True)
-    print('response: {}', catalog_res)
 
-    # Read the request content, zip file and XML file via a stream to prevent
-    # reading the whole data into memory at once. The memory used should be
-    # constant regardless of the size of the input data.
-    if not catalog_url.endswith('.zip'):
-        catalog_xml = IterIO(catalog_res.iter_lines)
+@contextmanager
+def open_catalog_xml(catalog_file):
+    """
+    Provides a stream of the catalog XML from a seekable file which contains
+    either the XML itself or a ZIP archive with the XML as the first member.
+    """
+    is_zip = is_zipfile(catalog_file)
+    catalog_file.seek(0)
+    if is_zip:
+        with ZipFile(catalog_file) as zf:
+            with zf.open(zf.filelist[0], 'r') as xml_file:
+                yield xml_file
     else:
-        with ZipFile(IterIO(catalog_res.iter_content(chunk_size=4096), sentinel=b'')) as zf:
-            with zf.open(zf.filelist[0].filename, 'r') as xml_file:
-                catalog_xml = xml_file
-    return catalog_xml
+        yield catalog_file
+
+
+def spool_response(url, output_file, counter=None, chunk_size=64 * 1024):
+    """
+    Downloads the URL to a file-like in chunks. Reports the number
+    of downloaded bytes and the elapsed time to the counter.
+    """
+    start = time.time()
+    size = 0
+    with closing(requests.get(url, stream=True)) as response:
+        print('response: %s' % response)
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            output_file.write(chunk)
+            size += len(chunk)
+    output_file.flush()
+    elapsed = time.time() - start
+    print('downloaded %d bytes in %.3f sec' % (size, elapsed))
+    if counter is not None:
+        counter.download_finished(size, elapsed)
+    return size
 
 
 def get_ed_catalog_url(catalog_request_url, login, password):
@@ -41,54 +74,295 @@ def get_ed_catalog_url(catalog_request_url, login, password):
     return catalog_url
 
 
-def process_catalog(input_xml, process_item):
+# available implementations of process_catalog()
+PARSER_ENGINES = ('xmltodict', 'lxml')
+
+
+def process_catalog(input_xml, process_item, engine='xmltodict', item_filter=None, item_visited=None):
     print('process_catalog()')
     '''
     Processes each product item from an ED catalog XML in a streamed way.
     input_xml - a string or stream representing the XML
-    process_item - a function to be called for each item (OrderedDict)
+    process_item - a function to be called for each item (dict)
+    engine - parser implementation, one of PARSER_ENGINES
+    item_filter - optional predicate item_filter(commodity_name, commodity_code);
+        process_item() is called only for accepted items
+    item_visited - optional function called for every item before filtering
     '''
 
+    if engine == 'xmltodict':
+        process_catalog_xmltodict(input_xml, process_item, item_filter, item_visited)
+    elif engine == 'lxml':
+        for item in iter_catalog_items_lxml(input_xml, item_filter, item_visited):
+            process_item(item)
+    else:
+        raise ValueError('Unknown parser engine: %s' % engine)
+
+
+def process_catalog_xmltodict(input_xml, process_item, item_filter=None, item_visited=None):
+    # NOTE: xmltodict builds the whole item before we can look at it,
+    # so the filter does not save any work here
     expected_path = ['ResponseProductList', 'ProductList', 'Product']
 
     def handle_item(path, item):
         if [key for (key, value) in path] == expected_path:
-            process_item(item)
+            if item_visited is not None:
+                item_visited()
+            if item_filter is None or item_filter(item['CommodityName'], item['CommodityCode']):
+                process_item(item)
         return True
 
     xmltodict.parse(input_xml, item_depth=3, item_callback=handle_item)
 
 
-def is_3d_print_item(item):
+def iter_catalog_items_lxml(input_xml, item_filter=None, item_visited=None):
+    """
+    Yields each product item from an ED catalog XML using lxml iterparse().
+
+    The items are the same as from xmltodict, just plain dicts. Each
+    processed element is cleared along with its preceding siblings so that
+    the memory used does not grow with the number of products.
+
+    Products rejected by item_filter are discarded without converting
+    them to dicts, only their CommodityName and CommodityCode are read.
+    """
+    if isinstance(input_xml, str):
+        input_xml = io.BytesIO(input_xml.encode('utf-8'))
+    for _, element in etree.iterparse(input_xml, events=('end',), tag='Product'):
+        if _is_product_element(element):
+            if item_visited is not None:
+                item_visited()
+            if item_filter is None or item_filter(
+                    _child_text(element, 'CommodityName'),
+                    _child_text(element, 'CommodityCode')):
+                yield _product_to_dict(element)
+        element.clear()
+        parent = element.getparent()
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def _child_text(element, tag):
+    # the same value as in the item dict, ie. stripped text or None
+    text = element.findtext(tag)
+    return text.strip() or None if text else None
+
+
+def _is_product_element(element):
+    # same as the expected path ResponseProductList/ProductList/Product
+    product_list = element.getparent()
+    if product_list is None or product_list.tag != 'ProductList':
+        return False
+    root = product_list.getparent()
+    return root is not None and root.tag == 'ResponseProductList' and root.getparent() is None
+
+
+def _product_to_dict(element):
+    # xmltodict passes the attributes of the item element in the path and
+    # its own (unstripped) text only if it has no children
+    item = _children_to_dict(element)
+    if item:
+        return item
+    return element.text or None
+
+
+def _element_to_value(element):
+    """
+    Converts an element into a value the same way as xmltodict: attributes
+    are prefixed with '@', repeated children form a list, text is stripped
+    and empty text becomes None.
+    """
+    if len(element) == 0 and not element.attrib:
+        return element.text.strip() or None if element.text else None
+    value = {}
+    for key, attr_value in element.attrib.items():
+        value['@' + key] = attr_value
+    value.update(_children_to_dict(element))
+    text = _element_text(element)
+    if text:
+        value['#text'] = text
+    return value
+
+
+def _children_to_dict(element):
+    item = {}
+    for child in element:
+        if not isinstance(child.tag, str):
+            # comments and processing instructions
+            continue
+        value = _element_to_value(child)
+        if child.tag not in item:
+            item[child.tag] = value
+        elif isinstance(item[child.tag], list):
+            item[child.tag].append(value)
+        else:
+            item[child.tag] = [item[child.tag], value]
+    return item
+
+
+def _element_text(element):
+    # xmltodict joins all the character data directly inside the element
+    return ''.join([element.text or ''] + [child.tail or '' for child in element]).strip()
+
+
+class CategoryFilter(object):
+    """
+    Selects products from given categories by their commodity name or code.
+
+    Can be passed as item_filter to process_catalog().
+    """
+
+    def __init__(self, names=('3D TISK',), codes=('3DP',)):
+        self.names = frozenset(names)
+        self.codes = frozenset(codes)
+
+    def __call__(self, commodity_name, commodity_code):
+        return commodity_name in self.names or commodity_code in self.codes
+
+    def __repr__(self):
+        return 'CategoryFilter(names=%r, codes=%r)' % (sorted(self.names), sorted(self.codes))
+
+
+# products from the 3D print category
+DEFAULT_CATEGORY_FILTER = CategoryFilter()
+
+
+def is_3d_print_item(item, category_filter=DEFAULT_CATEGORY_FILTER):
     """Filters products from just a single category"""
-    return item['CommodityName'] == '3D TISK' or item['CommodityCode'] == '3DP'
+    return category_filter(item['CommodityName'], item['CommodityCode'])
+
+
+def item_digest(ed_item):
+    """
+    Computes a stable digest of a raw ED item (independent of the key order).
+    """
+    item_json = json.dumps(ed_item, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(item_json.encode('utf-8')).hexdigest()
+
+
+# raw ED fields kept in the stored items, the rest is only needed for the conversion
+ED_STORED_FIELDS = ('ProId', 'Code', 'CommodityCode', 'CommodityName', 'ProducerName', 'Status',
+                    'OnStock', 'OnStockText')
+
+
+def compact_ed_item(ed_item):
+    """Returns just the stored fields of a raw ED item."""
+    return OrderedDict((field, ed_item[field]) for field in ED_STORED_FIELDS if field in ed_item)
+
+
+def compress_ed_item(ed_item):
+    """Returns the whole raw ED item as zlib compressed JSON."""
+    return zlib.compress(json.dumps(ed_item, separators=(',', ':')).encode('utf-8'))
+
+
+def decompress_ed_item(data):
+    return json.loads(zlib.decompress(data).decode('utf-8'), object_pairs_hook=OrderedDict)
 
 
-def update_item_to_mongo(ed_item, collection):
+# converted fields whose change puts the product into a delta export
+EXPORT_DELTA_FIELDS = ('PRICE', 'STANDARD_PRICE', 'PURCHASE_PRICE', 'PRICE_VAT', 'VAT',
+                       'STOCK', 'AVAILABILITY_IN_STOCK')
+
+
+def export_digest(shoptet_item):
+    """Digest of the converted fields exported in a delta."""
+    return item_digest(OrderedDict((field, shoptet_item.get(field)) for field in EXPORT_DELTA_FIELDS))
+
+
+def item_upsert(ed_item, shoptet_item, digest, delta_digest, change_seq=None, store_raw=False):
+    """
+    Returns the upsert (code, fields) of a converted item. The change_seq
+    is set if the exported fields have changed. Only a few raw ED fields
+    are stored, the whole raw item is stored compressed if store_raw.
+    """
     # NOTE: upsert is much slower than insert, but we'd like to
     # store also items from Shoptet in the same collection
-    print('updating item', ed_item['Code'])
-    shoptet_item = convert_item(ed_item)
-    collection.update(
-        {'code': ed_item['Code']},
-        {'$set': {
-            'code': ed_item['Code'],
-            'ed': ed_item,
-            'shoptet_from_ed': shoptet_item}},
-        upsert=True)
-
-
-def load_catalog_to_mongo(input_xml, item_collection, counter):
-    def process_item(item):
-        counter.item_visited()
-        if is_3d_print_item(item):
-            counter.item_selected()
-            update_item_to_mongo(item, item_collection)
+    fields = {
+        'code': ed_item['Code'],
+        'ed': compact_ed_item(ed_item),
+        'ed_digest': digest,
+        'export_digest': delta_digest,
+        'has_export': True,
+        'shoptet_from_ed': shoptet_item}
+    if change_seq is not None:
+        fields['change_seq'] = change_seq
+    if store_raw:
+        fields['ed_raw'] = compress_ed_item(ed_item)
+    return ed_item['Code'], fields
+
+
+def changed_item_upsert(ed_item, digests, counter, change_seq=None, store_raw=False):
+    """
+    Returns the upsert of a selected item or None if the item has not
+    changed since it was stored (its digest is the same). A new item or
+    an item whose exported fields have changed is marked by change_seq.
+    """
+    code = ed_item['Code']
+    digest = item_digest(ed_item)
+    stored_digest, stored_export_digest = digests.get(code, (None, None))
+    if code not in digests:
+        counter.item_inserted()
+    elif stored_digest == digest:
+        counter.item_unchanged()
+        return None
+    else:
+        counter.item_updated()
+    shoptet_item = fast_convert_item(ed_item)
+    delta_digest = export_digest(shoptet_item)
+    is_export_changed = code not in digests or stored_export_digest != delta_digest
+    digests[code] = (digest, delta_digest)
+    return item_upsert(ed_item, shoptet_item, digest, delta_digest, change_seq if is_export_changed else None,
+                       store_raw)
 
-    process_catalog(input_xml, process_item)
+
+def load_catalog_to_mongo(input_xml, item_store, counter, batch_size=1000, parser_engine='xmltodict',
+                          category_filter=DEFAULT_CATEGORY_FILTER, digests=None, change_seq=None, store_raw=False):
+    """
+    Loads the selected items of a catalog XML to an item_store.ItemStore.
+
+    digests - the stored digests, loaded from the store if None
+    change_seq - marks the items with changed exported fields,
+        a new one is allocated (and committed once loaded) if None
+    store_raw - store also the whole raw ED items compressed
+    """
+    # items whose digest did not change are neither converted nor written
+    if digests is None:
+        digests = item_store.load_ed_digests()
+    allocated_change_seq = None
+    if change_seq is None:
+        change_seq = allocated_change_seq = item_store.next_change_seq()
+
+    start = time.time()
+    convert_time, write_time = counter.stage_time('convert'), counter.write_time()
+    try:
+        with HistoryWriter(item_store, change_seq, batch_size, counter) as writer:
+            def process_item(item):
+                # only items accepted by category_filter get here
+                counter.item_selected()
+                upsert = timed_changed_item_upsert(item, digests, counter, change_seq, store_raw)
+                if upsert is not None:
+                    writer.add(upsert)
+
+            total = counter.total
+            process_catalog(input_xml, process_item, parser_engine,
+                            item_filter=category_filter, item_visited=counter.item_visited)
+    finally:
+        if allocated_change_seq is not None:
+            item_store.commit_change_seq(allocated_change_seq)
+    # parsing is interleaved with the conversion and writes, it takes the rest
+    parse_time = (time.time() - start) - (counter.stage_time('convert') - convert_time) - \
+        (counter.write_time() - write_time)
+    counter.stage_timed('parse', parse_time, counter.total - total)
     counter.finished()
 
 
+def timed_changed_item_upsert(ed_item, digests, counter, change_seq=None, store_raw=False):
+    start = time.time()
+    upsert = changed_item_upsert(ed_item, digests, counter, change_seq, store_raw)
+    counter.stage_timed('convert', time.time() - start, 1)
+    return upsert
+
+
 def convert_item(item):
     """Converts an item from ED format to Shoptet format"""
 
@@ -165,6 +439,88 @@ def convert_item(item):
     return out_item
 
 
+# the same conversion as convert_item() for a batch of items, faster
+
+STOCK_AMOUNT_PATTERN = re.compile(r'([0-9]+)[,+-].*')
+EAN13_WEIGHTS = (1, 3) * 6
+CENTS = Decimal('.01')
+AVAILABILITY_ON_STOCK = 'Skladem u dodavatele'
+AVAILABILITY_NOT_ON_STOCK = 'Není skladem'
+
+
+def convert_items(items):
+    """
+    Converts a list of items from ED format to Shoptet format. The result
+    is the same as of convert_item() for each item (`benchmark.py convert`
+    checks it on generated items).
+    """
+    return [fast_convert_item(item) for item in items]
+
+
+def fast_convert_item(item):
+    """
+    convert_item() with precompiled patterns and the VAT multipliers,
+    stock amounts and EAN codes cached (they repeat among the items and
+    the syncs).
+    """
+    vat_percent, vat_multiplier = vat_rate(item['Vat'])
+    price_with_vat = str((Decimal(item['EndUserPrice']) * vat_multiplier).quantize(CENTS, rounding=ROUND_HALF_UP))
+    status = item['Status']
+    return OrderedDict([
+        ('NAME', item['Name']),
+        ('DESCRIPTION', item['Description'] or item['Name']),
+        ('MANUFACTURER', item['ProducerName']),
+        ('WARRANTY', item['Warranty']),
+        ('ITEM_TYPE', 'product'),
+        ('UNIT', 'ks'),
+        ('IMAGES', OrderedDict([('IMAGE', item['ImageUrl'])])),
+        ('FLAGS', OrderedDict([
+            ('ACTION', '1' if status == 'Doprodej' else '0'),
+            ('NEW', '1' if status == 'Novinka' else '0'),
+            ('TIP', '1' if status == 'TOP Produkt' else '0'),
+        ])),
+        ('CODE', item['Code']),
+        ('PRICE', item['EndUserPrice']),
+        ('STANDARD_PRICE', price_with_vat),
+        ('PURCHASE_PRICE',
+         str((Decimal(item['YourPriceWithFees']) * vat_multiplier).quantize(CENTS, rounding=ROUND_HALF_UP))),
+        ('PRICE_VAT', price_with_vat),
+        ('VAT', vat_percent),
+        ('EAN', normalize_ean(item['EANCode'])),
+        ('CURRENCY', 'CZK'),
+        ('STOCK', OrderedDict([
+            ('AMOUNT', stock_amount(item['OnStockText'])),
+            ('MINIMAL_AMOUNT', '0'),
+        ])),
+        ('AVAILABILITY_IN_STOCK', AVAILABILITY_ON_STOCK if item['OnStock'] == 'true' else AVAILABILITY_NOT_ON_STOCK)
+    ])
+
+
+@lru_cache(maxsize=None)
+def vat_rate(vat):
+    """Returns the VAT percent (text) and the price multiplier of an ED VAT rate."""
+    vat_percent = Decimal(vat).quantize(Decimal('1'), rounding=ROUND_HALF_UP)
+    return str(vat_percent), Decimal('1') + Decimal('0.01') * vat_percent
+
+
+@lru_cache(maxsize=1024)
+def stock_amount(on_stock_text):
+    """Integer stock amount of the ED stock text (see convert_item())."""
+    return STOCK_AMOUNT_PATTERN.sub('\\1', on_stock_text)
+
+
+@lru_cache(maxsize=64 * 1024)
+def normalize_ean(ean_code):
+    """EAN-13 of the ED EAN code (see convert_item())."""
+    if not ean_code or len(ean_code) > 14:
+        return 13 * '0'
+    elif len(ean_code) == 14:
+        code = ean_code[1:-1]
+        s = sum(int(c) * w for (c, w) in zip(code, EAN13_WEIGHTS))
+        return code + str((10 - s) % 10)
+    return ean_code
+
+
 def round_price(price):
     """Round price to 2 decimal places"""
     return price.quantize(Decimal('.01'), rounding=ROUND_HALF_UP)
@@ -196,33 +552,340 @@ def ean14_to_ean_13(code):
     return ean13_checksum(code[1:-1])
 
 
-def download_ed_catalog_to_mongo(mongo_uri, catalog_url, counter):
-    mongo = MongoClient(mongo_uri)
-    db = mongo.get_default_database()
-    item_collection = db.items
-    item_collection.create_index('code')
+def download_ed_catalog_to_mongo(store_uri, catalog_url, counter, batch_size=1000, parser_engine='xmltodict',
+                                 category_filter=DEFAULT_CATEGORY_FILTER, cache=None, is_cancelled=None,
+                                 queue_size=1000, profile_path=None, store_raw=False):
+    """
+    Downloads the ED catalog and loads the selected items to the store
+    (MongoDB or SQLite, see store.get_item_store()).
+
+    Downloading, XML parsing, conversion and database writes run as a
+    pipeline of threads connected by bounded queues, so the time spent
+    on the network and in the database overlaps with the CPU time.
+    A ZIP archive is decompressed as it is being downloaded. The stats of
+    the stages are reported in counter.pipeline_stats.
+
+    With a DownloadCache the catalog is downloaded to the cache first and
+    the pipeline reads it from there, so the ingest is skipped completely
+    if the server responds it has not been modified or the catalog
+    downloaded again is identical to the one ingested last time. The
+    catalog is committed to the cache only once ingested successfully, so
+    a failed ingest is repeated next time. Returns False if the ingest was
+    skipped. Raises PipelineCancelled once is_cancelled() returns True.
+
+    profile_path - optional path where the cProfile stats of all the stages
+        are dumped (eg. for snakeviz or pstats)
+    store_raw - store also the whole raw ED items compressed
+    """
+    item_store = store.get_item_store(store_uri)
+    # items whose digest did not change are neither converted nor written
+    digests = item_store.load_ed_digests()
+    download = None
+    if cache is not None:
+        # an empty store is always loaded, eg. after it has been wiped
+        download = cache.fetch(catalog_url, counter, key=ingest_key(store_uri, category_filter), force=not digests)
+        if not download.changed:
+            print('ED catalog has not changed (%s), the ingest was skipped' % download.status)
+            counter.finished()
+            return False
+
+    pipeline = Pipeline(is_cancelled, profile=profile_path is not None)
+    # 64 KiB chunks
+    chunks = pipeline.queue('download', 64)
+    items = pipeline.queue('parse', queue_size)
+    upserts = pipeline.queue('convert', max(queue_size, batch_size))
+
+    def read(stage):
+        if download is None:
+            spool_response(catalog_url, QueueWriter(stage, chunks), counter)
+        else:
+            with open(download.path, 'rb') as catalog_file:
+                shutil.copyfileobj(catalog_file, QueueWriter(stage, chunks), 64 * 1024)
+
+    def parse(stage):
+        downloaded = QueueReader(stage, chunks)
+        head = downloaded.peek(len(LOCAL_FILE_HEADER_SIGNATURE))
+        catalog_xml = ZipStreamReader(downloaded) if head == LOCAL_FILE_HEADER_SIGNATURE else downloaded
+        process_catalog(catalog_xml, lambda item: stage.put(items, item), parser_engine,
+                        item_filter=category_filter, item_visited=counter.item_visited)
+        # only the first ZIP member is read, the download must not block
+        # on the full queue with the rest
+        downloaded.drain()
+
+    def convert(stage):
+        while True:
+            item = stage.get(items)
+            if item is END:
+                return
+            counter.item_selected()
+            upsert = timed_changed_item_upsert(item, digests, counter, change_seq, store_raw)
+            if upsert is not None:
+                stage.put(upserts, upsert)
+
+    def write(stage):
+        with HistoryWriter(item_store, change_seq, batch_size, counter) as writer:
+            while True:
+                upsert = stage.get(upserts)
+                if upsert is END:
+                    return
+                writer.add(upsert)
+
+    pipeline.add_stage('download', read, chunks)
+    pipeline.add_stage('parse', parse, items)
+    pipeline.add_stage('convert', convert, upserts)
+    pipeline.add_stage('write', write)
+
+    def update_stats(pipeline):
+        counter.pipeline_stats = pipeline.stats()
+
+    change_seq = item_store.next_change_seq()
+    try:
+        pipeline.run(on_poll=update_stats)
+    finally:
+        item_store.commit_change_seq(change_seq)
+        if profile_path is not None:
+            pipeline.profile_stats().dump_stats(profile_path)
+            print('profile of the pipeline stages saved to', profile_path)
+    update_stats(pipeline)
+    counter.stage_timed('parse', pipeline.stage('parse').busy_time(), counter.total)
+    counter.finished()
+    if download is not None:
+        cache.commit(download)
+    return True
+
+
+def ingest_key(store_uri, category_filter):
+    """
+    Key of the ingests of the cached catalog, a catalog ingested into
+    one store or with one category filter is not skipped for another.
+    """
+    return hashlib.sha1(('%s %r' % (store_uri, category_filter)).encode('utf-8')).hexdigest()
+
+
+@contextmanager
+def fetch_ed_catalog(catalog_url, counter, cache=None, key='', force=False):
+    """
+    Provides a local seekable file with the downloaded catalog (XML or ZIP)
+    which is valid until the end of the with block. Without a DownloadCache
+    the catalog is spooled to a temporary file. With the cache None is
+    provided if the catalog has not changed since it was committed under
+    the key (see ingest_key()), it is committed once the with block
+    finishes without an error.
+    """
+    if cache is None:
+        with tempfile.TemporaryFile() as catalog_file:
+            spool_response(catalog_url, catalog_file, counter)
+            catalog_file.seek(0)
+            yield catalog_file
+        return
+
+    download = cache.fetch(catalog_url, counter, key=key, force=force)
+    if not download.changed:
+        print('ED catalog has not changed (%s), skipping the ingest' % download.status)
+        yield None
+        return
+    with open(download.path, 'rb') as catalog_file:
+        yield catalog_file
+    cache.commit(download)
 
-    catalog_xml = download_ed_catalog(catalog_url)
-    load_catalog_to_mongo(catalog_xml, item_collection, counter)
+
+# upper bounds of the buckets of the write latency histogram (in seconds)
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
 
 
 class Counter(object):
-    def __init__(self, report=None, report_period=1000):
+    """
+    Statistics of an ingest: the items, the download, the time spent
+    in each stage, the database writes and the memory.
+    """
+    # statistics which can be summed over parallel shards
+    SHARD_FIELDS = ('total', 'selected', 'unchanged', 'updated', 'inserted', 'batches', 'written', 'changed',
+                    'write_errors')
+
+    def __init__(self, report=None, report_period=1000, report_interval=None):
+        """
+        report - function called with the counter every report_period
+            visited items and once finished
+        report_interval - minimum number of seconds between two reports
+            (except the final one), None for no limit
+        """
+        self.start_time = time.time()
         self.total = 0
         self.selected = 0
+        # selected items by the change against the stored version
+        self.unchanged = 0
+        self.updated = 0
+        self.inserted = 0
+        # statistics of the catalog download
+        self.bytes_downloaded = 0
+        self.download_time = 0.0
+        self.download_cache_status = None
+        # CPU stages: name -> {'time': seconds, 'items': count}
+        self.stage_times = OrderedDict()
+        # stats of the stages when ingested as a pipeline
+        self.pipeline_stats = None
+        # statistics of batches flushed to the database
+        self.batches = 0
+        self.written = 0
+        # documents actually inserted or modified by the batches
+        self.changed = 0
+        self.batch_latencies = []
+        self.write_errors = 0
         self.report_period = report_period
+        self.report_interval = report_interval
+        self.last_report_time = None
         self.report = report
 
     def item_visited(self):
         self.total += 1
         if self.report and self.total % self.report_period == 0:
-            self.report(self)
+            now = time.time()
+            if self.report_interval is None or self.last_report_time is None or \
+                    now - self.last_report_time >= self.report_interval:
+                self.last_report_time = now
+                self.report(self)
 
     def item_selected(self):
         self.selected += 1
 
+    def item_unchanged(self):
+        self.unchanged += 1
+
+    def item_updated(self):
+        self.updated += 1
+
+    def item_inserted(self):
+        self.inserted += 1
+
+    def stage_timed(self, name, elapsed, items=0):
+        """Adds the time spent in a stage and the number of items it processed."""
+        stage = self.stage_times.setdefault(name, {'time': 0.0, 'items': 0})
+        stage['time'] += elapsed
+        stage['items'] += items
+
+    def stage_time(self, name):
+        return self.stage_times[name]['time'] if name in self.stage_times else 0.0
+
+    def shard_state(self):
+        """
+        Returns the item and batch statistics to be merged with other
+        counters, eg. from parallel processes.
+        """
+        state = dict((name, getattr(self, name)) for name in self.SHARD_FIELDS)
+        state['batch_latencies'] = list(self.batch_latencies)
+        state['stage_times'] = dict((name, dict(stage)) for (name, stage) in self.stage_times.items())
+        return state
+
+    def merge_shard_states(self, states):
+        """
+        Sets the item and batch statistics to the sum of given shard states.
+        The stage times are summed too, so they are the CPU time of all shards.
+        """
+        for name in self.SHARD_FIELDS:
+            setattr(self, name, sum(state[name] for state in states))
+        self.batch_latencies = [latency for state in states for latency in state['batch_latencies']]
+        self.stage_times = OrderedDict()
+        for state in states:
+            for (name, stage) in state['stage_times'].items():
+                self.stage_timed(name, stage['time'], stage['items'])
+
+    def download_finished(self, size, elapsed, cache_status=None):
+        self.bytes_downloaded += size
+        self.download_time += elapsed
+        self.download_cache_status = cache_status
+
+    def download_throughput(self):
+        """Returns the download throughput in bytes/sec."""
+        if self.download_time <= 0:
+            return 0.0
+        return self.bytes_downloaded / self.download_time
+
+    def batch_flushed(self, size, latency, write_errors=0, changed=0):
+        self.batches += 1
+        self.written += size
+        self.changed += changed
+        self.batch_latencies.append(latency)
+        self.write_errors += write_errors
+
+    def write_time(self):
+        return sum(self.batch_latencies)
+
+    def mean_batch_latency(self):
+        if not self.batch_latencies:
+            return 0.0
+        return sum(self.batch_latencies) / len(self.batch_latencies)
+
+    def latency_histogram(self):
+        """Returns the number of batches in each latency bucket."""
+        labels = ['<= %g s' % bound for bound in LATENCY_BUCKETS] + ['> %g s' % LATENCY_BUCKETS[-1]]
+        counts = [0] * len(labels)
+        for latency in self.batch_latencies:
+            index = 0
+            while index < len(LATENCY_BUCKETS) and latency > LATENCY_BUCKETS[index]:
+                index += 1
+            counts[index] += 1
+        return OrderedDict(zip(labels, counts))
+
+    def stage_stats(self):
+        """
+        Returns the wall time and throughput of each stage. Downloading is
+        measured in bytes, the writes are the round trips of the batches.
+        """
+        stats = OrderedDict()
+        stats['download'] = _stage_stats(self.download_time, self.bytes_downloaded, 'bytes')
+        for (name, stage) in sorted(self.stage_times.items(), key=lambda item: item[0] != 'parse'):
+            stats[name] = _stage_stats(stage['time'], stage['items'])
+        stats['write'] = _stage_stats(self.write_time(), self.written)
+        return stats
+
+    def metrics(self):
+        """All the statistics as a structure of plain values, eg. for the job meta."""
+        metrics = OrderedDict([
+            ('elapsed_time', time.time() - self.start_time),
+            ('items', OrderedDict([
+                ('total', self.total),
+                ('selected', self.selected),
+                ('unchanged', self.unchanged),
+                ('updated', self.updated),
+                ('inserted', self.inserted)])),
+            ('download', OrderedDict([
+                ('bytes', self.bytes_downloaded),
+                ('time', self.download_time),
+                ('bytes_per_sec', self.download_throughput()),
+                ('cache_status', self.download_cache_status)])),
+            ('stages', self.stage_stats()),
+            ('writes', OrderedDict([
+                ('batches', self.batches),
+                ('items', self.written),
+                ('changed', self.changed),
+                ('errors', self.write_errors),
+                ('mean_latency', self.mean_batch_latency()),
+                ('latency_histogram', self.latency_histogram())])),
+            ('peak_memory', peak_memory()),
+        ])
+        if self.pipeline_stats is not None:
+            metrics['pipeline'] = self.pipeline_stats
+        return metrics
+
     def finished(self):
-        self.report(self)
+        if self.report:
+            self.report(self)
+
+
+def _stage_stats(elapsed, items, unit='items'):
+    return OrderedDict([
+        ('wall_time', elapsed),
+        (unit, items),
+        ('%s_per_sec' % unit, items / elapsed if elapsed > 0 else None)])
+
+
+def peak_memory():
+    """
+    Peak resident set size in bytes of this process or any of its finished
+    child processes (eg. parallel ingest workers). Linux reports KiB.
+    """
+    return 1024 * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
 
 
 if __name__ == '__main__':
@@ -232,10 +895,11 @@ if __name__ == '__main__':
         catalog_url = 'http://localhost:5000/static/priceList_1055541_UTF8_63e3bbe9-ab87-49bf-a221-b20590b106de.zip'
         return catalog_url
 
-    mongo_uri = os.environ.get('MONGO_URI')  # localhost if not defined
-
     def counter_report(counter):
-        print('total:', counter.total, ', selected:', counter.selected)
+        print('total:', counter.total, ', selected:', counter.selected,
+              ', unchanged:', counter.unchanged, ', updated:', counter.updated,
+              ', inserted:', counter.inserted, ', batches:', counter.batches)
 
     counter = Counter(report=counter_report, report_period=1000)
-    download_ed_catalog_to_mongo(mongo_uri, ed_catalog_url(), counter)
+    download_ed_catalog_to_mongo(store.store_uri, ed_catalog_url(), counter)
+    store.close()
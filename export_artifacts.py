@@ -0,0 +1,127 @@
+"""
+Precomputed exports of the Shoptet import XML.
+
+The export is built by a worker once the data has changed instead of on
+each download. The data version is a number in MongoDB incremented by each
+ingest which changed some documents. Each artifact is stored in plain and
+gzipped form along with a JSON metadata file, keyed by the data version.
+Only the newest few artifacts are kept.
+
+The metadata also records the committed change sequence (see catalog_meta)
+when the export started, a client can then fetch just the delta of the products changed
+since then.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import time
+
+from export_catalog import export_catalog_file
+from xml_validation import ItemValidator
+
+ARTIFACT_NAME_PATTERN = re.compile(r'^shoptet_catalog_v(\d+)\.json$')
+
+
+class ExportArtifacts(object):
+    """
+    artifact_dir - directory where the artifacts are stored
+    keep - number of the newest artifacts which are kept
+    """
+
+    def __init__(self, artifact_dir, keep=5):
+        self.artifact_dir = artifact_dir
+        self.keep = keep
+
+    def file_name(self, version, extension='xml'):
+        return 'shoptet_catalog_v%d.%s' % (version, extension)
+
+    def path(self, version, extension='xml'):
+        return os.path.join(self.artifact_dir, self.file_name(version, extension))
+
+    def versions(self):
+        """Versions of the complete artifacts, the newest first."""
+        if not os.path.isdir(self.artifact_dir):
+            return []
+        matches = (ARTIFACT_NAME_PATTERN.match(name) for name in os.listdir(self.artifact_dir))
+        return sorted((int(match.group(1)) for match in matches if match), reverse=True)
+
+    def get(self, version):
+        """Returns the metadata of the artifact or None if not built."""
+        meta_path = self.path(version, 'json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as meta_file:
+            return json.load(meta_file)
+
+    def latest(self):
+        versions = self.versions()
+        return self.get(versions[0]) if versions else None
+
+    def build(self, version, item_store, change_seq=None, compress_level=6, validate=False):
+        """
+        Exports the catalog as the artifact of the given data version.
+        change_seq - the change sequence read before the export started
+        validate - validate each product by the RelaxNG schema as it is
+            exported, the invalid ones are listed in the metadata
+        The metadata file is written last, so an artifact is visible only
+        once complete. Returns its metadata.
+        """
+        os.makedirs(self.artifact_dir, exist_ok=True)
+        start = time.time()
+        validator = ItemValidator() if validate else None
+        xml_path, item_count = export_catalog_file(item_store, self.artifact_dir, self.file_name(version),
+                                                   validator)
+        gzip_path = self.path(version, 'xml.gz')
+        digest = hashlib.sha1()
+        with open(xml_path, 'rb') as xml_file, \
+                gzip.open(gzip_path + '.tmp', 'wb', compresslevel=compress_level) as gzip_file:
+            while True:
+                chunk = xml_file.read(1024 * 1024)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                gzip_file.write(chunk)
+        os.replace(gzip_path + '.tmp', gzip_path)
+
+        meta = {
+            'version': version,
+            'change_seq': change_seq,
+            'items': item_count,
+            'digest': digest.hexdigest(),
+            'file_name': self.file_name(version),
+            'size': os.path.getsize(xml_path),
+            'gzip_file_name': self.file_name(version, 'xml.gz'),
+            'gzip_size': os.path.getsize(gzip_path),
+            'built_at': time.time(),
+            'build_time': time.time() - start,
+        }
+        if validator is not None:
+            meta['validation'] = validator.stats()
+        meta_path = self.path(version, 'json')
+        with open(meta_path + '.tmp', 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(meta_path + '.tmp', meta_path)
+        print('export artifact v%d: %d items, %d bytes (%d gzipped) in %.3f sec' % (
+            version, meta['items'], meta['size'], meta['gzip_size'], meta['build_time']))
+        if validator is not None:
+            print('export artifact v%d: %d invalid products, validated in %.3f sec' % (
+                version, validator.invalid, validator.validation_time))
+        return meta
+
+    def prune(self):
+        """Removes all but the newest artifacts."""
+        for version in self.versions()[self.keep:]:
+            print('export artifact v%d: removing' % version)
+            # the metadata first, so that an incomplete artifact is never served
+            for extension in ('json', 'xml', 'xml.gz'):
+                path = self.path(version, extension)
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def etag(meta, gzipped=False):
+    """Strong ETag of the artifact, different for the gzipped variant."""
+    return 'v%d-%s%s' % (meta['version'], meta['digest'][:16], '-gz' if gzipped else '')
@@ -1,32 +1,92 @@
 """
-Export catalog from MongoDB to XML that can be imported to Shoptet.
+Export catalog from the store (MongoDB or SQLite) to XML that can be imported to Shoptet.
 """
 
 import argparse
 import os
 from collections import OrderedDict
 
-import pymongo
 import xmltodict
-from pymongo import MongoClient
 
+import store
+from xml_validation import ItemValidator
 
-def export_catalog_from_mongo(item_collection, output_xml=None):
+
+# beginning and end of the document exactly as xmltodict.unparse() emits them
+XML_HEADER = '<?xml version="1.0" encoding="utf-8"?>\n<SHOP>\n'
+XML_FOOTER = '</SHOP>'
+
+
+def find_export_items(item_store, batch_size=1000, since=None):
+    """
+    Returns an iterator over the items to be exported sorted by code.
+    since - only the items changed after this change sequence (a delta export)
+    """
+    return item_store.export_scan(since, batch_size)
+
+
+def export_catalog_from_mongo(item_store, output_xml=None, since=None, validator=None):
     """
     Exports items from ED that have been converted to Shoptet
     into and XML file.
-    item_collection - MongoDB collection containing items
+    item_store - item_store.ItemStore containing items
     output_xml - file-like where the XML will be written
+    since - export only the items changed after this change sequence
+    validator - optional xml_validation.ItemValidator of the SHOPITEMs
+    """
+    items = find_export_items(item_store, since=since)
+    return export_catalog(items, output_xml, validator)
+
+
+def export_catalog(items, output_file, validator=None):
+    """
+    Writes the catalog XML to output_file or returns it as a string
+    if output_file is None.
+    """
+    chunks = iter_catalog_xml(items, validator=validator)
+    if output_file is None:
+        return ''.join(chunks)
+    for chunk in chunks:
+        output_file.write(chunk)
+
+
+def iter_catalog_xml(items, chunk_size=64 * 1024, validator=None):
     """
-    items = item_collection.find({'shoptet_from_ed': {'$ne': None}}) \
-        .sort('code', pymongo.ASCENDING)
-    return export_catalog(items, output_xml)
+    Generates the catalog XML incrementally - the header, the SHOPITEM
+    elements and the footer - in chunks of roughly chunk_size characters.
 
+    The concatenated output is identical to unparsing the whole catalog
+    at once via xmltodict.unparse(..., pretty=True).
 
-def export_catalog(items, output_file):
-    shop_items = [convert_item(item) for item in items]
-    catalog_dict = OrderedDict([('SHOP', OrderedDict([('SHOPITEM', shop_items)]))])
-    return xmltodict.unparse(catalog_dict, output=output_file, pretty=True)
+    validator - optional xml_validation.ItemValidator which validates
+        each SHOPITEM as it is generated
+    """
+    buffer = [XML_HEADER]
+    buffer_length = len(XML_HEADER)
+    for item in items:
+        shop_item = shop_item_xml(item, validator)
+        buffer.append(shop_item)
+        buffer_length += len(shop_item)
+        if buffer_length >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            buffer_length = 0
+    buffer.append(XML_FOOTER)
+    yield ''.join(buffer)
+
+
+def shop_item_xml(item, validator=None):
+    """
+    The SHOPITEM element of a stored item as it appears in the catalog XML
+    (between XML_HEADER and XML_FOOTER).
+    """
+    shop_item_dict = convert_item(item)
+    shop_item = xmltodict.unparse(
+        OrderedDict([('SHOPITEM', shop_item_dict)]),
+        full_document=False, pretty=True, depth=1)
+    if validator is not None:
+        validator.validate_xml(shop_item_dict['CODE'], shop_item)
+    return shop_item
 
 
 def convert_item(item):
@@ -81,26 +141,61 @@ def convert_item(item):
 
 
 def export_catalog_xml():
-    mongo_uri = os.environ.get('MONGO_URI')
-    mongo = MongoClient(mongo_uri)
-    db = mongo.get_default_database()
-    item_collection = db.items
-    return export_catalog_from_mongo(item_collection)
+    return ''.join(iter_export_catalog_xml())
+
+
+def iter_export_catalog_xml(since=None):
+    """
+    Generates the catalog XML from the default database in chunks.
+    since - only the items changed after this change sequence
+    """
+    for chunk in iter_catalog_xml(find_export_items(store.get_item_store(), since=since)):
+        yield chunk
+
+
+def export_catalog_file(item_store, output_dir, file_name, validator=None):
+    """
+    Exports the catalog to a file in output_dir. It is written under
+    a temporary name and renamed once complete, so that a partially
+    written file is never visible. Returns the path and the number of items.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, file_name)
+    tmp_path = path + '.tmp'
+    item_count = [0]
+
+    def counted(items):
+        for item in items:
+            item_count[0] += 1
+            yield item
+
+    with open(tmp_path, 'w', encoding='utf-8') as output_file:
+        export_catalog(counted(find_export_items(item_store)), output_file, validator)
+    os.replace(tmp_path, path)
+    return path, item_count[0]
 
 
 def parse_args():
     parser = argparse.ArgumentParser(
-        description='Export merged catalog from MongoDB to Shoptet XML.')
+        description='Export merged catalog from the store to Shoptet XML.')
     parser.add_argument('output', help='Path to catalog in Shoptet XML format')
+    parser.add_argument('--store-uri', help='MongoDB or sqlite:// URI, STORE_URI by default')
+    parser.add_argument('--since', type=int,
+                        help='Export only products changed after this change sequence')
+    parser.add_argument('--validate', action='store_true',
+                        help='Validate each product by the RelaxNG schema and report the invalid ones')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     args = parse_args()
 
-    mongo = MongoClient()
-    db = mongo.s3dt_catalog
-    item_collection = db.items
-
-    with open(args.output, 'w') as output_xml_file:
-        export_catalog_from_mongo(item_collection, output_xml_file)
+    validator = ItemValidator() if args.validate else None
+    with open(args.output, 'w', encoding='utf-8') as output_xml_file:
+        export_catalog_from_mongo(store.get_item_store(args.store_uri), output_xml_file, args.since, validator)
+    if validator is not None:
+        print('valid products: %d, invalid products: %d, validated in %.3f sec' % (
+            validator.valid, validator.invalid, validator.validation_time))
+        for (code, message) in validator.errors:
+            print('%s: %s' % (code, message))
+    store.close()
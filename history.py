@@ -0,0 +1,98 @@
+"""
+History of the products from ED.
+
+An ED ingest overwrites the converted product, so before each batch is
+written its previous version is diffed against the new one and a compact
+change record is appended for each changed field along with the batch
+(only for the products actually written):
+
+    {'run': 12, 'code': '123456', 'field': 'PURCHASE_PRICE', 'old': '100.00', 'new': '110.00'}
+
+A new product gets a single record with the NEW field (and its name as
+the new value). The run is the change sequence allocated by the ingest.
+Unchanged products are skipped by their digest before being converted,
+so they cost nothing.
+
+The records are indexed by (run, field, code) for the report of a run
+and by (code, run) for the history of a product, so neither needs
+a collection scan regardless of the number of runs kept.
+"""
+
+import time
+from collections import OrderedDict
+
+from item_store import ItemWriter
+
+# field of the record of a new product
+NEW_ITEM_FIELD = 'NEW'
+
+# converted fields whose changes are recorded, nested ones are dotted
+HISTORY_FIELDS = ('NAME', 'PRICE', 'STANDARD_PRICE', 'PURCHASE_PRICE', 'PRICE_VAT', 'VAT',
+                  'STOCK.AMOUNT', 'AVAILABILITY_IN_STOCK')
+
+# sections of the change report
+REPORT_FIELDS = (NEW_ITEM_FIELD,) + HISTORY_FIELDS
+
+
+def get_field(item, field):
+    """Value of a (dotted) field or None if missing."""
+    for name in field.split('.'):
+        if not isinstance(item, dict):
+            return None
+        item = item.get(name)
+    return item
+
+
+def item_changes(run, code, old_item, new_item):
+    """
+    Change records of a converted item against its previous version
+    (None for a new item).
+    """
+    if old_item is None:
+        return [change_record(run, code, NEW_ITEM_FIELD, None, new_item.get('NAME'))]
+    changes = []
+    for field in HISTORY_FIELDS:
+        old_value, new_value = get_field(old_item, field), get_field(new_item, field)
+        if old_value != new_value:
+            changes.append(change_record(run, code, field, old_value, new_value))
+    return changes
+
+
+def change_record(run, code, field, old_value, new_value):
+    return OrderedDict([('run', run), ('code', code), ('field', field), ('old', old_value), ('new', new_value)])
+
+
+class HistoryWriter(ItemWriter):
+    """
+    ItemWriter of the ED upserts which records the changes of the
+    converted items along with each batch which overwrites them.
+
+    run - the change sequence of the ingest
+    """
+
+    def __init__(self, item_store, run, batch_size=1000, counter=None):
+        super(HistoryWriter, self).__init__(item_store, batch_size, counter)
+        self.run = run
+        self.change_count = 0
+
+    def write_batch(self, upserts):
+        start = time.time()
+        changes = self.batch_changes(upserts)
+        if self.counter is not None:
+            # a part of the batch write latency
+            self.counter.stage_timed('history', time.time() - start, len(upserts))
+        self.change_count += len(changes)
+        return self.item_store.upsert_batch(upserts, changes)
+
+    def batch_changes(self, upserts):
+        # a single lookup of the previous versions for the whole batch
+        stored_items = self.item_store.get_by_codes([code for (code, _) in upserts], ['shoptet_from_ed'])
+        old_items = {item['code']: item.get('shoptet_from_ed') for item in stored_items}
+        changes = []
+        for (code, fields) in upserts:
+            new_item = fields.get('shoptet_from_ed')
+            if new_item is not None:
+                changes.extend(item_changes(self.run, code, old_items.get(code), new_item))
+                # a code repeated within the batch is diffed against its last version
+                old_items[code] = new_item
+        return changes
@@ -0,0 +1,765 @@
+"""
+Storage of the merged ED and Shoptet products.
+
+The ingests and the export access the products only via an ItemStore,
+so that they can run either on MongoDB or on an embedded SQLite database
+(eg. locally or in a small deployment without a mongod).
+
+An item is a document identified by its code whose top-level fields are
+set by upserts - the ED ingest sets `ed`, `shoptet_from_ed` and the digests,
+the Shoptet ingest sets `shoptet`. The store also keeps the counters of
+the data version and the change sequence (see catalog_meta) and the
+change records of the products (see history).
+
+The browse matches the prefixes of the words of the name and the code on
+both backends. The words are split by search_words() without diacritics
+and case, MongoDB stores them in the indexed `search_words` array and
+matches each prefix by an anchored regex (an index range scan), SQLite
+keeps them in a FTS5 index queried by prefixes.
+
+Check that a store behaves as expected (its data is dropped!):
+
+    python item_store.py check sqlite:///tmp/s3dt_check.db
+    python item_store.py check mongodb://localhost/s3dt_check
+"""
+
+import argparse
+import base64
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import pymongo
+from pymongo import UpdateOne
+
+from bulk_writer import BulkWriter, print_write_errors
+from catalog_meta import CHANGE_SEQ_ID, DATA_VERSION_ID, PENDING_TIMEOUT, bump_data_version, commit_change_seq, \
+    get_change_seq, get_committed_change_seq, get_data_version, next_change_seq
+
+# only the fields needed by export_catalog.convert_item()
+EXPORTED_FIELDS = ('NAME', 'DESCRIPTION', 'MANUFACTURER', 'WARRANTY', 'ITEM_TYPE', 'UNIT', 'IMAGES', 'FLAGS',
+                   'CODE', 'PRICE', 'STANDARD_PRICE', 'PURCHASE_PRICE', 'PRICE_VAT', 'VAT', 'EAN', 'CURRENCY',
+                   'STOCK', 'AVAILABILITY_IN_STOCK')
+EXPORT_PROJECTION = dict(
+    [('_id', 0), ('code', 1), ('shoptet.VISIBLE', 1), ('shoptet.AVAILABILITY_IN_STOCK', 1)] +
+    [('shoptet_from_ed.%s' % field, 1) for field in EXPORTED_FIELDS])
+
+# the fields shown by the product browse
+BROWSE_FIELDS = ('code', 'has_export', 'ed.Status', 'ed.OnStock', 'ed.OnStockText',
+                 'shoptet.VISIBLE', 'shoptet.AVAILABILITY_IN_STOCK',
+                 'shoptet_from_ed.NAME', 'shoptet_from_ed.MANUFACTURER', 'shoptet_from_ed.PRICE_VAT',
+                 'shoptet_from_ed.PURCHASE_PRICE', 'shoptet_from_ed.STOCK')
+BROWSE_PROJECTION = dict([('_id', 0)] + [(field, 1) for field in BROWSE_FIELDS])
+
+# letters and digits, the same as the separators of the FTS5 unicode61 tokenizer
+WORD_PATTERN = re.compile(r'[^\W_]+')
+
+
+class ItemStore(object):
+    """
+    Interface of the product storage.
+
+    An upsert is a tuple (code, fields), it sets the top-level fields
+    of the item with the code, which is created if it does not exist.
+    """
+
+    def create_indexes(self):
+        raise NotImplementedError
+
+    def upsert_batch(self, upserts, changes=None):
+        """
+        Applies a batch of upserts. Returns the number of items inserted
+        or actually modified and the number of failed upserts.
+
+        changes - change records of the upserted items (see history.change_record),
+            appended only once the upserts of their codes have been written
+        """
+        raise NotImplementedError
+
+    def get_by_codes(self, codes, fields=None):
+        """
+        Returns the stored items with the given codes.
+        fields - top-level fields to return besides the code, all if None
+        """
+        raise NotImplementedError
+
+    def export_scan(self, since=None, batch_size=1000):
+        """
+        Iterates over the items to be exported sorted by code.
+        since - only the items changed after this change sequence
+        """
+        raise NotImplementedError
+
+    def browse(self, filters, after=None, limit=50):
+        """
+        Returns up to limit items with a code greater than after (keyset
+        pagination) sorted by code. Each filter is backed by an index
+        ending with the code.
+
+        filters - a dict of (all optional):
+            manufacturer - the converted MANUFACTURER
+            status - the ED Status (eg. 'Novinka')
+            stock - 'in' or 'out' of the ED stock
+            visible - the Shoptet visibility (True/False)
+            source - 'ed' (only in ED), 'shoptet' (only in Shoptet) or 'both'
+            text - prefixes of the words of the name or the code
+        """
+        raise NotImplementedError
+
+    def load_ed_digests(self):
+        """
+        Returns a map code -> (digest, export digest) of all the items
+        stored from ED, so that an ingest can skip the unchanged items.
+        """
+        raise NotImplementedError
+
+    def get_data_version(self):
+        raise NotImplementedError
+
+    def bump_data_version(self):
+        """Marks that the data has changed. Returns the new version."""
+        raise NotImplementedError
+
+    def get_change_seq(self):
+        """The last allocated change sequence (0 if none yet)."""
+        raise NotImplementedError
+
+    def next_change_seq(self):
+        """
+        Allocates a new change sequence for an ingest, which must commit it
+        once finished (see commit_change_seq()).
+        """
+        raise NotImplementedError
+
+    def commit_change_seq(self, change_seq):
+        """Marks that the ingest which allocated change_seq has finished (or failed)."""
+        raise NotImplementedError
+
+    def get_committed_change_seq(self):
+        """
+        The last change sequence up to which all the ingests have finished,
+        the cursor of the delta export (see catalog_meta).
+        """
+        raise NotImplementedError
+
+    def add_changes(self, changes):
+        """Appends change records (see history.change_record)."""
+        raise NotImplementedError
+
+    def find_changes(self, run, field=None, limit=None):
+        """Change records of a run (optionally of a single field) sorted by field and code."""
+        raise NotImplementedError
+
+    def count_changes(self, run):
+        """Returns a map field -> number of change records of a run."""
+        raise NotImplementedError
+
+    def find_item_changes(self, code):
+        """Change records of a product sorted by run."""
+        raise NotImplementedError
+
+    def change_runs(self, limit=None):
+        """Runs which have some change records, the latest first."""
+        raise NotImplementedError
+
+    def drop(self):
+        """Removes all the items, counters and change records."""
+        raise NotImplementedError
+
+    def writer(self, batch_size=1000, counter=None):
+        """Returns an ItemWriter which upserts in batches."""
+        return ItemWriter(self, batch_size, counter)
+
+
+class ItemWriter(BulkWriter):
+    """
+    Collects upserts (code, fields) and flushes them to an ItemStore in batches.
+    """
+
+    def __init__(self, item_store, batch_size=1000, counter=None):
+        super(ItemWriter, self).__init__(None, batch_size, counter)
+        self.item_store = item_store
+
+    def write_batch(self, upserts):
+        return self.item_store.upsert_batch(upserts)
+
+
+class MongoItemStore(ItemStore):
+    """
+    Items in the `items` collection of a MongoDB database,
+    the counters in the `meta` collection and the change records
+    in the `changes` collection.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.collection = db.items
+        self.changes = db.changes
+
+    def create_indexes(self):
+        # unique, so that the ingests running in parallel cannot insert
+        # the same new item twice (see BulkWriter.bulk_write())
+        code_index = self.collection.index_information().get('code_1')
+        if code_index is not None and not code_index.get('unique'):
+            print('items: the code index is not unique, run migrate_schema.py to merge the duplicate items')
+        else:
+            self.collection.create_index('code', unique=True)
+        self.collection.create_index('change_seq')
+        # the export scan selects the converted items in the order of this index,
+        # so they are not sorted in memory, but it does not cover the scan
+        # (the whole documents are fetched)
+        self.collection.create_index([('has_export', pymongo.ASCENDING), ('code', pymongo.ASCENDING)])
+        self.changes.create_index([('run', pymongo.ASCENDING), ('field', pymongo.ASCENDING),
+                                   ('code', pymongo.ASCENDING)])
+        self.changes.create_index([('code', pymongo.ASCENDING), ('run', pymongo.ASCENDING)])
+        # the browse filters, each sorted by code
+        for field in ('shoptet_from_ed.MANUFACTURER', 'ed.Status', 'ed.OnStock', 'shoptet.VISIBLE'):
+            self.collection.create_index([(field, pymongo.ASCENDING), ('code', pymongo.ASCENDING)])
+        self.collection.create_index([('has_export', pymongo.ASCENDING), ('shoptet.VISIBLE', pymongo.ASCENDING),
+                                      ('code', pymongo.ASCENDING)])
+        # a prefix of a word is a range of this multikey index
+        self.collection.create_index([('search_words', pymongo.ASCENDING), ('code', pymongo.ASCENDING)])
+
+    def upsert_batch(self, upserts, changes=None):
+        operations = [UpdateOne({'code': code}, item_update(code, fields), upsert=True)
+                      for (code, fields) in upserts]
+        changed_count, write_errors = BulkWriter(self.collection).bulk_write(operations)
+        print_write_errors(write_errors, len(operations))
+        if changes:
+            # there are no transactions, the changes of the failed upserts are left out
+            failed_codes = set(upserts[error['index']][0] for error in write_errors)
+            changes = [change for change in changes if change['code'] not in failed_codes]
+            if changes:
+                self.add_changes(changes)
+        return changed_count, len(write_errors)
+
+    def get_by_codes(self, codes, fields=None):
+        projection = {'_id': 0}
+        if fields is not None:
+            projection.update((field, 1) for field in ('code',) + tuple(fields))
+        return list(self.collection.find({'code': {'$in': list(codes)}}, projection))
+
+    def export_scan(self, since=None, batch_size=1000):
+        # the full export walks the (has_export, code) index and fetches each document
+        query = {'has_export': True}
+        if since is not None:
+            query['change_seq'] = {'$gt': since}
+        return self.collection.find(query, EXPORT_PROJECTION) \
+            .sort('code', pymongo.ASCENDING) \
+            .batch_size(batch_size)
+
+    def browse(self, filters, after=None, limit=50):
+        conditions = []
+        for (name, field) in [('manufacturer', 'shoptet_from_ed.MANUFACTURER'), ('status', 'ed.Status'),
+                              ('visible', 'shoptet.VISIBLE')]:
+            if name in filters:
+                conditions.append({field: filters[name]})
+        if 'stock' in filters:
+            conditions.append({'ed.OnStock': 'true' if filters['stock'] == 'in' else 'false'})
+        source = filters.get('source')
+        if source is not None:
+            # the items from ED have has_export, null also matches a missing field
+            conditions.append({'has_export': None if source == 'shoptet' else True})
+            conditions.append({'shoptet.VISIBLE': None if source == 'ed' else {'$in': [True, False]}})
+        for word in search_words(filters.get('text')):
+            # the words are letters and digits, there is nothing to escape
+            conditions.append({'search_words': {'$regex': '^' + word}})
+        if after is not None:
+            conditions.append({'code': {'$gt': after}})
+        query = {'$and': conditions} if conditions else {}
+        return list(self.collection.find(query, BROWSE_PROJECTION).sort('code', pymongo.ASCENDING).limit(limit))
+
+    def load_ed_digests(self):
+        # items stored before the digests or the compact schema were
+        # introduced map to a None digest, so that they are rewritten
+        cursor = self.collection.find(
+            {'ed': {'$exists': True}},
+            {'_id': 0, 'code': 1, 'ed_digest': 1, 'export_digest': 1, 'has_export': 1})
+        return {doc['code']: (doc.get('ed_digest') if doc.get('has_export') else None, doc.get('export_digest'))
+                for doc in cursor}
+
+    def get_data_version(self):
+        return get_data_version(self.db)
+
+    def bump_data_version(self):
+        return bump_data_version(self.db)
+
+    def get_change_seq(self):
+        return get_change_seq(self.db)
+
+    def next_change_seq(self):
+        return next_change_seq(self.db)
+
+    def commit_change_seq(self, change_seq):
+        commit_change_seq(self.db, change_seq)
+
+    def get_committed_change_seq(self):
+        return get_committed_change_seq(self.db)
+
+    def add_changes(self, changes):
+        # copies, insert_many() would add the _id to the records
+        self.changes.insert_many([dict(change) for change in changes], ordered=False)
+
+    def find_changes(self, run, field=None, limit=None):
+        query = {'run': run}
+        if field is not None:
+            query['field'] = field
+        cursor = self.changes.find(query, {'_id': 0}) \
+            .sort([('field', pymongo.ASCENDING), ('code', pymongo.ASCENDING)])
+        return list(cursor.limit(limit) if limit else cursor)
+
+    def count_changes(self, run):
+        result = self.changes.aggregate([
+            {'$match': {'run': run}},
+            {'$group': {'_id': '$field', 'count': {'$sum': 1}}}])
+        return {doc['_id']: doc['count'] for doc in result}
+
+    def find_item_changes(self, code):
+        return list(self.changes.find({'code': code}, {'_id': 0}).sort('run', pymongo.ASCENDING))
+
+    def change_runs(self, limit=None):
+        runs = sorted(self.changes.distinct('run'), reverse=True)
+        return runs[:limit] if limit else runs
+
+    def drop(self):
+        self.collection.drop()
+        self.changes.drop()
+        self.db.meta.delete_many({'_id': {'$in': [DATA_VERSION_ID, CHANGE_SEQ_ID]}})
+
+
+class SqliteItemStore(ItemStore):
+    """
+    Items in an embedded SQLite database. The code is the primary key,
+    the fields used by the queries are kept in columns besides the whole
+    item serialized as JSON. The database is in the WAL mode, so that
+    the readers (eg. the export) are not blocked by an ingest. A batch is
+    written by a single prepared statement within a transaction.
+
+    The browse filters are backed by indexes on JSON expressions and
+    the words of the name and code by a FTS5 full-text index.
+
+    Each thread gets its own connection.
+    """
+
+    # maximum number of bound parameters of a query in old SQLite versions
+    MAX_VARIABLES = 999
+
+    # the same expressions in the indexes and the queries, so that the indexes are used
+    MANUFACTURER = "json_extract(doc, '$.shoptet_from_ed.MANUFACTURER')"
+    STATUS = "json_extract(doc, '$.ed.Status')"
+    ON_STOCK = "json_extract(doc, '$.ed.OnStock')"
+    VISIBLE = "json_extract(doc, '$.shoptet.VISIBLE')"
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # transactions are managed explicitly
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        connection = self.connection()
+        # takes the write lock at once, so that a read-modify-write is atomic
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def create_indexes(self):
+        connection = self.connection()
+        connection.execute('''CREATE TABLE IF NOT EXISTS items (
+            code TEXT PRIMARY KEY,
+            has_export INTEGER NOT NULL DEFAULT 0,
+            change_seq INTEGER,
+            ed_digest TEXT,
+            export_digest TEXT,
+            doc TEXT NOT NULL)''')
+        connection.execute('CREATE INDEX IF NOT EXISTS items_export ON items (has_export, code)')
+        connection.execute('CREATE INDEX IF NOT EXISTS items_change_seq ON items (change_seq)')
+        connection.execute('CREATE TABLE IF NOT EXISTS meta (id TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+        # the change sequences of the running ingests
+        connection.execute('CREATE TABLE IF NOT EXISTS pending_change_seqs ('
+                           'seq INTEGER PRIMARY KEY, started REAL NOT NULL)')
+        # the old and new values are JSON
+        connection.execute('''CREATE TABLE IF NOT EXISTS changes (
+            run INTEGER NOT NULL,
+            code TEXT NOT NULL,
+            field TEXT NOT NULL,
+            old TEXT,
+            new TEXT)''')
+        connection.execute('CREATE INDEX IF NOT EXISTS changes_run ON changes (run, field, code)')
+        connection.execute('CREATE INDEX IF NOT EXISTS changes_code ON changes (code, run)')
+        for (name, expression) in [('manufacturer', self.MANUFACTURER), ('status', self.STATUS),
+                                   ('on_stock', self.ON_STOCK), ('visible', self.VISIBLE)]:
+            connection.execute('CREATE INDEX IF NOT EXISTS items_%s ON items (%s, code)' % (name, expression))
+        connection.execute('CREATE INDEX IF NOT EXISTS items_source ON items (has_export, %s, code)' % self.VISIBLE)
+        with self.transaction() as connection:
+            if not connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'items_fts'").fetchone():
+                # the rowid is the one of the item, the items stored before are indexed at once
+                connection.execute('CREATE VIRTUAL TABLE items_fts USING fts5(code, name)')
+                connection.execute("INSERT INTO items_fts (rowid, code, name) "
+                                   "SELECT rowid, code, json_extract(doc, '$.shoptet_from_ed.NAME') FROM items")
+
+    def upsert_batch(self, upserts, changes=None):
+        with self.transaction() as connection:
+            stored = self._get_docs(connection, set(code for (code, _) in upserts))
+            changed = OrderedDict()
+            for (code, fields) in upserts:
+                old_doc = changed.get(code, stored.get(code))
+                doc = OrderedDict(old_doc) if old_doc is not None else OrderedDict([('code', code)])
+                doc.update(fields)
+                doc['code'] = code
+                if doc != old_doc:
+                    changed[code] = doc
+            # the replaced rows get a new rowid, so they are reindexed
+            connection.executemany(
+                'DELETE FROM items_fts WHERE rowid = (SELECT rowid FROM items WHERE code = ?)',
+                [(code,) for code in changed if code in stored])
+            connection.executemany(
+                'INSERT OR REPLACE INTO items (code, has_export, change_seq, ed_digest, export_digest, doc) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(code, 1 if doc.get('has_export') else 0, doc.get('change_seq'), doc.get('ed_digest'),
+                  doc.get('export_digest'), encode_doc(doc))
+                 for (code, doc) in changed.items()])
+            connection.executemany(
+                'INSERT INTO items_fts (rowid, code, name) SELECT rowid, ?, ? FROM items WHERE code = ?',
+                [(' '.join(search_words(code)), ' '.join(search_words((doc.get('shoptet_from_ed') or {}).get('NAME'))),
+                  code) for (code, doc) in changed.items()])
+            if changes:
+                self._insert_changes(connection, changes)
+        return len(changed), 0
+
+    def _get_docs(self, connection, codes):
+        codes = list(codes)
+        docs = {}
+        for i in range(0, len(codes), self.MAX_VARIABLES):
+            chunk = codes[i:i + self.MAX_VARIABLES]
+            rows = connection.execute(
+                'SELECT code, doc FROM items WHERE code IN (%s)' % ','.join('?' * len(chunk)), chunk)
+            docs.update((code, decode_doc(doc)) for (code, doc) in rows)
+        return docs
+
+    def get_by_codes(self, codes, fields=None):
+        docs = self._get_docs(self.connection(), codes).values()
+        if fields is None:
+            return list(docs)
+        return [OrderedDict((field, doc[field]) for field in ('code',) + tuple(fields) if field in doc)
+                for doc in docs]
+
+    def export_scan(self, since=None, batch_size=1000):
+        if since is None:
+            cursor = self.connection().execute('SELECT doc FROM items WHERE has_export = 1 ORDER BY code')
+        else:
+            cursor = self.connection().execute(
+                'SELECT doc FROM items WHERE has_export = 1 AND change_seq > ? ORDER BY code', (since,))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for (doc,) in rows:
+                yield decode_doc(doc)
+
+    def browse(self, filters, after=None, limit=50):
+        conditions, params = [], []
+        for (name, expression) in [('manufacturer', self.MANUFACTURER), ('status', self.STATUS),
+                                   ('visible', self.VISIBLE)]:
+            if name in filters:
+                conditions.append('%s = ?' % expression)
+                params.append(filters[name])
+        if 'stock' in filters:
+            conditions.append('%s = ?' % self.ON_STOCK)
+            params.append('true' if filters['stock'] == 'in' else 'false')
+        source = filters.get('source')
+        if source is not None:
+            conditions.append('has_export = %d' % (0 if source == 'shoptet' else 1))
+            conditions.append('%s IS %s' % (self.VISIBLE, 'NULL' if source == 'ed' else 'NOT NULL'))
+        if search_words(filters.get('text')):
+            conditions.append('rowid IN (SELECT rowid FROM items_fts WHERE items_fts MATCH ?)')
+            params.append(fts_query(filters['text']))
+        if after is not None:
+            conditions.append('code > ?')
+            params.append(after)
+        query = 'SELECT doc FROM items'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY code LIMIT ?'
+        params.append(limit)
+        return [decode_doc(doc) for (doc,) in self.connection().execute(query, params)]
+
+    def load_ed_digests(self):
+        rows = self.connection().execute(
+            'SELECT code, ed_digest, export_digest FROM items WHERE ed_digest IS NOT NULL')
+        return {code: (digest, export_digest) for (code, digest, export_digest) in rows}
+
+    def _get_counter(self, counter_id):
+        row = self.connection().execute('SELECT version FROM meta WHERE id = ?', (counter_id,)).fetchone()
+        return row[0] if row else 0
+
+    def _increment_counter(self, counter_id, connection=None):
+        if connection is None:
+            with self.transaction() as connection:
+                return self._increment_counter(counter_id, connection)
+        connection.execute('INSERT OR IGNORE INTO meta (id, version) VALUES (?, 0)', (counter_id,))
+        connection.execute('UPDATE meta SET version = version + 1 WHERE id = ?', (counter_id,))
+        return connection.execute('SELECT version FROM meta WHERE id = ?', (counter_id,)).fetchone()[0]
+
+    def get_data_version(self):
+        return self._get_counter(DATA_VERSION_ID)
+
+    def bump_data_version(self):
+        return self._increment_counter(DATA_VERSION_ID)
+
+    def get_change_seq(self):
+        return self._get_counter(CHANGE_SEQ_ID)
+
+    def next_change_seq(self):
+        with self.transaction() as connection:
+            change_seq = self._increment_counter(CHANGE_SEQ_ID, connection)
+            connection.execute('INSERT INTO pending_change_seqs (seq, started) VALUES (?, ?)',
+                               (change_seq, time.time()))
+            return change_seq
+
+    def commit_change_seq(self, change_seq):
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM pending_change_seqs WHERE seq = ?', (change_seq,))
+
+    def get_committed_change_seq(self):
+        # a single statement reads a consistent snapshot
+        return self.connection().execute(
+            'SELECT COALESCE((SELECT MIN(seq) - 1 FROM pending_change_seqs WHERE started > ?), '
+            '(SELECT version FROM meta WHERE id = ?), 0)',
+            (time.time() - PENDING_TIMEOUT, CHANGE_SEQ_ID)).fetchone()[0]
+
+    def add_changes(self, changes):
+        with self.transaction() as connection:
+            self._insert_changes(connection, changes)
+
+    def _insert_changes(self, connection, changes):
+        connection.executemany(
+            'INSERT INTO changes (run, code, field, old, new) VALUES (?, ?, ?, ?, ?)',
+            [(change['run'], change['code'], change['field'], encode_doc(change['old']),
+              encode_doc(change['new'])) for change in changes])
+
+    def find_changes(self, run, field=None, limit=None):
+        query = 'SELECT run, code, field, old, new FROM changes WHERE run = ?'
+        params = [run]
+        if field is not None:
+            query += ' AND field = ?'
+            params.append(field)
+        query += ' ORDER BY field, code'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+        return self._change_records(self.connection().execute(query, params))
+
+    def count_changes(self, run):
+        rows = self.connection().execute('SELECT field, COUNT(*) FROM changes WHERE run = ? GROUP BY field', (run,))
+        return dict(rows)
+
+    def find_item_changes(self, code):
+        return self._change_records(self.connection().execute(
+            'SELECT run, code, field, old, new FROM changes WHERE code = ? ORDER BY run', (code,)))
+
+    def _change_records(self, rows):
+        return [OrderedDict([('run', run), ('code', code), ('field', field),
+                             ('old', decode_doc(old)), ('new', decode_doc(new))])
+                for (run, code, field, old, new) in rows]
+
+    def change_runs(self, limit=None):
+        query = 'SELECT DISTINCT run FROM changes ORDER BY run DESC'
+        if limit:
+            query += ' LIMIT %d' % limit
+        return [run for (run,) in self.connection().execute(query)]
+
+    def drop(self):
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM items')
+            connection.execute('DELETE FROM meta')
+            connection.execute('DELETE FROM pending_change_seqs')
+            connection.execute('DELETE FROM changes')
+            connection.execute('DELETE FROM items_fts')
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+def encode_doc(doc):
+    return json.dumps(doc, separators=(',', ':'), ensure_ascii=False, default=_encode_bytes)
+
+
+def decode_doc(doc_json):
+    return json.loads(doc_json, object_pairs_hook=_decode_pairs)
+
+
+def _encode_bytes(value):
+    # eg. the compressed raw ED item
+    if isinstance(value, bytes):
+        return {'$binary': base64.b64encode(value).decode('ascii')}
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def _decode_pairs(pairs):
+    if len(pairs) == 1 and pairs[0][0] == '$binary':
+        return base64.b64decode(pairs[0][1])
+    return OrderedDict(pairs)
+
+
+def item_update(code, fields):
+    """MongoDB update of an upsert (code, fields) which keeps the search words."""
+    update = {'$set': dict(fields, code=code)}
+    if fields.get('shoptet_from_ed') is not None:
+        update['$set']['search_words'] = search_words(code, fields['shoptet_from_ed'].get('NAME'))
+    else:
+        # an item only in Shoptet, the ED ingest adds the words of the name
+        update['$setOnInsert'] = {'search_words': search_words(code)}
+    return update
+
+
+def search_words(*texts):
+    """
+    The distinct words of the texts (None is skipped) in lowercase
+    without diacritics, eg. 'Tiskárna PLA-1.75' -> ['tiskarna', 'pla', '1', '75'].
+    """
+    words = []
+    for text in texts:
+        if text:
+            decomposed = unicodedata.normalize('NFKD', text)
+            plain = ''.join(c for c in decomposed if not unicodedata.combining(c)).lower()
+            for word in WORD_PATTERN.findall(plain):
+                if word not in words:
+                    words.append(word)
+    return words
+
+
+def fts_query(text):
+    """FTS5 query matching the items with all the words (or their prefixes)."""
+    return ' '.join('"%s"*' % word for word in search_words(text))
+
+
+def is_sqlite_uri(uri):
+    return uri.startswith('sqlite://')
+
+
+def sqlite_path(uri):
+    """sqlite:///abs/path/catalog.db or sqlite://relative/path/catalog.db"""
+    return uri[len('sqlite://'):]
+
+
+def check_item_store(item_store):
+    """
+    Checks the behavior of a store required by the ingests and the export.
+    Drops all its data! Raises AssertionError on the first failed check.
+    """
+    item_store.create_indexes()
+    item_store.drop()
+
+    def check(condition, message):
+        if not condition:
+            raise AssertionError('%s: %s' % (type(item_store).__name__, message))
+
+    check(item_store.get_change_seq() == 0, 'no change sequence allocated in an empty store')
+    check(item_store.next_change_seq() == 1 and item_store.next_change_seq() == 2, 'change sequences increase')
+    check(item_store.get_change_seq() == 2, 'the last change sequence is returned')
+    check(item_store.get_committed_change_seq() == 0, 'an allocated change sequence is not committed')
+    item_store.commit_change_seq(2)
+    check(item_store.get_committed_change_seq() == 0, 'a change sequence is committed after the earlier ones')
+    item_store.commit_change_seq(1)
+    check(item_store.get_committed_change_seq() == 2, 'the committed change sequence follows the finished ingests')
+    check(item_store.get_data_version() == 0 and item_store.bump_data_version() == 1, 'data version increases')
+
+    shoptet_from_ed = OrderedDict([('CODE', 'B'), ('STOCK', OrderedDict([('AMOUNT', '1'), ('MINIMAL_AMOUNT', '0')]))])
+    upserts = [
+        ('B', {'ed': {'Code': 'B'}, 'ed_digest': 'b1', 'export_digest': 'e1', 'has_export': True,
+               'change_seq': 1, 'shoptet_from_ed': shoptet_from_ed, 'ed_raw': b'\x00raw'}),
+        ('A', {'ed': {'Code': 'A'}, 'ed_digest': 'a1', 'export_digest': 'e2', 'has_export': True,
+               'change_seq': 2, 'shoptet_from_ed': {'CODE': 'A'}}),
+        ('C', {'shoptet': {'CODE': 'C', 'VISIBLE': False, 'AVAILABILITY_IN_STOCK': ''}}),
+    ]
+    check(item_store.upsert_batch(upserts) == (3, 0), 'new items are inserted')
+    check(item_store.upsert_batch(upserts) == (0, 0), 'unchanged items are not counted as modified')
+    check(item_store.upsert_batch([('A', {'shoptet': {'CODE': 'A', 'VISIBLE': True,
+                                                      'AVAILABILITY_IN_STOCK': 'x'}})]) == (1, 0),
+          'a field is added to an existing item')
+
+    items = {item['code']: item for item in item_store.get_by_codes(['A', 'B', 'X'])}
+    check(sorted(items) == ['A', 'B'], 'only the existing items are returned by codes')
+    check(items['A']['ed_digest'] == 'a1' and items['A']['shoptet']['VISIBLE'] is True,
+          'an upsert keeps the other fields')
+    check(items['B']['ed_raw'] == b'\x00raw', 'binary fields are stored')
+    check([dict(item) for item in item_store.get_by_codes(['A'], ['ed_digest'])] == [{'code': 'A', 'ed_digest': 'a1'}],
+          'only the requested fields are returned')
+    check(list(items['B']['shoptet_from_ed']['STOCK']) == ['AMOUNT', 'MINIMAL_AMOUNT'],
+          'the order of nested fields is kept')
+
+    check([item['code'] for item in item_store.export_scan()] == ['A', 'B'],
+          'the export scans the converted items sorted by code')
+    check([item['code'] for item in item_store.export_scan(since=1)] == ['A'],
+          'the delta export selects the items by change sequence')
+    check([item['code'] for item in item_store.browse({}, after='A', limit=1)] == ['B'],
+          'the browse is paginated by code')
+    check([[item['code'] for item in item_store.browse({'source': source})] for source in ('ed', 'shoptet', 'both')] ==
+          [['B'], ['C'], ['A']], 'the browse filters the items by source')
+    check([item['code'] for item in item_store.browse({'visible': False})] == ['C'], 'the browse filters by visibility')
+    check(item_store.load_ed_digests() == {'A': ('a1', 'e2'), 'B': ('b1', 'e1')}, 'ED digests by code')
+
+    with item_store.writer(batch_size=2) as writer:
+        for i in range(5):
+            writer.add(('W%d' % i, {'has_export': True}))
+    check(writer.changed_count == 5, 'the writer flushes all the batches')
+
+    item_store.add_changes([
+        OrderedDict([('run', 3), ('code', 'B'), ('field', 'PRICE'), ('old', '1'), ('new', '2')]),
+        OrderedDict([('run', 3), ('code', 'A'), ('field', 'PRICE'), ('old', None), ('new', '3')]),
+        OrderedDict([('run', 3), ('code', 'C'), ('field', 'NEW'), ('old', None), ('new', 'C')]),
+        OrderedDict([('run', 4), ('code', 'A'), ('field', 'VAT'), ('old', '21'), ('new', '15')]),
+    ])
+    check([(c['field'], c['code']) for c in item_store.find_changes(3)] == [('NEW', 'C'), ('PRICE', 'A'),
+                                                                            ('PRICE', 'B')],
+          'the changes of a run are sorted by field and code')
+    check([dict(c) for c in item_store.find_changes(3, 'PRICE', limit=1)] ==
+          [{'run': 3, 'code': 'A', 'field': 'PRICE', 'old': None, 'new': '3'}], 'the changes of a field')
+    check(item_store.count_changes(3) == {'NEW': 1, 'PRICE': 2}, 'the changes counted by field')
+    check([c['run'] for c in item_store.find_item_changes('A')] == [3, 4], 'the changes of a product by run')
+    check(item_store.change_runs() == [4, 3] and item_store.change_runs(1) == [4], 'the latest runs first')
+    check(len(list(item_store.export_scan(batch_size=2))) == 7, 'the export scan reads all the batches')
+    item_store.drop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Storage of the catalog products.')
+    parser.add_argument('command', choices=['check'])
+    parser.add_argument('uri', help='sqlite:///path/to/catalog.db or a MongoDB URI (its data is dropped!)')
+    args = parser.parse_args()
+
+    import store
+    item_store = store.get_item_store(args.uri)
+    try:
+        check_item_store(item_store)
+    except AssertionError as e:
+        print('FAILED:', e)
+        sys.exit(1)
+    print('OK')
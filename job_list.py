@@ -0,0 +1,162 @@
+"""
+Listing of the RQ jobs for the /jobs/ page.
+
+Fetching the jobs one by one (Queue.fetch_job) costs a Redis round trip
+per job. Here only a page of each registry is listed (in a single round
+trip) and the hashes of its jobs are fetched by a single pipelined batch
+of HGETALL.
+
+The ids whose job hash has already expired (eg. a job deleted meanwhile)
+are removed from their registries, so that they do not pile up.
+"""
+
+from collections import OrderedDict
+
+import redis
+from rq import Queue
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+from rq.registry import FinishedJobRegistry, StartedJobRegistry
+
+# number of jobs of each state listed on a page
+DEFAULT_LIMITS = OrderedDict([
+    ('Waiting', 50),
+    ('Running', 50),
+    ('Finished', 20),
+    ('Failed', 20),
+])
+
+
+class JobPage(object):
+    """A page of the jobs of a single state."""
+
+    def __init__(self, state, jobs, total, page, limit):
+        self.state = state
+        self.jobs = jobs
+        self.total = total
+        self.page = page
+        self.limit = limit
+
+    @property
+    def has_previous(self):
+        return self.page > 1
+
+    @property
+    def has_next(self):
+        return self.page * self.limit < self.total
+
+
+def list_jobs(redis_client, states=None, page=1, limits=DEFAULT_LIMITS):
+    """
+    Returns a map state -> JobPage.
+
+    states - states to list, all by default
+    page - number of the page (from 1) of each listed state
+    """
+    registries = job_registries(redis_client)
+    # moves the timed out running jobs to the failed queue and removes
+    # the expired finished jobs
+    registries['Running'].cleanup()
+    registries['Finished'].cleanup()
+
+    listed = [state for state in registries if states is None or state in states]
+    pipe = redis_client.pipeline(transaction=False)
+    for state in listed:
+        queue_job_ids(pipe, state, registries[state], (page - 1) * limits[state], limits[state])
+    results = pipe.execute()
+
+    pages = OrderedDict()
+    for (i, state) in enumerate(listed):
+        total, job_ids = results[2 * i], [job_id.decode('utf-8') for job_id in results[2 * i + 1]]
+        if state == 'Failed':
+            job_ids.reverse()
+        pages[state] = (total, job_ids)
+    jobs = fetch_jobs(redis_client, [(job_id, registries[state])
+                                     for (state, (_, job_ids)) in pages.items() for job_id in job_ids])
+    return OrderedDict(
+        (state, JobPage(state, [jobs[job_id] for job_id in job_ids if job_id in jobs], total, page, limits[state]))
+        for (state, (total, job_ids)) in pages.items())
+
+
+def job_registries(redis_client):
+    return OrderedDict([
+        ('Waiting', Queue(connection=redis_client)),
+        ('Running', StartedJobRegistry(connection=redis_client)),
+        ('Finished', FinishedJobRegistry(connection=redis_client)),
+        ('Failed', Queue('failed', connection=redis_client)),
+    ])
+
+
+def queue_job_ids(pipe, state, registry, offset, limit):
+    """Adds the commands which return the total and a page of the job ids."""
+    if state == 'Waiting':
+        # the next job to run first
+        pipe.llen(registry.key)
+        pipe.lrange(registry.key, offset, offset + limit - 1)
+    elif state == 'Failed':
+        # the failed jobs are appended, the page is taken from the end
+        pipe.llen(registry.key)
+        pipe.lrange(registry.key, -(offset + limit), -(offset + 1))
+    else:
+        # the registries are sorted sets scored by the expiration time,
+        # the latest first
+        pipe.zcard(registry.key)
+        pipe.zrevrange(registry.key, offset, offset + limit - 1)
+
+
+def fetch_jobs(redis_client, job_registry_pairs):
+    """
+    Fetches the jobs by a pipelined batch of HGETALL. Returns a map
+    job id -> Job of the existing jobs, the missing ones are removed
+    from their registries (a queue or a sorted set).
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for (job_id, _) in job_registry_pairs:
+        pipe.hgetall(Job.key_for(job_id))
+    job_hashes = pipe.execute()
+
+    jobs = OrderedDict()
+    pipe = strict_pipeline(redis_client)
+    for ((job_id, registry), job_hash) in zip(job_registry_pairs, job_hashes):
+        job = restore_job(redis_client, job_id, job_hash)
+        if job is not None:
+            jobs[job_id] = job
+        elif isinstance(registry, Queue):
+            pipe.lrem(registry.key, 0, job_id)
+        else:
+            pipe.zrem(registry.key, job_id)
+    pipe.execute()
+    return jobs
+
+
+def strict_pipeline(redis_client):
+    """
+    A pipeline with the StrictRedis commands (the argument order of LREM
+    differs in the legacy Redis client) over the connections of the client.
+    """
+    if isinstance(redis_client, redis.Redis):
+        redis_client = redis.StrictRedis(connection_pool=redis_client.connection_pool)
+    return redis_client.pipeline(transaction=False)
+
+
+class _FetchedHash(object):
+    """Stands for the connection of a Job so that it is restored from an already fetched hash."""
+
+    def __init__(self, job_hash):
+        self.job_hash = job_hash
+
+    def hgetall(self, key):
+        return self.job_hash
+
+
+def restore_job(redis_client, job_id, job_hash):
+    """Job restored from its hash (by Job.refresh()), None if the hash is missing or invalid."""
+    job = Job(job_id, connection=redis_client)
+    job.connection = _FetchedHash(job_hash)
+    try:
+        job.refresh()
+    except NoSuchJobError:
+        return None
+    finally:
+        job.connection = redis_client
+    return job
@@ -0,0 +1,137 @@
+"""
+Migrates the stored items to the compact schema.
+
+Items stored from ED used to contain the whole raw ED item under `ed`.
+Now only `ed_catalog.ED_STORED_FIELDS` are kept there (optionally with
+the whole raw item zlib compressed in `ed_raw`) and the converted items
+are flagged by `has_export`, which is indexed along with the code.
+
+The migration can be run repeatedly, the migrated items are skipped.
+Until it is run, the next ED ingest rewrites the old items anyway.
+
+The index of the code used not to be unique, so the ED and Shoptet ingests
+running in parallel could insert two items with the same code. Such
+duplicates are merged into a single item first and the index is made
+unique.
+
+The browse used to match whole words by a text index, now it matches
+prefixes of the words stored in `search_words`. They are added to the
+items stored before and the text index is dropped.
+
+Usage:
+
+    python migrate_schema.py [--mongo-uri mongodb://localhost/s3dt_catalog] [--store-raw]
+"""
+
+import argparse
+
+from pymongo import UpdateOne
+
+import store
+from bulk_writer import BulkWriter
+from catalog_meta import bump_data_version, commit_change_seq, next_change_seq
+from ed_catalog import compact_ed_item, compress_ed_item
+from item_store import MongoItemStore, search_words
+
+
+def migrate_items(item_collection, batch_size=1000, store_raw=False):
+    """
+    Rewrites the items stored in the old schema.
+    Returns the number of migrated items.
+    """
+    MongoItemStore(item_collection.database).create_indexes()
+    # the old items have no has_export flag
+    cursor = item_collection.find(
+        {'shoptet_from_ed': {'$ne': None}, 'has_export': {'$exists': False}},
+        {'ed': 1}).batch_size(batch_size)
+    item_count = 0
+    with BulkWriter(item_collection, batch_size) as writer:
+        for doc in cursor:
+            ed_item = doc.get('ed') or {}
+            fields = {'ed': compact_ed_item(ed_item), 'has_export': True}
+            if store_raw and ed_item:
+                fields['ed_raw'] = compress_ed_item(ed_item)
+            writer.add(UpdateOne({'_id': doc['_id']}, {'$set': fields}))
+            item_count += 1
+    return item_count
+
+
+def add_search_words(item_collection, batch_size=1000):
+    """
+    Stores the words of the code and the name of the items stored before
+    the search words were introduced and drops the old text index.
+    Returns the number of updated items.
+    """
+    cursor = item_collection.find(
+        {'search_words': {'$exists': False}}, {'code': 1, 'shoptet_from_ed.NAME': 1}).batch_size(batch_size)
+    item_count = 0
+    with BulkWriter(item_collection, batch_size) as writer:
+        for doc in cursor:
+            words = search_words(doc['code'], (doc.get('shoptet_from_ed') or {}).get('NAME'))
+            writer.add(UpdateOne({'_id': doc['_id']}, {'$set': {'search_words': words}}))
+            item_count += 1
+    if 'items_text' in item_collection.index_information():
+        item_collection.drop_index('items_text')
+    return item_count
+
+
+def merge_duplicate_items(item_collection):
+    """
+    Merges the items with the same code into the oldest one, whose fields
+    take precedence (the later upserts were applied to it). The merged
+    items get a new change sequence, so that they are in the next delta
+    export. Then makes the index of the code unique.
+    Returns the number of removed duplicates.
+    """
+    duplicates = item_collection.aggregate([
+        {'$group': {'_id': '$code', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}}], allowDiskUse=True)
+    change_seq = None
+    removed_count = 0
+    try:
+        for duplicate in duplicates:
+            docs = list(item_collection.find({'_id': {'$in': duplicate['ids']}}).sort('_id', 1))
+            merged = {}
+            for doc in reversed(docs):
+                merged.update(doc)
+            if change_seq is None:
+                change_seq = next_change_seq(item_collection.database)
+            merged['change_seq'] = change_seq
+            item_collection.replace_one({'_id': docs[0]['_id']}, merged)
+            removed_count += item_collection.delete_many(
+                {'_id': {'$in': [doc['_id'] for doc in docs[1:]]}}).deleted_count
+            print('merged %d items with code %s' % (len(docs), duplicate['_id']))
+    finally:
+        if change_seq is not None:
+            commit_change_seq(item_collection.database, change_seq)
+    if change_seq is not None:
+        bump_data_version(item_collection.database)
+    code_index = item_collection.index_information().get('code_1')
+    if code_index is not None and not code_index.get('unique'):
+        item_collection.drop_index('code_1')
+    item_collection.create_index('code', unique=True)
+    return removed_count
+
+
+def collection_size(db, collection_name):
+    """Returns the number of documents, their total and average size in bytes."""
+    stats = db.command('collstats', collection_name)
+    return stats['count'], stats['size'], stats.get('avgObjSize', 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate the stored items to the compact schema.')
+    parser.add_argument('--mongo-uri', help='MongoDB URI, MONGO_URI by default')
+    parser.add_argument('--store-raw', action='store_true',
+                        help='Keep the whole raw ED items, zlib compressed')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    db = store.get_database(args.mongo_uri)
+    print('before: %d items, %d bytes, %d bytes per item' % collection_size(db, 'items'))
+    print('removed %d duplicate items' % merge_duplicate_items(db.items))
+    print('migrated %d items' % migrate_items(db.items, args.batch_size, args.store_raw))
+    print('added search words to %d items' % add_search_words(db.items, args.batch_size))
+    # the size of the data, the storage itself is reclaimed by a compaction
+    print('after: %d items, %d bytes, %d bytes per item' % collection_size(db, 'items'))
+    store.close()
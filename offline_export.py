@@ -0,0 +1,150 @@
+"""
+Converts the ED catalog to the Shoptet import XML in a single pass,
+without a database - eg. for ad-hoc runs and debugging.
+
+The Shoptet CSV is read into an in-memory index code -> (visibility,
+availability), then the ED catalog (XML or ZIP) is streamed, the selected
+products are converted, joined with the index and written as SHOPITEMs
+right away by the same rules as export_catalog.convert_item(). Besides
+the index only the byte range of each exported code is kept in memory, so
+it grows with the number of exported products, not with the ED catalog.
+The catalog is parsed by the lxml iterparse engine, which yields the items.
+
+Unlike the export from the store, the products are in the order of the
+ED catalog, not sorted by code. A code repeated in the ED catalog is
+exported once, by its last occurrence (as the store keeps the last upsert):
+the byte range of each written SHOPITEM is kept by code and the ranges of
+the replaced ones are cut out of the output at the end.
+
+Usage:
+
+    python offline_export.py ed_catalog.zip shoptet_products.csv shoptet_import.xml
+"""
+
+import argparse
+import os
+import shutil
+import time
+
+import ed_catalog
+import export_catalog
+from shoptet_catalog import CATALOG_ENCODING, iter_catalog_csv
+from xml_validation import ItemValidator
+
+
+def load_shoptet_index(csv_path, encoding=CATALOG_ENCODING):
+    """
+    Reads the Shoptet CSV into a map code -> (VISIBLE, AVAILABILITY_IN_STOCK).
+    The availability texts repeat, so each distinct one is kept only once.
+    """
+    availabilities = {}
+    index = {}
+    with open(csv_path, encoding=encoding, newline='') as csv_file:
+        for item in iter_catalog_csv(csv_file):
+            availability = item['AVAILABILITY_IN_STOCK']
+            index[item['CODE']] = (item['VISIBLE'], availabilities.setdefault(availability, availability))
+    return index
+
+
+def iter_merged_items(catalog_xml, shoptet_index, category_filter=ed_catalog.DEFAULT_CATEGORY_FILTER):
+    """
+    Generates the selected ED items converted and joined with the Shoptet
+    index, in the form of the stored items read by the export. A code
+    repeated in the catalog is generated each time.
+    """
+    for ed_item in ed_catalog.iter_catalog_items_lxml(catalog_xml, category_filter):
+        item = {'code': ed_item['Code'], 'shoptet_from_ed': ed_catalog.fast_convert_item(ed_item)}
+        shoptet_state = shoptet_index.get(ed_item['Code'])
+        if shoptet_state is not None:
+            item['shoptet'] = {'VISIBLE': shoptet_state[0], 'AVAILABILITY_IN_STOCK': shoptet_state[1]}
+        yield item
+
+
+def export_offline(ed_catalog_path, shoptet_csv_path, output_path,
+                   category_filter=ed_catalog.DEFAULT_CATEGORY_FILTER, validator=None):
+    """
+    Writes the Shoptet import XML of the ED catalog (XML or ZIP) and
+    the Shoptet CSV. Returns the statistics.
+    """
+    start = time.time()
+    shoptet_index = load_shoptet_index(shoptet_csv_path)
+    stats = {'shoptet_items': len(shoptet_index), 'index_time': time.time() - start}
+    # code -> (start, end) of the last SHOPITEM written
+    written = {}
+    existing_items = 0
+    # byte ranges of the SHOPITEMs replaced by a later one with the same code
+    replaced = []
+    with open(ed_catalog_path, 'rb') as catalog_file, \
+            ed_catalog.open_catalog_xml(catalog_file) as catalog_xml, \
+            open(output_path, 'wb') as output_file:
+        output_file.write(export_catalog.XML_HEADER.encode('utf-8'))
+        for item in iter_merged_items(catalog_xml, shoptet_index, category_filter):
+            item_start = output_file.tell()
+            output_file.write(export_catalog.shop_item_xml(item, validator).encode('utf-8'))
+            if item['code'] in written:
+                replaced.append(written[item['code']])
+            elif 'shoptet' in item:
+                # the same code is always joined with the same Shoptet item
+                existing_items += 1
+            written[item['code']] = (item_start, output_file.tell())
+        output_file.write(export_catalog.XML_FOOTER.encode('utf-8'))
+    if replaced:
+        print('WARNING: %d products repeated in the ED catalog, only the last one of each is exported'
+              % len(replaced))
+        remove_byte_ranges(output_path, replaced)
+    stats['items'] = len(written)
+    stats['existing_items'] = existing_items
+    stats['duplicate_items'] = len(replaced)
+    stats['elapsed_time'] = time.time() - start
+    return stats
+
+
+def remove_byte_ranges(path, ranges, chunk_size=1024 * 1024):
+    """Rewrites the file without the given (start, end) byte ranges."""
+    tmp_path = path + '.tmp'
+    with open(path, 'rb') as input_file, open(tmp_path, 'wb') as output_file:
+        for (start, end) in sorted(ranges):
+            copy_bytes(input_file, output_file, start - input_file.tell(), chunk_size)
+            input_file.seek(end)
+        shutil.copyfileobj(input_file, output_file, chunk_size)
+    os.replace(tmp_path, path)
+
+
+def copy_bytes(input_file, output_file, size, chunk_size):
+    while size > 0:
+        chunk = input_file.read(min(size, chunk_size))
+        if not chunk:
+            return
+        output_file.write(chunk)
+        size -= len(chunk)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Convert the ED catalog to the Shoptet import XML without a database.')
+    parser.add_argument('ed_catalog', help='Path to the ED catalog (XML or ZIP)')
+    parser.add_argument('shoptet_csv', help='Path to the Shoptet products CSV')
+    parser.add_argument('output', help='Path to the Shoptet import XML to be written')
+    parser.add_argument('--commodity-names', nargs='*', default=['3D TISK'],
+                        help='Names of the selected ED categories')
+    parser.add_argument('--commodity-codes', nargs='*', default=['3DP'],
+                        help='Codes of the selected ED categories')
+    parser.add_argument('--validate', action='store_true',
+                        help='Validate each product by the RelaxNG schema and report the invalid ones')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    validator = ItemValidator() if args.validate else None
+    stats = export_offline(args.ed_catalog, args.shoptet_csv, args.output,
+                           ed_catalog.CategoryFilter(args.commodity_names, args.commodity_codes), validator)
+    print('exported %d products (%d existing in Shoptet of %d, %d repeated skipped) in %.3f sec' % (
+        stats['items'], stats['existing_items'], stats['shoptet_items'], stats['duplicate_items'],
+        stats['elapsed_time']))
+    if validator is not None:
+        print('valid products: %d, invalid products: %d, validated in %.3f sec' % (
+            validator.valid, validator.invalid, validator.validation_time))
+        for (code, message) in validator.errors:
+            print('%s: %s' % (code, message))
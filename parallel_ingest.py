@@ -0,0 +1,249 @@
+"""
+Parallel ingest of the ED catalog on multiple cores.
+
+The catalog XML is split into byte ranges aligned on <Product> boundaries.
+Each shard is parsed, filtered, converted and written to MongoDB in a separate
+process with its own batched writes. The progress of the shards is merged
+into a single Counter in the parent process. The stored digests (a map of
+all the stored items) are passed to each worker process once when it starts,
+not with each of its shards.
+
+The resulting documents are the same as from a single-process ingest as long
+as product codes are unique within the catalog (otherwise the order in which
+the duplicates are written is not defined).
+"""
+
+import multiprocessing
+import queue
+import shutil
+import tempfile
+
+import store
+from ed_catalog import DEFAULT_CATEGORY_FILTER, Counter, fetch_ed_catalog, ingest_key, load_catalog_to_mongo, \
+    open_catalog_xml
+from pipeline import PipelineCancelled
+
+PRODUCT_START_TAG = b'<Product>'
+PRODUCT_END_TAG = b'</Product>'
+# each shard is parsed as a complete document with the products
+SHARD_ROOT_START = b'<ResponseProductList><ProductList>'
+SHARD_ROOT_END = b'</ProductList></ResponseProductList>'
+
+# the stored digests in a worker process, set by _init_worker()
+_worker_digests = None
+
+
+def download_ed_catalog_to_mongo_parallel(store_uri, catalog_url, counter, num_workers, batch_size=1000,
+                                          parser_engine='xmltodict', category_filter=DEFAULT_CATEGORY_FILTER,
+                                          cache=None, store_raw=False, is_cancelled=None):
+    """
+    The same as ed_catalog.download_ed_catalog_to_mongo(), but the catalog
+    is ingested by num_workers processes once it is downloaded.
+    Returns False if the ingest was skipped since the catalog has not changed.
+    Raises PipelineCancelled once is_cancelled() returns True.
+    """
+    digests = store.get_item_store(store_uri).load_ed_digests()
+    with fetch_ed_catalog(catalog_url, counter, cache, ingest_key(store_uri, category_filter),
+                          force=not digests) as catalog_file:
+        if catalog_file is None:
+            counter.finished()
+            return False
+        # the shards are read by the workers from an uncompressed file
+        with tempfile.NamedTemporaryFile(suffix='.xml') as xml_file:
+            with open_catalog_xml(catalog_file) as catalog_xml:
+                shutil.copyfileobj(catalog_xml, xml_file, 1024 * 1024)
+            xml_file.flush()
+            load_catalog_file_parallel(xml_file.name, store_uri, counter, num_workers, batch_size,
+                                       parser_engine, category_filter, store_raw=store_raw, digests=digests,
+                                       is_cancelled=is_cancelled)
+    return True
+
+
+def load_catalog_file_parallel(xml_path, store_uri, counter, num_workers, batch_size=1000,
+                               parser_engine='xmltodict', category_filter=DEFAULT_CATEGORY_FILTER,
+                               num_shards=None, store_raw=False, digests=None, is_cancelled=None):
+    """
+    Loads a local catalog XML file to the store using a pool of processes.
+
+    num_shards - number of byte ranges, by default a few per worker
+        so that the work is balanced
+    digests - the stored digests, loaded from the store if None
+    is_cancelled - optional function checked while the shards are running,
+        once it returns True the workers are terminated and
+        PipelineCancelled is raised (the batches written so far are kept)
+    """
+    item_store = store.get_item_store(store_uri)
+    if digests is None:
+        digests = item_store.load_ed_digests()
+    # all shards mark the changed items by the same sequence
+    change_seq = item_store.next_change_seq()
+
+    with open(xml_path, 'rb') as xml_file:
+        shard_ranges = find_shard_ranges(xml_file, num_shards or 4 * num_workers)
+        xml_declaration = read_xml_declaration(xml_file)
+    print('ingesting %d shards by %d workers' % (len(shard_ranges), num_workers))
+
+    try:
+        _ingest_shards(xml_path, shard_ranges, xml_declaration, store_uri, counter, num_workers, batch_size,
+                       parser_engine, category_filter, digests, change_seq, store_raw, is_cancelled)
+    finally:
+        item_store.commit_change_seq(change_seq)
+    counter.finished()
+
+
+def _ingest_shards(xml_path, shard_ranges, xml_declaration, store_uri, counter, num_workers, batch_size,
+                   parser_engine, category_filter, digests, change_seq, store_raw, is_cancelled):
+    shard_states = {}
+    finished_shards = set()
+    with multiprocessing.Manager() as manager:
+        progress_queue = manager.Queue()
+        # leaving the with block terminates the workers, eg. when cancelled
+        with multiprocessing.Pool(num_workers, _init_worker, (digests,)) as pool:
+            pending = [
+                pool.apply_async(ingest_shard, (
+                    index, xml_path, start, end, xml_declaration, store_uri, batch_size,
+                    parser_engine, category_filter, change_seq, store_raw, progress_queue,
+                    counter.report_period))
+                for (index, (start, end)) in enumerate(shard_ranges)]
+            while pending:
+                if is_cancelled is not None and is_cancelled():
+                    print('parallel ingest cancelled, terminating the workers')
+                    raise PipelineCancelled()
+                pending[0].wait(timeout=1.0)
+                for result in [result for result in pending if result.ready()]:
+                    index, state = result.get()
+                    shard_states[index] = state
+                    finished_shards.add(index)
+                    pending.remove(result)
+                _drain_progress(progress_queue, shard_states, finished_shards)
+                counter.merge_shard_states(shard_states.values())
+                if pending and counter.report:
+                    counter.report(counter)
+
+
+def _init_worker(digests):
+    global _worker_digests
+    _worker_digests = digests
+
+
+def _drain_progress(progress_queue, shard_states, finished_shards):
+    while True:
+        try:
+            index, state = progress_queue.get_nowait()
+        except queue.Empty:
+            return
+        # a late progress report must not overwrite the final state
+        if index not in finished_shards:
+            shard_states[index] = state
+
+
+def ingest_shard(index, xml_path, start, end, xml_declaration, store_uri, batch_size,
+                 parser_engine, category_filter, change_seq, store_raw, progress_queue, report_period):
+    """
+    Ingests the products within a byte range of the catalog XML.
+    Runs in a worker process of the pool. Returns the index and the final
+    shard state.
+    """
+    def report(counter):
+        progress_queue.put((index, counter.shard_state()))
+
+    # every process has its own client, reused by its next shards
+    item_store = store.get_item_store(store_uri)
+    counter = Counter(report=report, report_period=report_period)
+    with open(xml_path, 'rb') as xml_file:
+        shard_xml = ShardReader(xml_file, start, end,
+                                xml_declaration + SHARD_ROOT_START, SHARD_ROOT_END)
+        load_catalog_to_mongo(shard_xml, item_store, counter, batch_size, parser_engine,
+                              category_filter, _worker_digests, change_seq, store_raw)
+    return index, counter.shard_state()
+
+
+def find_shard_ranges(xml_file, num_shards, window_size=64 * 1024):
+    """
+    Splits the products of the catalog XML into at most num_shards byte
+    ranges (start, end) of roughly the same size. Each range starts at a
+    <Product> tag and ends right after a </Product> tag.
+    """
+    xml_file.seek(0, 2)
+    size = xml_file.tell()
+    first_start = _find_forward(xml_file, PRODUCT_START_TAG, 0, window_size)
+    last_end = _find_backward(xml_file, PRODUCT_END_TAG, size, window_size)
+    if first_start is None or last_end is None:
+        return []
+    last_end += len(PRODUCT_END_TAG)
+
+    boundaries = [first_start]
+    for i in range(1, num_shards):
+        target = first_start + (last_end - first_start) * i // num_shards
+        position = _find_forward(xml_file, PRODUCT_START_TAG, max(target, boundaries[-1] + 1), window_size)
+        if position is None or position >= last_end:
+            break
+        boundaries.append(position)
+    boundaries.append(last_end)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def read_xml_declaration(xml_file):
+    """Returns the XML declaration (bytes) including the encoding or b''."""
+    xml_file.seek(0)
+    head = xml_file.read(1024)
+    if head.startswith(b'<?xml') and b'?>' in head:
+        return head[:head.index(b'?>') + 2]
+    return b''
+
+
+def _find_forward(xml_file, tag, position, window_size):
+    # windows overlap so that a tag on their boundary is found
+    while True:
+        xml_file.seek(position)
+        window = xml_file.read(window_size)
+        index = window.find(tag)
+        if index >= 0:
+            return position + index
+        if len(window) < window_size:
+            return None
+        position += window_size - len(tag) + 1
+
+
+def _find_backward(xml_file, tag, end, window_size):
+    while end > 0:
+        start = max(0, end - window_size)
+        xml_file.seek(start)
+        window = xml_file.read(end - start)
+        index = window.rfind(tag)
+        if index >= 0:
+            return start + index
+        if start == 0:
+            return None
+        end = start + len(tag) - 1
+    return None
+
+
+class ShardReader(object):
+    """
+    Read-only file-like over a byte range of a file wrapped between
+    a prefix and a suffix, so that it forms a standalone XML document.
+    """
+
+    def __init__(self, input_file, start, end, prefix, suffix):
+        self.input_file = input_file
+        self.position = start
+        self.end = end
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.prefix) + (self.end - self.position) + len(self.suffix)
+        data = b''
+        if self.prefix:
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size and self.position < self.end:
+            self.input_file.seek(self.position)
+            chunk = self.input_file.read(min(size - len(data), self.end - self.position))
+            self.position += len(chunk)
+            data += chunk
+        if len(data) < size and self.position >= self.end and self.suffix:
+            rest = size - len(data)
+            data, self.suffix = data + self.suffix[:rest], self.suffix[rest:]
+        return data
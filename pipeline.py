@@ -0,0 +1,255 @@
+"""
+Minimal pipeline of stages running on separate threads.
+
+The stages are connected by bounded queues, so a stage faster than its
+consumer blocks instead of buffering without limit (backpressure). Each stage
+measures its busy time, ie. the time it does not spend waiting on the queues,
+which shows the stage limiting the throughput. If any stage fails or the
+pipeline is cancelled all stages stop.
+"""
+
+import cProfile
+import pstats
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+# marks the end of the items in a queue
+END = object()
+
+
+class PipelineCancelled(Exception):
+    pass
+
+
+class Pipeline(object):
+    """
+    is_cancelled - optional function polled every poll_interval seconds,
+        the pipeline is stopped once it returns True
+    profile - whether to profile each stage by cProfile
+    """
+
+    def __init__(self, is_cancelled=None, poll_interval=1.0, profile=False):
+        self.is_cancelled = is_cancelled
+        self.poll_interval = poll_interval
+        self.profile = profile
+        self.queues = OrderedDict()
+        self.stages = []
+        self.stop_event = threading.Event()
+        self.error = None
+        self.cancelled = False
+
+    def queue(self, name, maxsize):
+        q = queue.Queue(maxsize)
+        q.name = name
+        q.max_depth = 0
+        self.queues[name] = q
+        return q
+
+    def add_stage(self, name, target, output_queue=None):
+        """
+        Adds a stage running target(stage). END is put to the output_queue
+        after target returns.
+        """
+        self.stages.append(Stage(self, name, target, output_queue))
+
+    def run(self, on_poll=None):
+        """
+        Runs the stages until all of them finish. Calls on_poll(pipeline)
+        periodically. Re-raises the first error of a stage or raises
+        PipelineCancelled if cancelled.
+        """
+        threads = [threading.Thread(target=stage.run, name=stage.name) for stage in self.stages]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            # the last stage finishes last unless the pipeline is stopped
+            threads[-1].join(self.poll_interval)
+            if not self.stop_event.is_set() and self.is_cancelled is not None and self.is_cancelled():
+                print('pipeline cancelled')
+                self.cancelled = True
+                self.stop_event.set()
+            if on_poll is not None:
+                on_poll(self)
+        for thread in threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+        if self.cancelled:
+            raise PipelineCancelled()
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.stop_event.set()
+
+    def stage(self, name):
+        return next(stage for stage in self.stages if stage.name == name)
+
+    def profile_stats(self):
+        """The cProfile stats of all the stages merged (pstats.Stats)."""
+        profilers = [stage.profiler for stage in self.stages if stage.profiler is not None]
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        return stats
+
+    def stats(self):
+        """Statistics of each stage and queue."""
+        stats = OrderedDict()
+        for stage in self.stages:
+            stats[stage.name] = stage.stats()
+        for q in self.queues.values():
+            stats[q.name + '_queue'] = {
+                'depth': q.qsize(),
+                'max_depth': q.max_depth,
+                'capacity': q.maxsize}
+        return stats
+
+
+class Stage(object):
+    def __init__(self, pipeline, name, target, output_queue):
+        self.pipeline = pipeline
+        self.name = name
+        self.target = target
+        self.output_queue = output_queue
+        self.received = 0
+        self.sent = 0
+        self.wait_time = 0.0
+        self.start_time = None
+        self.end_time = None
+        self.profiler = None
+
+    def run(self):
+        self.start_time = time.time()
+        if self.pipeline.profile:
+            # a profiler only sees the thread which enabled it
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        try:
+            self.target(self)
+            if self.output_queue is not None:
+                self.put(self.output_queue, END)
+        except PipelineCancelled:
+            pass
+        except Exception as e:
+            print('pipeline stage %s failed: %r' % (self.name, e))
+            self.pipeline.fail(e)
+        finally:
+            if self.profiler is not None:
+                self.profiler.disable()
+            self.end_time = time.time()
+
+    def get(self, q):
+        """Returns the next item from the queue or END."""
+        start = time.time()
+        try:
+            while True:
+                self._check_stopped()
+                try:
+                    item = q.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    pass
+        finally:
+            self.wait_time += time.time() - start
+        if item is not END:
+            self.received += 1
+        return item
+
+    def put(self, q, item):
+        start = time.time()
+        try:
+            while True:
+                self._check_stopped()
+                try:
+                    q.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+        finally:
+            self.wait_time += time.time() - start
+        q.max_depth = max(q.max_depth, q.qsize())
+        if item is not END:
+            self.sent += 1
+
+    def _check_stopped(self):
+        if self.pipeline.stop_event.is_set():
+            raise PipelineCancelled()
+
+    def elapsed_time(self):
+        if self.start_time is None:
+            return 0.0
+        return (self.end_time or time.time()) - self.start_time
+
+    def busy_time(self):
+        """Time not spent waiting on the queues."""
+        return max(0.0, self.elapsed_time() - self.wait_time)
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'sent': self.sent,
+            'elapsed_time': self.elapsed_time(),
+            'busy_time': self.busy_time(),
+            'finished': self.end_time is not None}
+
+
+class QueueReader(object):
+    """Read-only file-like over a queue of bytes chunks ended by END."""
+
+    def __init__(self, stage, q):
+        self.stage = stage
+        self.queue = q
+        self.buffer = b''
+        self.eof = False
+
+    def peek(self, size):
+        """Returns up to size bytes without consuming them."""
+        while len(self.buffer) < size and not self.eof:
+            self._fill()
+        return self.buffer[:size]
+
+    def read(self, size=-1):
+        while (size is None or size < 0 or len(self.buffer) < size) and not self.eof:
+            self._fill()
+        if size is None or size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def drain(self):
+        """Skips the rest of the chunks until the END. Returns the number of bytes skipped."""
+        size = len(self.buffer)
+        self.buffer = b''
+        while not self.eof:
+            chunk = self.stage.get(self.queue)
+            if chunk is END:
+                self.eof = True
+            else:
+                size += len(chunk)
+        return size
+
+    def _fill(self):
+        chunk = self.stage.get(self.queue)
+        if chunk is END:
+            self.eof = True
+        else:
+            self.buffer += chunk
+
+
+class QueueWriter(object):
+    """Write-only file-like putting the written chunks to a queue."""
+
+    def __init__(self, stage, q):
+        self.stage = stage
+        self.queue = q
+
+    def write(self, data):
+        self.stage.put(self.queue, data)
+
+    def flush(self):
+        pass
@@ -0,0 +1,85 @@
+"""
+Browse of the merged ED and Shoptet products.
+
+The products are paginated by a keyset on the code (?after=<last code>),
+so that each page is an index range scan regardless of its position.
+"""
+
+from collections import OrderedDict
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+STOCK_VALUES = ('in', 'out')
+SOURCE_VALUES = ('ed', 'shoptet', 'both')
+BOOLEAN_VALUES = {'true': True, 'false': False}
+
+
+def parse_filters(args):
+    """
+    Filters of item_store.ItemStore.browse() from the request arguments.
+    Raises ValueError on an invalid value.
+    """
+    filters = {}
+    for name in ('manufacturer', 'status'):
+        if args.get(name):
+            filters[name] = args[name]
+    if args.get('stock'):
+        filters['stock'] = parse_choice(args['stock'], STOCK_VALUES)
+    if args.get('visible'):
+        filters['visible'] = BOOLEAN_VALUES[parse_choice(args['visible'], BOOLEAN_VALUES)]
+    if args.get('source'):
+        filters['source'] = parse_choice(args['source'], SOURCE_VALUES)
+    text = ' '.join(args.get('q', '').split())
+    if text:
+        filters['text'] = text
+    return filters
+
+
+def parse_choice(value, choices):
+    if value not in choices:
+        raise ValueError('invalid value: %s' % value)
+    return value
+
+
+def parse_limit(value):
+    limit = int(value) if value else PAGE_SIZE
+    if limit < 1:
+        raise ValueError('invalid limit: %d' % limit)
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def browse_products(item_store, filters, after=None, limit=PAGE_SIZE):
+    """
+    Returns a page of products (see product_row()) and the code to pass
+    as after for the next page (None on the last page).
+    """
+    # one more item tells whether there is a next page
+    items = item_store.browse(filters, after, limit + 1)
+    products = [product_row(item) for item in items[:limit]]
+    next_after = products[-1]['code'] if len(items) > limit else None
+    return products, next_after
+
+
+def product_row(item):
+    """A flat summary of a stored item."""
+    ed_item = item.get('ed') or {}
+    shoptet_item = item.get('shoptet') or {}
+    converted_item = item.get('shoptet_from_ed') or {}
+    if item.get('has_export'):
+        source = 'both' if shoptet_item else 'ed'
+    else:
+        source = 'shoptet'
+    return OrderedDict([
+        ('code', item['code']),
+        ('name', converted_item.get('NAME')),
+        ('manufacturer', converted_item.get('MANUFACTURER')),
+        ('ed_status', ed_item.get('Status')),
+        ('on_stock', ed_item.get('OnStock') == 'true' if 'OnStock' in ed_item else None),
+        ('stock_amount', (converted_item.get('STOCK') or {}).get('AMOUNT')),
+        ('price_vat', converted_item.get('PRICE_VAT')),
+        ('purchase_price', converted_item.get('PURCHASE_PRICE')),
+        ('visible', shoptet_item.get('VISIBLE')),
+        ('availability', shoptet_item.get('AVAILABILITY_IN_STOCK') or converted_item.get('AVAILABILITY_IN_STOCK')),
+        ('source', source),
+    ])
@@ -0,0 +1,88 @@
+"""
+Live progress of the background jobs via Redis.
+
+Saving the RQ job rewrites its whole hash, so the running jobs only publish
+a small JSON snapshot of their progress. It is stored in a key with a TTL
+(for the pages rendered meanwhile) and published on a channel which the
+app relays to the browsers as Server-Sent Events.
+"""
+
+import json
+import time
+
+PROGRESS_CHANNEL = 's3dt:progress'
+# the snapshot outlives the job a bit so that the last state can be shown
+PROGRESS_TTL = 24 * 3600
+
+
+def progress_key(job_id):
+    return 's3dt:progress:%s' % job_id
+
+
+class ProgressPublisher(object):
+    """
+    Publishes the progress of a job. The snapshots are merged, so each
+    publish() may update just some of the fields.
+    """
+
+    def __init__(self, redis_client, job_id):
+        self.redis_client = redis_client
+        self.job_id = job_id
+        self.snapshot = {'job_id': job_id}
+
+    def publish(self, **fields):
+        self.snapshot.update(fields)
+        self.snapshot['time'] = time.time()
+        message = json.dumps(self.snapshot)
+        # a single round trip for both commands
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.set(progress_key(self.job_id), message, ex=PROGRESS_TTL)
+        pipe.publish(PROGRESS_CHANNEL, message)
+        pipe.execute()
+
+
+def get_progress(redis_client, job_ids):
+    """Returns the last progress snapshot of each job (job id -> dict)."""
+    job_ids = list(job_ids)
+    if not job_ids:
+        return {}
+    values = redis_client.mget([progress_key(job_id) for job_id in job_ids])
+    return dict((job_id, json.loads(value.decode('utf-8')))
+                for (job_id, value) in zip(job_ids, values) if value is not None)
+
+
+def iter_progress_events(redis_client, job_id=None, timeout=300, keepalive_interval=15, poll_interval=0.2):
+    """
+    Generates the progress snapshots (of a single job or all jobs) as
+    Server-Sent Events. The stream is closed after timeout seconds, so that
+    it does not occupy a web worker forever, and the browser reconnects.
+    """
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(PROGRESS_CHANNEL)
+    try:
+        yield 'retry: 1000\n\n'
+        if job_id is not None:
+            # the current state, the later changes come from the channel
+            for snapshot in get_progress(redis_client, [job_id]).values():
+                yield sse_event(json.dumps(snapshot))
+        start = last_event = time.time()
+        while time.time() - start < timeout:
+            # only checks the socket, it does not query Redis
+            message = pubsub.get_message()
+            if message is None:
+                time.sleep(poll_interval)
+            elif message['type'] == 'message':
+                data = message['data'].decode('utf-8')
+                if job_id is None or json.loads(data)['job_id'] == job_id:
+                    last_event = time.time()
+                    yield sse_event(data)
+            if time.time() - last_event >= keepalive_interval:
+                last_event = time.time()
+                # a comment keeps proxies from closing an idle connection
+                yield ': keepalive\n\n'
+    finally:
+        pubsub.close()
+
+
+def sse_event(data, event='progress'):
+    return 'event: %s\ndata: %s\n\n' % (event, data)
@@ -1,3 +1,4 @@
 #!/bin/bash
 source activate s3dt_catalog
-exec honcho start
+# two workers, so that the updates of a full sync run in parallel
+exec honcho start -c worker=2
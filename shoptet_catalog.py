@@ -1,62 +1,149 @@
+import codecs
 import csv
+import io
+import time
+from contextlib import closing
 
 import requests
-from pymongo import MongoClient
 
+import store
+from item_store import ItemWriter
 
-def download_shoptet_catalog_to_mongo(mongo_uri, catalog_url):
-    catalog_str = download_shoptet_catalog(catalog_url)
-    items = parse_catalog_csv(catalog_str)
-    update_items_in_mongo(items, mongo_uri)
-    return len(items)
+CATALOG_ENCODING = 'cp1250'
 
 
-def download_shoptet_catalog(catalog_url):
+def download_shoptet_catalog_to_mongo(store_uri, catalog_url, batch_size=1000, counter=None):
     """
-    Downloads the catalog CSV from Shoptet, decodes it and returns the string.
+    Streams the catalog CSV from Shoptet to the store, the memory does not
+    depend on the size of the catalog.
+
+    Returns the number of items in the catalog and the number
+    of documents inserted or modified in MongoDB.
+    """
+    with closing(requests.get(catalog_url, stream=True)) as response:
+        response.raise_for_status()
+        lines = iter_decoded_lines(response.iter_content(chunk_size=64 * 1024), counter)
+        return update_items_in_mongo(iter_catalog_csv(lines), store_uri, batch_size, counter)
+
+
+def iter_decoded_lines(chunks, counter=None, encoding=CATALOG_ENCODING):
+    """
+    Decodes a stream of byte chunks incrementally and generates the text
+    lines including their line endings, as expected by csv.reader().
+    The downloaded bytes and the time waiting for them are reported
+    to the counter.
     """
-    response = requests.get(catalog_url)
-    return response.content.decode('cp1250')
+    decoder = codecs.getincrementaldecoder(encoding)()
+    partial_line = ''
+    start = time.time()
+    for chunk in chunks:
+        if counter is not None:
+            counter.download_finished(len(chunk), time.time() - start)
+        lines = (partial_line + decoder.decode(chunk)).split('\n')
+        partial_line = lines.pop()
+        for line in lines:
+            yield line + '\n'
+        start = time.time()
+    partial_line += decoder.decode(b'', final=True)
+    if partial_line:
+        yield partial_line
 
 
 def parse_catalog_csv(catalog_csv_str):
     """
     Parses the CSV into a list of items (each is a dict).
     """
-    lines = catalog_csv_str.split('\r\n')
+    return list(iter_catalog_csv(io.StringIO(catalog_csv_str, newline='')))
+
+
+def iter_catalog_csv(lines):
+    """
+    Parses the CSV lines into items (each is a dict).
+    Quoted fields may span multiple lines.
+    """
+    rows = csv.reader(lines, delimiter=';')
 
     # input columns: code;pairCode;name;productVisibility;
     # output columns: CODE;VISIBLE
-    columns = lines[0].strip().split(';')
+    columns = [column.strip() for column in next(rows)]
     code_index = columns.index('code')
     visibility_index = columns.index('productVisibility')
     availability_in_stock_index = columns.index('availabilityInStock')
 
     # we extract product id, visibility
-    return [
-        {
-            'CODE': row[code_index],
-            'VISIBLE': row[visibility_index] == 'visible',
-            'AVAILABILITY_IN_STOCK': row[availability_in_stock_index]
-        }
-        for row in csv.reader(lines[1:], delimiter=';')
-        if len(row) >= 4
-    ]
-
-
-def update_items_in_mongo(items, mongo_uri):
-    mongo = MongoClient(mongo_uri)
-    db = mongo.get_default_database()
-    item_collection = db.items
-    item_collection.create_index("code")
+    for row in rows:
+        if len(row) >= 4:
+            yield {
+                'CODE': row[code_index],
+                'VISIBLE': row[visibility_index] == 'visible',
+                'AVAILABILITY_IN_STOCK': row[availability_in_stock_index]
+            }
 
+
+def update_items_in_mongo(items, store_uri, batch_size=1000, counter=None):
+    """
+    Stores the items from Shoptet. New items and items whose visibility
+    or availability has changed are marked by a new change_seq.
+    The items may be a generator, they are written in batches.
+    """
+    item_store = store.get_item_store(store_uri)
+    change_seq = item_store.next_change_seq()
     item_count = 0
 
-    for item in items:
-        item_count += 1
-        item_collection.update(
-            {'code': item['CODE']},
-            {'$set': {'code': item['CODE'], 'shoptet': item}},
-            upsert=True)
+    try:
+        with ShoptetWriter(item_store, change_seq, batch_size, counter) as writer:
+            for item in items:
+                item_count += 1
+                writer.add(item)
+    finally:
+        item_store.commit_change_seq(change_seq)
+
+    if counter is not None:
+        counter.finished()
+    return item_count, writer.changed_count
+
+
+class ShoptetWriter(ItemWriter):
+    """
+    ItemWriter of the Shoptet items. Each batch is compared against the
+    stored states of its codes only, so the memory does not depend on the
+    size of the catalog.
+
+    change_seq - marks the new items and the items whose visibility
+        or availability has changed
+    """
+
+    def __init__(self, item_store, change_seq, batch_size=1000, counter=None):
+        super(ShoptetWriter, self).__init__(item_store, batch_size, counter)
+        self.change_seq = change_seq
+
+    def write_batch(self, items):
+        stored_items = self.item_store.get_by_codes([item['CODE'] for item in items], ['shoptet'])
+        stored_states = {doc['code']: shoptet_state(doc['shoptet']) for doc in stored_items if doc.get('shoptet')}
+        upserts = []
+        for item in items:
+            fields = {'code': item['CODE'], 'shoptet': item}
+            stored_state = stored_states.get(item['CODE'])
+            if stored_state != shoptet_state(item):
+                fields['change_seq'] = self.change_seq
+            if self.counter is not None:
+                count_item(self.counter, stored_state, 'change_seq' in fields)
+            # a code repeated within the batch is compared against its last version
+            stored_states[item['CODE']] = shoptet_state(item)
+            upserts.append((item['CODE'], fields))
+        return super(ShoptetWriter, self).write_batch(upserts)
+
+
+def shoptet_state(item):
+    return item.get('VISIBLE'), item.get('AVAILABILITY_IN_STOCK')
+
 
-    return item_count
+def count_item(counter, stored_item, is_changed):
+    counter.item_visited()
+    counter.item_selected()
+    if stored_item is None:
+        counter.item_inserted()
+    elif is_changed:
+        counter.item_updated()
+    else:
+        counter.item_unchanged()
@@ -0,0 +1,122 @@
+"""
+Access to the MongoDB database of the catalog.
+
+All the entry points - the web app, the worker jobs and the command line
+tools - share a single pooled MongoClient per process instead of connecting
+on each request or job. The indexes are created once per process, at the
+startup of the web app and the worker.
+
+MongoClient is not fork-safe, so a forked process (an RQ work horse,
+a worker of the parallel ingest) gets its own client.
+
+Configured by environment variables:
+
+MONGO_URI - including the database name, mongodb://localhost/s3dt_catalog by default
+MONGO_MAX_POOL_SIZE - maximum number of connections of the process
+MONGO_CONNECT_TIMEOUT_MS, MONGO_SOCKET_TIMEOUT_MS, MONGO_SERVER_SELECTION_TIMEOUT_MS
+MONGO_WRITE_CONCERN - number of acknowledging nodes (eg. 1) or 'majority'
+MONGO_JOURNAL - wait for the journal commit of the writes (true/false)
+
+The pymongo defaults apply to the options which are not set.
+
+STORE_URI - where the products are stored (see item_store), MONGO_URI
+    by default, eg. sqlite:///data/catalog.db for an embedded SQLite database
+"""
+
+import os
+
+from pymongo import MongoClient
+
+from item_store import MongoItemStore, SqliteItemStore, is_sqlite_uri, sqlite_path
+
+DEFAULT_MONGO_URI = 'mongodb://localhost/s3dt_catalog'
+
+mongo_uri = os.environ.get('MONGO_URI') or DEFAULT_MONGO_URI
+store_uri = os.environ.get('STORE_URI') or mongo_uri
+
+# (pid, uri) -> MongoClient
+_clients = {}
+# (pid, uri) -> ItemStore
+_item_stores = {}
+# URIs of the stores whose indexes have been created by this process (or its parent)
+_indexed_stores = set()
+
+
+def client_options(environ=os.environ):
+    """MongoClient keyword arguments from the environment."""
+    options = {}
+    for (name, option) in [('MONGO_MAX_POOL_SIZE', 'maxPoolSize'),
+                           ('MONGO_CONNECT_TIMEOUT_MS', 'connectTimeoutMS'),
+                           ('MONGO_SOCKET_TIMEOUT_MS', 'socketTimeoutMS'),
+                           ('MONGO_SERVER_SELECTION_TIMEOUT_MS', 'serverSelectionTimeoutMS')]:
+        if environ.get(name):
+            options[option] = int(environ[name])
+    write_concern = environ.get('MONGO_WRITE_CONCERN')
+    if write_concern:
+        options['w'] = int(write_concern) if write_concern.isdigit() else write_concern
+    if environ.get('MONGO_JOURNAL'):
+        options['j'] = environ['MONGO_JOURNAL'].lower() in ('1', 'true', 'yes')
+    return options
+
+
+def get_client(uri=None):
+    """
+    Returns the shared client of this process for the URI
+    (MONGO_URI by default), it is created on the first use.
+    """
+    key = (os.getpid(), uri or mongo_uri)
+    client = _clients.get(key)
+    if client is None:
+        # drop the clients inherited from the parent process
+        for inherited_key in [k for k in _clients if k[0] != key[0]]:
+            del _clients[inherited_key]
+        client = _clients[key] = MongoClient(key[1], **client_options())
+    return client
+
+
+def get_database(uri=None):
+    """The database given in the URI (MONGO_URI by default)."""
+    return get_client(uri).get_default_database()
+
+
+def item_collection(uri=None):
+    """The collection of the merged ED and Shoptet products."""
+    return get_database(uri).items
+
+
+def get_item_store(uri=None):
+    """
+    Returns the shared ItemStore of this process for the URI (STORE_URI
+    by default) - SQLite for a sqlite:// URI, MongoDB otherwise. Its
+    indexes are created on the first use.
+    """
+    key = (os.getpid(), uri or store_uri)
+    item_store = _item_stores.get(key)
+    if item_store is None:
+        for inherited_key in [k for k in _item_stores if k[0] != key[0]]:
+            del _item_stores[inherited_key]
+        if is_sqlite_uri(key[1]):
+            item_store = SqliteItemStore(sqlite_path(key[1]))
+        else:
+            item_store = MongoItemStore(get_database(key[1]))
+        _item_stores[key] = item_store
+    if key[1] not in _indexed_stores:
+        item_store.create_indexes()
+        _indexed_stores.add(key[1])
+    return item_store
+
+
+def ensure_indexes(uri=None):
+    """Creates the indexes of the store unless already done by this process."""
+    get_item_store(uri)
+
+
+def close():
+    """Closes the clients and stores of this process (eg. at the end of a CLI run)."""
+    pid = os.getpid()
+    for key in [k for k in _item_stores if k[0] == pid]:
+        item_store = _item_stores.pop(key)
+        if isinstance(item_store, SqliteItemStore):
+            item_store.close()
+    for key in [k for k in _clients if k[0] == pid]:
+        _clients.pop(key).close()
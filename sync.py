@@ -0,0 +1,90 @@
+"""
+Full sync of the catalog: the ED and Shoptet catalogs are updated by two
+jobs in parallel (on separate workers) and then the export job writes the
+Shoptet import XML.
+
+RQ can make a job depend on a single other job only, so the export depends
+on both updates via a counter in Redis: each update decrements it when
+finished and the one which gets to zero enqueues the export. If an update
+fails the export is never enqueued.
+"""
+
+import time
+import uuid
+
+from rq import Queue
+
+# the updates which have to finish before the export
+SYNC_STAGES = ('ed', 'shoptet')
+# recent syncs shown in the UI
+MAX_SYNCS = 20
+SYNC_TTL = 7 * 24 * 3600
+SYNCS_KEY = 's3dt:syncs'
+
+
+def sync_key(sync_id):
+    return 's3dt:sync:%s' % sync_id
+
+
+def pending_key(sync_id):
+    return 's3dt:sync:%s:pending' % sync_id
+
+
+def start_sync(redis_client, job_timeout):
+    """Enqueues the updates of a new full sync. Returns its id."""
+    sync_id = uuid.uuid4().hex
+    state = {
+        'started_at': time.time(),
+        'job_timeout': job_timeout,
+        'ed_job_id': str(uuid.uuid4()),
+        'shoptet_job_id': str(uuid.uuid4()),
+    }
+    # the state is written before the updates are enqueued, so that
+    # stage_finished() finds it even if a worker takes a job right away
+    pipe = redis_client.pipeline()
+    pipe.set(pending_key(sync_id), len(SYNC_STAGES), ex=SYNC_TTL)
+    pipe.hmset(sync_key(sync_id), state)
+    pipe.expire(sync_key(sync_id), SYNC_TTL)
+    pipe.lpush(SYNCS_KEY, sync_id)
+    pipe.ltrim(SYNCS_KEY, 0, MAX_SYNCS - 1)
+    pipe.execute()
+    queue = Queue(connection=redis_client)
+    # the functions are referenced by name, tasks imports this module
+    queue.enqueue('tasks.update_ed_catalog', sync_id=sync_id, timeout=job_timeout, job_id=state['ed_job_id'])
+    queue.enqueue('tasks.update_shoptet_catalog', sync_id=sync_id, timeout=job_timeout,
+                  job_id=state['shoptet_job_id'])
+    return sync_id
+
+
+def stage_finished(redis_client, sync_id, stage):
+    """
+    Called by each update job once it succeeded. The last one enqueues
+    the export.
+    """
+    redis_client.hset(sync_key(sync_id), '%s_finished_at' % stage, time.time())
+    if redis_client.decr(pending_key(sync_id)) != 0:
+        return None
+    job_timeout = int(redis_client.hget(sync_key(sync_id), 'job_timeout') or 600)
+    export_job = Queue(connection=redis_client).enqueue(
+        'tasks.export_catalog_job', sync_id=sync_id, timeout=job_timeout)
+    redis_client.hset(sync_key(sync_id), 'export_job_id', export_job.id)
+    print('sync %s: all updates finished, enqueued export %s' % (sync_id, export_job.id))
+    return export_job
+
+
+def set_sync_fields(redis_client, sync_id, **fields):
+    redis_client.hmset(sync_key(sync_id), fields)
+
+
+def get_sync(redis_client, sync_id):
+    """Returns the state of the sync as a dict or None if unknown."""
+    state = redis_client.hgetall(sync_key(sync_id))
+    if not state:
+        return None
+    state = dict((key.decode('utf-8'), value.decode('utf-8')) for (key, value) in state.items())
+    state['id'] = sync_id
+    return state
+
+
+def recent_sync_ids(redis_client):
+    return [sync_id.decode('utf-8') for sync_id in redis_client.lrange(SYNCS_KEY, 0, MAX_SYNCS - 1)]
@@ -0,0 +1,203 @@
+"""
+Generator of synthetic ED catalogs for benchmarks and tests.
+
+The products have all the fields of the real ED feed, with values varied
+the same way (price levels, VAT rates, stock ranges, EAN lengths, statuses),
+so that every branch of convert_item() is exercised. A given seed always
+produces the same catalog.
+"""
+
+import argparse
+import io
+import random
+import zipfile
+from xml.sax.saxutils import escape
+
+import ed_catalog
+
+CATALOG_HEADER = '''<?xml version="1.0" encoding="utf-8"?>
+<ResponseProductList>
+  <Status>
+    <StatusCode />
+    <ErrorText />
+  </Status>
+  <ProductList>
+'''
+
+CATALOG_FOOTER = '''  </ProductList>
+  <AddressId>1055541</AddressId>
+  <Count>%d</Count>
+  <GeneratedDate>2015-01-30T12:55:38.0327916+01:00</GeneratedDate>
+</ResponseProductList>
+'''
+
+PRODUCT_TEMPLATE = '''    <Product>
+       <ProId>%(pro_id)d</ProId>
+       <Code>%(code)s</Code>
+       <Name>%(name)s</Name>
+       <YourPrice>%(your_price)s</YourPrice>
+       <YourPriceWithFees>%(your_price_with_fees)s</YourPriceWithFees>
+       <CommodityCode>%(commodity_code)s</CommodityCode>
+       <GarbageFee>%(garbage_fee)s</GarbageFee>
+       <AuthorFee>0.00</AuthorFee>
+       <ValuePack>0.000000</ValuePack>
+       <ValuePackQty>0.000</ValuePackQty>
+       <Warranty>%(warranty)s</Warranty>
+       <CommodityName>%(commodity_name)s</CommodityName>
+       <DealerPrice>%(end_user_price)s</DealerPrice>
+       <EndUserPrice>%(end_user_price)s</EndUserPrice>
+       <Vat>%(vat)s</Vat>
+       <PartNumber>%(part_number)s</PartNumber>
+       <OnStock>%(on_stock)s</OnStock>
+       <OnStockText>%(on_stock_text)s</OnStockText>
+       <Status>%(status)s</Status>
+       <ImageUrl>http://www.edsystem.cz/IMGCACHE/_%(image_dir)s/%(pro_id)d_0a_3.jpg</ImageUrl>
+       <ProducerName>%(producer)s</ProducerName>
+       <RateOfDutyCode>84433210</RateOfDutyCode>
+       <EANCode>%(ean)s</EANCode>
+       <Description>%(description)s</Description>
+     </Product>
+'''
+
+# (CommodityName, CommodityCode) - the first one is selected by the default filter
+SELECTED_COMMODITY = ('3D TISK', '3DP')
+OTHER_COMMODITIES = [
+    ('NOTEBOOKY', 'NTB'),
+    ('MONITORY', 'MON'),
+    ('TISKÁRNY', 'PRN'),
+    ('SPOTŘEBNÍ MATERIÁL', 'SPM'),
+    ('PŘÍSLUŠENSTVÍ', 'PRI'),
+]
+PRODUCERS = ['MakerBot', 'Prusa Research', 'Ultimaker', 'XYZprinting', 'Zortrax', 'Formlabs', 'Verbatim']
+PRODUCT_KINDS = ['3D tiskárna', 'Filament PLA', 'Filament ABS', 'Tisková hlava', 'Podložka', 'Skener']
+STATUSES = ['', '', '', 'Novinka', 'Doprodej', 'TOP Produkt']
+VAT_RATES = ['21.00', '21.00', '21.00', '15.00', '10.00']
+WARRANTIES = ['24 Měsíc(ů)', '12 Měsíc(ů)', '36 Měsíc(ů)']
+DESCRIPTION_LINES = [
+    'Print technology: Fused deposition modeling',
+    'Rozměry: šxvxh (cm) 49.3x56.5x85.4',
+    'Hmotnost (kg): 41',
+    'Maximální rozměry tisku (cm): 30.5x30.5x45.7',
+    'Connectivity: WI-FI, USB, ETHERNET',
+    'Software: MakerBot Desktop (STL, OBJ, THING, MAKERBOT)',
+    'Kontrola tisku přes mobilní aplikaci',
+]
+
+
+def generate_catalog(output_file, num_products, selected_ratio=0.5, seed=0):
+    """
+    Writes a catalog XML with num_products products to a text file-like.
+    About selected_ratio of them belong to the 3D print category.
+    """
+    rng = random.Random(seed)
+    output_file.write(CATALOG_HEADER)
+    for i in range(num_products):
+        output_file.write(PRODUCT_TEMPLATE % random_product(rng, i, rng.random() < selected_ratio))
+    output_file.write(CATALOG_FOOTER % num_products)
+
+
+def random_product(rng, index, is_selected):
+    pro_id = 100000 + index
+    commodity_name, commodity_code = SELECTED_COMMODITY if is_selected else rng.choice(OTHER_COMMODITIES)
+    producer = rng.choice(PRODUCERS)
+    your_price = rng.randint(50, 200000)
+    garbage_fee = rng.choice([0, 0, 12, 45])
+    return {
+        'pro_id': pro_id,
+        # codes are unique, some are numeric, some alphanumeric
+        'code': '%d' % (400000 + index) if index % 3 else 'SYN-%07d' % index,
+        'name': escape('%s %s %d' % (rng.choice(PRODUCT_KINDS), producer, index)),
+        'your_price': '%d.00' % your_price,
+        'your_price_with_fees': '%d.00' % (your_price + garbage_fee),
+        'commodity_code': commodity_code,
+        'commodity_name': escape(commodity_name),
+        'garbage_fee': '%d.00' % garbage_fee,
+        'warranty': escape(rng.choice(WARRANTIES)),
+        'end_user_price': '%d.00' % (your_price * rng.choice([108, 115, 125]) // 100),
+        'vat': rng.choice(VAT_RATES),
+        'part_number': 'PN-%06d' % rng.randint(0, 999999),
+        'on_stock': rng.choice(['true', 'false']),
+        'on_stock_text': random_stock_text(rng),
+        'status': rng.choice(STATUSES),
+        'image_dir': '%03d' % (pro_id // 1000 % 1000),
+        'producer': escape(producer),
+        'ean': random_ean(rng),
+        # the description is HTML escaped within the XML, some are empty
+        'description': escape(random_description(rng)),
+    }
+
+
+def random_stock_text(rng):
+    kind = rng.random()
+    if kind < 0.4:
+        return '%d,00' % rng.randint(0, 9)
+    elif kind < 0.8:
+        return rng.choice(['10-49', '50-99'])
+    return '100+'
+
+
+def random_ean(rng):
+    length = rng.choice([0, 6, 13, 13, 13, 14, 15])
+    return ''.join(str(rng.randint(0, 9)) for _ in range(length))
+
+
+def random_description(rng):
+    if rng.random() < 0.1:
+        return ''
+    lines = rng.sample(DESCRIPTION_LINES, rng.randint(1, len(DESCRIPTION_LINES)))
+    return '<p>%s</p>' % '<br />'.join(lines)
+
+
+def write_catalog_files(xml_path, num_products, selected_ratio=0.5, seed=0, zip_path=None):
+    """
+    Generates the catalog to xml_path and optionally compresses it
+    to a ZIP archive at zip_path, like the one served by ED.
+    """
+    with open(xml_path, 'w', encoding='utf-8') as xml_file:
+        generate_catalog(xml_file, num_products, selected_ratio, seed)
+    if zip_path is not None:
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.write(xml_path, 'edsystem_public_catalog.xml')
+
+
+# unusual values mixed into the items generated by generate_convert_items()
+EDGE_VALUES = {
+    'Vat': ['21', '21.00', '15.00', '10.00', '0', '0.00', '12.5', '20.49', '20.50'],
+    'OnStockText': ['0,00', '7,00', '10-49', '50-99', '100+', '', '12', 'neuvedeno', '3,5', '5+', '1-'],
+    'Description': [None, '', 'Popis'],
+    'Status': [None, '', 'Novinka', 'Doprodej', 'TOP Produkt', 'Jiný'],
+    'OnStock': ['true', 'false', None],
+}
+
+
+def generate_convert_items(num_items, seed=0):
+    """
+    Parsed items of a synthetic catalog, a half of them with some fields
+    replaced by edge cases (EAN codes of any length, fractional prices...).
+    """
+    catalog = io.StringIO()
+    generate_catalog(catalog, num_items, 1.0, seed)
+    items = []
+    ed_catalog.process_catalog(io.BytesIO(catalog.getvalue().encode('utf-8')), items.append, 'lxml')
+    rng = random.Random(seed)
+    for item in items[::2]:
+        for (field, values) in EDGE_VALUES.items():
+            if rng.random() < 0.5:
+                item[field] = rng.choice(values)
+        item['EANCode'] = ''.join(str(rng.randint(0, 9)) for _ in range(rng.randint(0, 16)))
+        item['EndUserPrice'] = '%d.%03d' % (rng.randint(0, 100000), rng.randint(0, 999))
+        item['YourPriceWithFees'] = '%d.%03d' % (rng.randint(0, 100000), rng.randint(0, 999))
+    return items
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic ED catalog.')
+    parser.add_argument('output_xml', help='Path to the generated catalog XML')
+    parser.add_argument('-n', '--products', type=int, default=10000, help='Number of products')
+    parser.add_argument('-s', '--selected-ratio', type=float, default=0.5,
+                        help='Fraction of products in the 3D print category')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-z', '--zip', help='Path to a ZIP archive with the catalog')
+    args = parser.parse_args()
+
+    write_catalog_files(args.output_xml, args.products, args.selected_ratio, args.seed, args.zip)
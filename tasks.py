@@ -1,23 +1,96 @@
+import json
 import os
 import time
 
 from rq import Connection, get_current_job
 
+import store
 import worker
-from ed_catalog import get_ed_catalog_url, download_ed_catalog_to_mongo, Counter
+from download_cache import DownloadCache
+from ed_catalog import get_ed_catalog_url, download_ed_catalog_to_mongo, CategoryFilter, Counter
+from export_artifacts import ExportArtifacts
+from parallel_ingest import download_ed_catalog_to_mongo_parallel
+from pipeline import PipelineCancelled
+from progress import ProgressPublisher
 from shoptet_catalog import download_shoptet_catalog_to_mongo
+from sync import set_sync_fields, stage_finished
 
-# localhost if not defined
-mongo_uri = os.environ.get('MONGO_URI')
+# number of upserts sent to MongoDB in a single bulk write
+mongo_batch_size = int(os.environ.get('MONGO_BATCH_SIZE', 1000))
+# default ED catalog parser, see ed_catalog.PARSER_ENGINES
+ed_parser_engine = os.environ.get('ED_PARSER_ENGINE', 'xmltodict')
+# number of processes ingesting the ED catalog, 1 means a single-process ingest
+ed_ingest_workers = int(os.environ.get('ED_INGEST_WORKERS', 1))
+# store also the whole raw ED items (zlib compressed), not just the used fields
+ed_store_raw = os.environ.get('ED_STORE_RAW', '').lower() in ('1', 'true', 'yes')
 
 
-def update_ed_catalog():
+def env_list(name, default):
+    """Reads a comma-separated list from an environment variable."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return [part.strip() for part in value.split(',') if part.strip()]
+
+
+# the ED catalog is downloaded (and ingested) only if it has changed,
+# an empty ED_DOWNLOAD_CACHE_DIR disables the cache
+ed_download_cache_dir = os.environ.get('ED_DOWNLOAD_CACHE_DIR', 'data/download_cache')
+ed_download_cache = DownloadCache(
+    ed_download_cache_dir,
+    max_size=int(os.environ.get('ED_DOWNLOAD_CACHE_MAX_SIZE', 1024 ** 3))
+) if ed_download_cache_dir else None
+
+# minimum number of seconds between two progress updates of a job
+progress_interval = float(os.environ.get('PROGRESS_INTERVAL', 1.0))
+
+# where the exported Shoptet import XML files are written
+export_dir = os.environ.get('EXPORT_DIR', 'data/exports')
+# the newest exports which are kept
+export_artifacts = ExportArtifacts(export_dir, keep=int(os.environ.get('EXPORT_KEEP', 5)))
+# validate each exported product by the RelaxNG schema
+export_validate = os.environ.get('EXPORT_VALIDATE', 'true').lower() in ('1', 'true', 'yes')
+
+# where the profiles and metrics traces of the profiled ED ingests are saved
+ed_profile_dir = os.environ.get('ED_PROFILE_DIR', 'data/profiles')
+
+# ED products selected by their category
+ed_category_filter = CategoryFilter(
+    names=env_list('ED_COMMODITY_NAMES', ['3D TISK']),
+    codes=env_list('ED_COMMODITY_CODES', ['3DP']))
+
+
+def cancel_key(job_id):
+    """
+    Redis key flagging a running job to be cancelled. RQ itself only
+    removes a cancelled job from the queue, a running job must stop itself.
+    """
+    return 's3dt:cancel:%s' % job_id
+
+
+def is_job_cancelled(job):
+    return bool(worker.redis_client.exists(cancel_key(job.id)))
+
+
+def update_ed_catalog(parser_engine=None, num_workers=None, profile=False, sync_id=None):
+    """
+    profile - save the cProfile stats of the ingest (single-process only)
+        and a JSON trace with the metrics to ED_PROFILE_DIR
+    sync_id - the full sync this update is part of, if any
+    """
     job = get_current_job()
     job.meta['name'] = 'Update from ED catalog'
+    parser_engine = parser_engine or ed_parser_engine
+    job.meta['parser_engine'] = parser_engine
+    num_workers = num_workers or ed_ingest_workers
+    job.meta['ingest_workers'] = num_workers
+    job.meta['category_filter'] = repr(ed_category_filter)
+    progress = ProgressPublisher(worker.redis_client, job.id)
 
     def set_job_progress(state):
         job.meta['progress'] = state
         job.save()
+        progress.publish(progress=state)
 
     with Connection(worker.redis_client):
         start = time.time()
@@ -32,33 +105,149 @@ def update_ed_catalog():
         print('Downloading catalog from:', catalog_url)
 
         def counter_report(counter):
-            print('ED progress: Processed: %d, selected: %d' % (counter.total, counter.selected))
+            print('ED progress: Processed: %d, selected: %d (unchanged: %d, updated: %d, inserted: %d)' % (
+                counter.total, counter.selected, counter.unchanged, counter.updated, counter.inserted))
+            # the job itself is saved only once finished
+            progress.publish(
+                total_items=counter.total, selected_items=counter.selected, unchanged_items=counter.unchanged,
+                updated_items=counter.updated, inserted_items=counter.inserted,
+                downloaded_bytes=counter.bytes_downloaded)
+
+        def save_metrics():
             job.meta['total_items'] = counter.total
             job.meta['selected_items'] = counter.selected
-            job.save()
+            job.meta['metrics'] = counter.metrics()
+
+        profile_path = None
+        if profile:
+            os.makedirs(ed_profile_dir, exist_ok=True)
+            if num_workers == 1:
+                profile_path = os.path.join(ed_profile_dir, '%s.prof' % job.id)
+                job.meta['profile'] = profile_path
 
-        counter = Counter(report=counter_report, report_period=1000)
-        download_ed_catalog_to_mongo(mongo_uri, catalog_url, counter)
-        set_job_progress('catalog processed')
+        counter = Counter(report=counter_report, report_period=100, report_interval=progress_interval)
+        try:
+            if num_workers > 1:
+                is_ingested = download_ed_catalog_to_mongo_parallel(
+                    store.store_uri, catalog_url, counter, num_workers, mongo_batch_size, parser_engine,
+                    ed_category_filter, ed_download_cache, store_raw=ed_store_raw,
+                    is_cancelled=lambda: is_job_cancelled(job))
+            else:
+                is_ingested = download_ed_catalog_to_mongo(
+                    store.store_uri, catalog_url, counter, mongo_batch_size, parser_engine,
+                    ed_category_filter, ed_download_cache, is_cancelled=lambda: is_job_cancelled(job),
+                    profile_path=profile_path, store_raw=ed_store_raw)
+        except PipelineCancelled:
+            save_metrics()
+            set_job_progress('cancelled')
+            return
+        finally:
+            # also a cancelled or failed ingest keeps the batches written so far
+            if counter.changed > 0:
+                job.meta['data_version'] = data_changed()
+            if profile:
+                job.meta['trace'] = save_metrics_trace(job, counter)
+        save_metrics()
+        set_job_progress('catalog processed' if is_ingested else 'catalog not changed, skipped')
 
         end = time.time()
         job.meta['elapsed_time'] = '%.3f sec' % (end - start)
         job.save()
+    if sync_id is not None:
+        stage_finished(worker.redis_client, sync_id, 'ed')
+
+
+def data_changed():
+    """Bumps the data version, so that the next export is rebuilt."""
+    return store.get_item_store().bump_data_version()
 
 
-def update_shoptet_catalog():
+def save_metrics_trace(job, counter):
+    trace_path = os.path.join(ed_profile_dir, '%s.json' % job.id)
+    with open(trace_path, 'w') as trace_file:
+        json.dump({'job_id': job.id, 'meta': job.meta, 'metrics': counter.metrics()}, trace_file, indent=2)
+    print('metrics trace saved to', trace_path)
+    return trace_path
+
+
+def update_shoptet_catalog(sync_id=None):
     with Connection(worker.redis_client):
         start = time.time()
         job = get_current_job()
         job.meta['name'] = 'Update from Shoptet catalog'
+        progress = ProgressPublisher(worker.redis_client, job.id)
 
         catalog_url = os.environ.get('SHOPTET_CATALOG_URI')
         job.meta['catalog_url'] = catalog_url
+        progress.publish(progress='processing the catalog CSV')
         print('Downloading Shoptet catalog from:', catalog_url)
-        item_count = download_shoptet_catalog_to_mongo(mongo_uri, catalog_url)
-        print('Obtained %d items. Done.' % item_count)
+
+        def counter_report(counter):
+            print('Shoptet progress: Processed: %d (unchanged: %d, updated: %d, inserted: %d)' % (
+                counter.total, counter.unchanged, counter.updated, counter.inserted))
+            progress.publish(
+                total_items=counter.total, unchanged_items=counter.unchanged, updated_items=counter.updated,
+                inserted_items=counter.inserted, downloaded_bytes=counter.bytes_downloaded)
+
+        counter = Counter(report=counter_report, report_period=1000, report_interval=progress_interval)
+        try:
+            item_count, changed_count = download_shoptet_catalog_to_mongo(
+                store.store_uri, catalog_url, mongo_batch_size, counter)
+        finally:
+            # also a failed update keeps the batches written so far
+            if counter.changed > 0:
+                job.meta['data_version'] = data_changed()
+        print('Obtained %d items (%d changed). Done.' % (item_count, changed_count))
 
         end = time.time()
+        job.meta['progress'] = 'catalog processed'
         job.meta['elapsed_time'] = '%.3f sec' % (end - start)
         job.meta['total_items'] = item_count
+        job.meta['changed_items'] = changed_count
+        job.meta['metrics'] = counter.metrics()
+        job.save()
+        progress.publish(progress='catalog processed', total_items=item_count)
+    if sync_id is not None:
+        stage_finished(worker.redis_client, sync_id, 'shoptet')
+
+
+def export_catalog_job(sync_id=None):
+    """
+    Builds the export artifact of the current data version in EXPORT_DIR
+    unless it already exists.
+    """
+    with Connection(worker.redis_client):
+        start = time.time()
+        job = get_current_job()
+        job.meta['name'] = 'Export catalog to Shoptet'
+        progress = ProgressPublisher(worker.redis_client, job.id)
+        # the page of the sync shows the export once it starts
+        progress.publish(progress='exporting the catalog XML', sync_id=sync_id)
+
+        item_store = store.get_item_store()
+        version = item_store.get_data_version()
+        artifact = export_artifacts.get(version)
+        if artifact is None:
+            # read before the export, the changes made meanwhile (or by the ingests
+            # still running) are in the next delta
+            change_seq = item_store.get_committed_change_seq()
+            artifact = export_artifacts.build(version, item_store, change_seq, validate=export_validate)
+            export_artifacts.prune()
+            state = 'catalog exported'
+        else:
+            print('Export of data version %d already exists' % version)
+            state = 'catalog not changed, export skipped'
+
+        end = time.time()
+        job.meta['progress'] = state
+        job.meta['data_version'] = version
+        job.meta['artifact'] = artifact['file_name']
+        job.meta['elapsed_time'] = '%.3f sec' % (end - start)
+        job.meta['total_items'] = artifact['items']
+        job.meta['build_time'] = '%.3f sec' % artifact['build_time']
+        if 'validation' in artifact:
+            job.meta['validation'] = artifact['validation']
         job.save()
+        progress.publish(progress=state, total_items=artifact['items'])
+    if sync_id is not None:
+        set_sync_fields(worker.redis_client, sync_id, artifact=artifact['file_name'], finished_at=time.time())
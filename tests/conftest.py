@@ -0,0 +1,57 @@
+"""
+Shared fixtures of the tests.
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DATA_DIR = os.path.join(ROOT_DIR, 'resources', 'test')
+
+# the modules are at the top level of the repository
+sys.path.insert(0, ROOT_DIR)
+
+from item_store import MongoItemStore, SqliteItemStore  # noqa: E402
+
+
+def resource_path(file_name):
+    return os.path.join(TEST_DATA_DIR, file_name)
+
+
+@pytest.fixture(params=['sqlite', 'mongomock'])
+def item_store(request, tmpdir):
+    """An empty item store of each backend, MongoDB is emulated by mongomock."""
+    if request.param == 'sqlite':
+        item_store = SqliteItemStore(str(tmpdir.join('catalog.db')))
+    else:
+        mongomock = pytest.importorskip('mongomock')
+        item_store = MongoItemStore(mongomock.MongoClient()['s3dt_test'])
+    item_store.create_indexes()
+    yield item_store
+    if request.param == 'sqlite':
+        item_store.close()
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    """An empty fake Redis used as the connection of the worker and the app."""
+    try:
+        import fakeredis
+        import redis
+        import worker
+    except (ImportError, SyntaxError) as e:
+        pytest.skip('fake Redis is not available: %s' % e)
+
+    class FakeRedis(fakeredis.FakeStrictRedis, redis.StrictRedis):
+        pass
+
+    redis_client = FakeRedis()
+    redis_client.flushall()
+    monkeypatch.setattr(worker, 'redis_client', redis_client)
+    return redis_client
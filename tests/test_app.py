@@ -0,0 +1,54 @@
+import io
+
+import pytest
+
+import ed_catalog
+from conftest import resource_path
+from export_artifacts import ExportArtifacts
+
+try:
+    import app
+    import store
+    import tasks
+except ImportError as e:
+    pytest.skip('the app cannot be imported: %s' % e, allow_module_level=True)
+
+
+@pytest.fixture
+def item_store(tmpdir, monkeypatch):
+    """The default store of the app with the small catalog loaded."""
+    monkeypatch.setattr(store, 'store_uri', 'sqlite:///%s' % tmpdir.join('catalog.db'))
+    monkeypatch.setattr(tasks, 'export_artifacts', ExportArtifacts(str(tmpdir.join('exports'))))
+    item_store = store.get_item_store()
+    with open(resource_path('edsystem_catalog_small.xml'), 'rb') as catalog_xml:
+        ed_catalog.load_catalog_to_mongo(catalog_xml, item_store, ed_catalog.Counter(report=lambda counter: None),
+                                         parser_engine='lxml')
+    item_store.bump_data_version()
+    yield item_store
+    store.close()
+
+
+def expected_xml():
+    with io.open(resource_path('shoptet_catalog_small_expected.xml'), encoding='utf-8') as expected_file:
+        return expected_file.read()
+
+
+def test_catalog_serves_the_export_of_the_current_data(item_store):
+    client = app.app.test_client()
+    response = client.get('/catalog')
+    # generated live before the export is built
+    assert response.status_code == 200 and 'ETag' not in response.headers
+    assert response.data.decode('utf-8') == expected_xml()
+    assert response.headers['X-Change-Seq'] == str(item_store.get_committed_change_seq())
+
+    artifact = tasks.export_artifacts.build(item_store.get_data_version(), item_store,
+                                            item_store.get_committed_change_seq())
+    response = client.get('/catalog')
+    assert response.headers['ETag'].strip('"').startswith('v%d-' % artifact['version'])
+    assert response.data.decode('utf-8') == expected_xml()
+
+    # eg. a single update changed the data, the export is outdated
+    item_store.bump_data_version()
+    response = client.get('/catalog')
+    assert 'ETag' not in response.headers
+    assert response.data.decode('utf-8') == expected_xml()
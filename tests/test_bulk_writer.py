@@ -0,0 +1,69 @@
+from collections import namedtuple
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from bulk_writer import DUPLICATE_KEY_ERROR, BulkWriter
+
+Result = namedtuple('Result', ['inserted_count', 'upserted_count', 'modified_count'])
+
+
+class RacingCollection(object):
+    """
+    Rejects the upserts of the given codes once with a duplicate key error,
+    like when another ingest has inserted the same new item meanwhile.
+    """
+
+    def __init__(self, racing_codes):
+        self.racing_codes = set(racing_codes)
+        self.written = []
+
+    def bulk_write(self, operations, ordered=True):
+        errors = []
+        for (index, operation) in enumerate(operations):
+            code = operation._filter['code']
+            if code in self.racing_codes:
+                self.racing_codes.remove(code)
+                errors.append({'index': index, 'code': DUPLICATE_KEY_ERROR, 'errmsg': 'E11000 duplicate key'})
+            elif code == 'invalid':
+                errors.append({'index': index, 'code': 2, 'errmsg': 'invalid'})
+            else:
+                self.written.append(code)
+        if errors:
+            raise BulkWriteError({'writeErrors': errors, 'nUpserted': len(operations) - len(errors)})
+        return Result(0, len(operations), 0)
+
+
+def upserts(codes):
+    return [UpdateOne({'code': code}, {'$set': {'code': code}}, upsert=True) for code in codes]
+
+
+def test_duplicate_key_errors_are_retried():
+    collection = RacingCollection(['b', 'd'])
+    changed_count, errors = BulkWriter(collection).bulk_write(upserts(['a', 'b', 'c', 'd']))
+    assert changed_count == 4 and errors == []
+    assert collection.written == ['a', 'c', 'b', 'd']
+
+
+def test_other_errors_are_reported_with_their_index():
+    collection = RacingCollection(['b'])
+    changed_count, errors = BulkWriter(collection).bulk_write(upserts(['a', 'invalid', 'b']))
+    assert changed_count == 2
+    assert [error['index'] for error in errors] == [1]
+
+
+def test_retried_errors_keep_the_index_within_the_batch():
+    # rejected twice, the retry fails as well
+    collection = RacingCollection(['c'])
+    writer = BulkWriter(collection)
+    original_bulk_write = collection.bulk_write
+
+    def bulk_write(operations, ordered=True):
+        collection.racing_codes.add('c')
+        return original_bulk_write(operations, ordered)
+
+    collection.bulk_write = bulk_write
+    changed_count, errors = writer.bulk_write(upserts(['a', 'b', 'c']))
+    assert changed_count == 2
+    assert [(error['index'], error['code']) for error in errors] == [(2, DUPLICATE_KEY_ERROR)]
+    assert writer.write_batch(upserts(['c'])) == (0, 1)
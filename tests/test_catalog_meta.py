@@ -0,0 +1,45 @@
+import mongomock
+
+import catalog_meta
+import item_store as item_store_module
+
+
+def test_committed_change_seq_waits_for_earlier_ingests(item_store):
+    first, second = item_store.next_change_seq(), item_store.next_change_seq()
+    item_store.commit_change_seq(second)
+    # the first ingest may still write items marked by its sequence
+    assert item_store.get_change_seq() == 2 and item_store.get_committed_change_seq() == 0
+    item_store.commit_change_seq(first)
+    assert item_store.get_committed_change_seq() == 2
+
+
+def test_stale_pending_change_seq_is_ignored(item_store, monkeypatch):
+    item_store.next_change_seq()
+    # eg. the worker running the ingest was killed
+    monkeypatch.setattr(catalog_meta, 'PENDING_TIMEOUT', -1)
+    monkeypatch.setattr(item_store_module, 'PENDING_TIMEOUT', -1)
+    assert item_store.get_committed_change_seq() == 1
+
+
+def test_allocation_retried_after_a_concurrent_one():
+    db = mongomock.MongoClient().db
+    assert catalog_meta.next_change_seq(db) == 1
+
+    class RacingDb(object):
+        """Another ingest allocates a sequence right after the first read."""
+        def __init__(self):
+            self.meta = self
+            self.raced = False
+
+        def find_one(self, query):
+            doc = db.meta.find_one(query)
+            if not self.raced:
+                self.raced = True
+                assert catalog_meta.next_change_seq(db) == 2
+            return doc
+
+        def update_one(self, query, update):
+            return db.meta.update_one(query, update)
+
+    assert catalog_meta.next_change_seq(RacingDb()) == 3
+    assert [p['seq'] for p in db.meta.find_one({'_id': catalog_meta.CHANGE_SEQ_ID})['pending']] == [1, 2, 3]
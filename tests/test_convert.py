@@ -0,0 +1,26 @@
+import json
+
+import pytest
+
+import ed_catalog
+from synthetic_catalog import generate_convert_items
+
+
+@pytest.fixture(scope='module')
+def items():
+    # a half of them with edge cases (EAN codes of any length, fractional prices...)
+    return generate_convert_items(20000)
+
+
+def test_batch_convert_gives_the_same_items(items):
+    converted = ed_catalog.convert_items(items)
+    assert len(converted) == len(items)
+    mismatches = [item['Code'] for (item, actual) in zip(items, converted)
+                  if json.dumps(actual) != json.dumps(ed_catalog.convert_item(item))]
+    assert mismatches == []
+
+
+def test_batch_convert_does_not_modify_the_items(items):
+    copies = json.dumps(items[:100])
+    ed_catalog.convert_items(items[:100])
+    assert json.dumps(items[:100]) == copies
@@ -0,0 +1,140 @@
+"""
+The download cache against the /test/<file_name> route of the app, which
+serves the files from static/ with conditional and range requests.
+"""
+
+import os
+import threading
+
+import pytest
+
+import ed_catalog
+from download_cache import DownloadCache
+
+CATALOG_FILE = 'edsystem_public_catalog_small.zip'
+
+try:
+    import app
+    import store
+    from werkzeug import serving
+except ImportError as e:
+    pytest.skip('the app cannot be imported: %s' % e, allow_module_level=True)
+
+
+@pytest.fixture(scope='module')
+def server_url(tmpdir_factory):
+    # the app creates the indexes of the default store on the first request
+    default_store_uri, store.store_uri = store.store_uri, 'sqlite:///%s' % tmpdir_factory.mktemp('app').join('app.db')
+    server = serving.make_server('127.0.0.1', 0, app.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d/test/' % server.server_port
+    server.shutdown()
+    store.store_uri = default_store_uri
+
+
+@pytest.fixture
+def catalog_data():
+    with open(os.path.join(app.app.static_folder, CATALOG_FILE), 'rb') as catalog_file:
+        return catalog_file.read()
+
+
+def fetch(cache, url, **kwargs):
+    download = cache.fetch(url, chunk_size=100, **kwargs)
+    with open(download.path, 'rb') as cached_file:
+        return download, cached_file.read()
+
+
+def test_fetch_until_committed(tmpdir, server_url, catalog_data):
+    cache = DownloadCache(str(tmpdir))
+    url = server_url + CATALOG_FILE
+
+    download, data = fetch(cache, url, key='a')
+    assert (download.status, download.changed) == ('downloaded', True)
+    assert data == catalog_data
+
+    # not committed, eg. the ingest failed, the cached file is changed again
+    download, data = fetch(cache, url, key='a')
+    assert (download.status, download.changed) == ('not_modified', True)
+    assert data == catalog_data
+
+    cache.commit(download)
+    download, data = fetch(cache, url, key='a')
+    assert (download.status, download.changed) == ('not_modified', False)
+
+    # committed by another consumer only
+    assert fetch(cache, url, key='b')[0].changed
+    assert fetch(cache, url, key='a', force=True)[0].changed
+
+
+def test_resume_interrupted_download(tmpdir, server_url, catalog_data):
+    cache = DownloadCache(str(tmpdir))
+    url = server_url + CATALOG_FILE
+    download, _ = fetch(cache, url)
+    etag = cache._load_meta(url)['etag']
+    # an interrupted download of the half of the file
+    os.remove(download.path)
+    os.remove(cache._meta_path(url))
+    with open(cache._part_path(url), 'wb') as part_file:
+        part_file.write(catalog_data[:len(catalog_data) // 2])
+    cache._save_json(cache._part_path(url) + '.json', {'url': url, 'etag': etag, 'last_modified': None})
+
+    download, data = fetch(cache, url)
+    assert (download.status, download.changed) == ('resumed', True)
+    assert data == catalog_data
+
+
+def test_failed_ingest_is_repeated(tmpdir, server_url, monkeypatch):
+    store_uri = 'sqlite:///%s' % tmpdir.join('catalog.db')
+    cache = DownloadCache(str(tmpdir.join('cache')))
+    url = server_url + CATALOG_FILE
+
+    def ingest():
+        counter = ed_catalog.Counter(report=lambda counter: None)
+        is_ingested = ed_catalog.download_ed_catalog_to_mongo(
+            store_uri, url, counter, parser_engine='lxml', cache=cache)
+        return is_ingested, counter
+
+    def fail(*args):
+        raise IOError('write failed')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(ed_catalog, 'timed_changed_item_upsert', fail)
+        with pytest.raises(IOError):
+            ingest()
+
+    is_ingested, counter = ingest()
+    assert is_ingested and counter.download_cache_status == 'not_modified'
+    assert counter.inserted == 1
+    is_ingested, counter = ingest()
+    assert not is_ingested and counter.selected == 0
+
+    # a wiped store is loaded again
+    store.get_item_store(store_uri).drop()
+    is_ingested, counter = ingest()
+    assert is_ingested and counter.inserted == 1
+    store.close()
+
+
+def test_identical_catalog_is_not_ingested_again(tmpdir, server_url):
+    store_uri = 'sqlite:///%s' % tmpdir.join('catalog.db')
+    cache = DownloadCache(str(tmpdir.join('cache')))
+    url = server_url + CATALOG_FILE
+
+    def ingest():
+        counter = ed_catalog.Counter(report=lambda counter: None)
+        is_ingested = ed_catalog.download_ed_catalog_to_mongo(
+            store_uri, url, counter, parser_engine='lxml', cache=cache)
+        return is_ingested, counter
+
+    assert ingest()[0]
+    # without the validators the server sends the whole file again
+    meta = cache._load_meta(url)
+    meta['etag'] = meta['last_modified'] = None
+    cache._save_json(cache._meta_path(url), meta)
+
+    is_ingested, counter = ingest()
+    assert not is_ingested and counter.download_cache_status == 'unchanged'
+    assert counter.total == 0
+    store.close()
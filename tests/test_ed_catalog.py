@@ -0,0 +1,59 @@
+import os
+import time
+import zipfile
+
+import ed_catalog
+import store
+from conftest import resource_path
+
+
+def parse_items(engine, category_filter=None):
+    items = []
+    with open(resource_path('edsystem_catalog_small.xml'), 'rb') as catalog_xml:
+        ed_catalog.process_catalog(catalog_xml, items.append, engine, item_filter=category_filter)
+    return items
+
+
+def test_parser_engines_give_the_same_items():
+    results = {}
+    for engine in ed_catalog.PARSER_ENGINES:
+        start = time.time()
+        items = parse_items(engine)
+        elapsed = time.time() - start
+        print('%s: %d items, %.0f items/sec' % (engine, len(items), len(items) / elapsed if elapsed > 0 else 0))
+        results[engine] = items
+    assert results['xmltodict']
+    assert results['lxml'] == results['xmltodict']
+    # the converted items are the same as well
+    assert [ed_catalog.convert_item(item) for item in results['lxml']] == \
+        [ed_catalog.convert_item(item) for item in results['xmltodict']]
+
+
+def test_parser_engines_filter_by_category():
+    selected = [parse_items(engine, ed_catalog.DEFAULT_CATEGORY_FILTER) for engine in ed_catalog.PARSER_ENGINES]
+    assert selected[0] == selected[1]
+    assert all(ed_catalog.is_3d_print_item(item) for item in selected[0])
+
+
+def test_pipeline_ingest_reads_the_rest_of_a_zip(tmpdir, monkeypatch):
+    """The members after the catalog are downloaded, but not parsed."""
+    zip_path = str(tmpdir.join('catalog.zip'))
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as catalog_zip:
+        catalog_zip.write(resource_path('edsystem_catalog_small.xml'), 'catalog.xml')
+        # incompressible, more chunks than the download queue holds
+        catalog_zip.writestr('rest.bin', os.urandom(8 * 1024 * 1024))
+
+    def spool_file(url, output_file, counter=None, chunk_size=64 * 1024):
+        with open(zip_path, 'rb') as zip_file:
+            for chunk in iter(lambda: zip_file.read(chunk_size), b''):
+                output_file.write(chunk)
+
+    monkeypatch.setattr(ed_catalog, 'spool_response', spool_file)
+    deadline = time.time() + 30
+    counter = ed_catalog.Counter(report=lambda counter: None)
+    is_ingested = ed_catalog.download_ed_catalog_to_mongo(
+        'sqlite:///%s' % tmpdir.join('catalog.db'), 'http://localhost/catalog.zip', counter,
+        parser_engine='lxml', is_cancelled=lambda: time.time() > deadline)
+    assert is_ingested
+    assert counter.inserted == 1
+    store.close()
@@ -0,0 +1,34 @@
+import io
+
+import pytest
+
+import ed_catalog
+import export_catalog
+from conftest import resource_path
+
+
+def load_small_catalog(item_store, parser_engine):
+    counter = ed_catalog.Counter(report=lambda counter: None)
+    with open(resource_path('edsystem_catalog_small.xml'), 'rb') as catalog_xml:
+        ed_catalog.load_catalog_to_mongo(catalog_xml, item_store, counter, parser_engine=parser_engine)
+
+
+@pytest.mark.parametrize('parser_engine', ed_catalog.PARSER_ENGINES)
+def test_export_is_identical_to_the_expected_xml(item_store, parser_engine):
+    load_small_catalog(item_store, parser_engine)
+    with io.open(resource_path('shoptet_catalog_small_expected.xml'), encoding='utf-8') as expected_file:
+        expected_xml = expected_file.read()
+
+    assert export_catalog.export_catalog_from_mongo(item_store) == expected_xml
+    output_file = io.StringIO()
+    export_catalog.export_catalog_from_mongo(item_store, output_file)
+    assert output_file.getvalue() == expected_xml
+
+
+def test_streamed_chunks_make_the_whole_document(item_store):
+    load_small_catalog(item_store, 'lxml')
+    items = list(item_store.export_scan())
+    # a chunk per item
+    chunks = list(export_catalog.iter_catalog_xml(items * 3, chunk_size=1))
+    assert len(chunks) == 4
+    assert ''.join(chunks) == export_catalog.export_catalog(items * 3, None)
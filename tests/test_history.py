@@ -0,0 +1,47 @@
+import pytest
+
+from bulk_writer import BulkWriter
+from history import HistoryWriter
+from item_store import SqliteItemStore
+
+
+def ed_upsert(code, name, **fields):
+    return code, dict(fields, shoptet_from_ed={'CODE': code, 'NAME': name})
+
+
+def test_changes_are_recorded_with_the_batch(item_store):
+    with HistoryWriter(item_store, 1) as writer:
+        writer.add(ed_upsert('A', 'Filament'))
+    with HistoryWriter(item_store, 2) as writer:
+        writer.add(ed_upsert('A', 'PLA filament'))
+        writer.add(ed_upsert('B', 'Nozzle'))
+    assert [(c['run'], c['code'], c['field']) for c in item_store.find_item_changes('A')] == \
+        [(1, 'A', 'NEW'), (2, 'A', 'NAME')]
+    assert item_store.count_changes(2) == {'NAME': 1, 'NEW': 1}
+
+
+def test_no_changes_of_a_failed_sqlite_batch(tmpdir):
+    item_store = SqliteItemStore(str(tmpdir.join('catalog.db')))
+    item_store.create_indexes()
+    writer = HistoryWriter(item_store, 1)
+    # the item cannot be serialized, the whole transaction is rolled back
+    with pytest.raises(TypeError):
+        writer.write_batch([ed_upsert('A', 'Filament'), ed_upsert('B', 'Nozzle', bad=object())])
+    assert item_store.find_changes(1) == [] and item_store.get_by_codes(['A', 'B']) == []
+    item_store.close()
+
+
+def test_no_changes_of_failed_mongo_upserts(item_store, monkeypatch):
+    if isinstance(item_store, SqliteItemStore):
+        pytest.skip('MongoDB only')
+    original_bulk_write = BulkWriter.bulk_write
+
+    def bulk_write(self, operations, retries=1):
+        # the second upsert fails, the others are written
+        changed_count, _ = original_bulk_write(self, operations[:1] + operations[2:], retries)
+        return changed_count, [{'index': 1, 'code': 2, 'errmsg': 'rejected'}]
+
+    monkeypatch.setattr(BulkWriter, 'bulk_write', bulk_write)
+    writer = HistoryWriter(item_store, 1)
+    assert writer.write_batch([ed_upsert('A', 'Filament'), ed_upsert('B', 'Nozzle'), ed_upsert('C', 'Bed')]) == (2, 1)
+    assert [c['code'] for c in item_store.find_changes(1)] == ['A', 'C']
@@ -0,0 +1,41 @@
+import pytest
+
+from item_store import check_item_store
+
+
+def test_item_store_behavior(item_store):
+    check_item_store(item_store)
+
+
+def test_failed_check_names_the_store(item_store):
+    item_store.next_change_seq()
+    # the check starts by dropping the data, so break the store itself
+    item_store.get_change_seq = lambda: 1
+    with pytest.raises(AssertionError) as error:
+        check_item_store(item_store)
+    assert str(error.value).startswith(type(item_store).__name__)
+
+
+def test_browse_matches_word_prefixes(item_store):
+    item_store.upsert_batch([
+        ('PLA-175', {'has_export': True, 'shoptet_from_ed': {'CODE': 'PLA-175', 'NAME': 'Filament PLA 1,75 mm'}}),
+        ('T1', {'has_export': True, 'shoptet_from_ed': {'CODE': 'T1', 'NAME': 'Tiskárna Průša i3'}}),
+        ('X9', {'shoptet': {'CODE': 'X9', 'VISIBLE': True, 'AVAILABILITY_IN_STOCK': ''}}),
+        ('Z', {'has_export': True, 'shoptet_from_ed': {'CODE': 'Z', 'NAME': 'Tisková hlava'}}),
+    ])
+    # an item from Shoptet gets the name from ED later
+    item_store.upsert_batch([('X9', {'has_export': True, 'shoptet_from_ed': {'CODE': 'X9', 'NAME': 'Prusament'}})])
+
+    def codes(text):
+        return [item['code'] for item in item_store.browse({'text': text})]
+
+    # the same results on both backends
+    assert codes('tisk') == ['T1', 'Z']
+    assert codes('TISKARNA') == ['T1']
+    assert codes('průš') == ['T1', 'X9']
+    assert codes('pla 175') == ['PLA-175']
+    assert codes('fil 1,75') == ['PLA-175']
+    assert codes('x9') == ['X9']
+    assert codes('lament') == []
+    assert codes('tisk hlava') == ['Z']
+    assert codes('"') == ['PLA-175', 'T1', 'X9', 'Z']
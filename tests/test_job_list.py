@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+try:
+    from rq import Queue
+    from rq.job import Job
+    from rq.registry import FinishedJobRegistry
+
+    from job_list import list_jobs
+except (ImportError, SyntaxError) as e:
+    # eg. an old rq on a new Python
+    pytest.skip('the job list cannot be imported: %s' % e, allow_module_level=True)
+
+LIMITS = {'Waiting': 2, 'Running': 2, 'Finished': 3, 'Failed': 2}
+
+
+def enqueue_jobs(redis_client, count):
+    queue = Queue(connection=redis_client)
+    return [queue.enqueue(time.sleep, 0).id for _ in range(count)]
+
+
+def finish_jobs(redis_client, count):
+    """Adds new jobs to the finished registry, the last one the latest."""
+    registry = FinishedJobRegistry(connection=redis_client)
+    job_ids = []
+    for i in range(count):
+        job = Job.create(time.sleep, (0,), connection=redis_client)
+        job.save()
+        redis_client.zadd(registry.key, time.time() + 100 + i, job.id)
+        job_ids.append(job.id)
+    return job_ids
+
+
+def listed_ids(job_page):
+    return [job.id for job in job_page.jobs]
+
+
+def test_pages_of_each_registry(redis_client):
+    waiting = enqueue_jobs(redis_client, 5)
+    finished = finish_jobs(redis_client, 4)
+
+    pages = list_jobs(redis_client, limits=LIMITS)
+    assert listed_ids(pages['Waiting']) == waiting[:2]
+    assert (pages['Waiting'].total, pages['Waiting'].has_previous, pages['Waiting'].has_next) == (5, False, True)
+    assert listed_ids(pages['Finished']) == finished[:0:-1]
+    assert pages['Finished'].total == 4
+    assert listed_ids(pages['Running']) == [] and listed_ids(pages['Failed']) == []
+
+    pages = list_jobs(redis_client, limits=LIMITS, page=3)
+    assert listed_ids(pages['Waiting']) == waiting[4:]
+    assert (pages['Waiting'].has_previous, pages['Waiting'].has_next) == (True, False)
+    assert listed_ids(pages['Finished']) == []
+
+
+def test_only_the_requested_states(redis_client):
+    enqueue_jobs(redis_client, 1)
+    pages = list_jobs(redis_client, ['Waiting'], limits=LIMITS)
+    assert list(pages) == ['Waiting']
+
+
+def test_expired_ids_are_removed(redis_client):
+    waiting = enqueue_jobs(redis_client, 3)
+    finished = finish_jobs(redis_client, 2)
+    # the job hashes expired meanwhile
+    redis_client.delete('rq:job:%s' % waiting[1], 'rq:job:%s' % finished[0])
+
+    pages = list_jobs(redis_client, limits=LIMITS)
+    assert listed_ids(pages['Waiting']) == [waiting[0]]
+    assert listed_ids(pages['Finished']) == [finished[1]]
+    assert [job_id.decode('utf-8') for job_id in redis_client.lrange(Queue(connection=redis_client).key, 0, -1)] \
+        == [waiting[0], waiting[2]]
+    assert redis_client.zrange(FinishedJobRegistry(connection=redis_client).key, 0, -1) \
+        == [finished[1].encode('utf-8')]
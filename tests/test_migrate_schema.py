@@ -0,0 +1,46 @@
+import pytest
+
+from item_store import MongoItemStore
+from migrate_schema import add_search_words, merge_duplicate_items
+
+mongomock = pytest.importorskip('mongomock')
+
+
+def test_duplicate_items_are_merged():
+    db = mongomock.MongoClient()['s3dt_test']
+    # inserted by the ED and Shoptet ingests in parallel before the index was unique
+    db.items.create_index('code')
+    db.items.insert_many([
+        {'code': 'A', 'ed': {'Code': 'A'}, 'has_export': True, 'shoptet': {'VISIBLE': True}},
+        {'code': 'A', 'shoptet': {'VISIBLE': False}, 'change_seq': 1},
+        {'code': 'B', 'has_export': True},
+        {'code': 'A', 'extra': 1},
+    ])
+
+    assert merge_duplicate_items(db.items) == 2
+    items = list(db.items.find({}, {'_id': 0}).sort('code', 1))
+    assert [item['code'] for item in items] == ['A', 'B']
+    # the fields of the oldest item take precedence
+    assert items[0]['shoptet'] == {'VISIBLE': True}
+    assert items[0]['ed'] == {'Code': 'A'} and items[0]['extra'] == 1
+    assert items[0]['change_seq'] == 1
+    assert db.items.index_information()['code_1'].get('unique')
+    assert merge_duplicate_items(db.items) == 0
+
+    MongoItemStore(db).create_indexes()
+    assert db.items.index_information()['code_1'].get('unique')
+
+
+def test_search_words_are_added():
+    db = mongomock.MongoClient()['s3dt_test']
+    db.items.create_index([('shoptet_from_ed.NAME', 'text'), ('code', 'text')], name='items_text')
+    db.items.insert_many([
+        {'code': 'A-1', 'shoptet_from_ed': {'NAME': 'Tiskárna Prusa'}},
+        {'code': 'B', 'shoptet': {'VISIBLE': True}},
+    ])
+
+    assert add_search_words(db.items) == 2
+    assert [item['search_words'] for item in db.items.find().sort('code', 1)] == \
+        [['a', '1', 'tiskarna', 'prusa'], ['b']]
+    assert 'items_text' not in db.items.index_information()
+    assert add_search_words(db.items) == 0
@@ -0,0 +1,51 @@
+import io
+import random
+
+import export_catalog
+import offline_export
+from synthetic_catalog import CATALOG_FOOTER, CATALOG_HEADER, PRODUCT_TEMPLATE, random_product
+
+
+def write_catalog(path, products):
+    with io.open(str(path), 'w', encoding='utf-8') as catalog_file:
+        catalog_file.write(CATALOG_HEADER)
+        for product in products:
+            catalog_file.write(PRODUCT_TEMPLATE % product)
+        catalog_file.write(CATALOG_FOOTER % len(products))
+
+
+def expected_export(catalog_path, shoptet_csv_path):
+    """The export of the catalog with all its products."""
+    shoptet_index = offline_export.load_shoptet_index(str(shoptet_csv_path))
+    with open(str(catalog_path), 'rb') as catalog_xml:
+        return export_catalog.export_catalog(offline_export.iter_merged_items(catalog_xml, shoptet_index), None)
+
+
+def test_repeated_product_is_exported_once_by_its_last_occurrence(tmpdir):
+    rng = random.Random(0)
+    products = [random_product(rng, i, True) for i in range(5)]
+    # the product exists in Shoptet, so only its price and stock are exported
+    repeated = dict(products[1], your_price_with_fees='999.00')
+    shoptet_csv = tmpdir.join('shoptet.csv')
+    shoptet_csv.write_text('code;pairCode;name;productVisibility;availabilityInStock\n'
+                           '%s;;Name;visible;Skladem\n' % products[1]['code'], encoding='cp1250')
+    write_catalog(tmpdir.join('ed.xml'), products[:3] + [repeated] + products[3:] + [repeated])
+    write_catalog(tmpdir.join('expected.xml'), products[:1] + products[2:3] + products[3:] + [repeated])
+
+    output = tmpdir.join('output.xml')
+    stats = offline_export.export_offline(str(tmpdir.join('ed.xml')), str(shoptet_csv), str(output))
+    assert output.read_text('utf-8') == expected_export(tmpdir.join('expected.xml'), shoptet_csv)
+    assert output.read_text('utf-8').count('<CODE>%s</CODE>' % repeated['code']) == 1
+    assert (stats['items'], stats['existing_items'], stats['duplicate_items']) == (5, 1, 2)
+
+
+def test_export_without_repeated_products(tmpdir):
+    rng = random.Random(1)
+    write_catalog(tmpdir.join('ed.xml'), [random_product(rng, i, True) for i in range(20)])
+    shoptet_csv = tmpdir.join('shoptet.csv')
+    shoptet_csv.write_text('code;pairCode;name;productVisibility;availabilityInStock\n', encoding='cp1250')
+
+    output = tmpdir.join('output.xml')
+    stats = offline_export.export_offline(str(tmpdir.join('ed.xml')), str(shoptet_csv), str(output))
+    assert output.read_text('utf-8') == expected_export(tmpdir.join('ed.xml'), shoptet_csv)
+    assert (stats['items'], stats['duplicate_items']) == (20, 0)
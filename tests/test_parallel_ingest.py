@@ -0,0 +1,51 @@
+import io
+
+import pytest
+
+import ed_catalog
+import parallel_ingest
+import store
+import synthetic_catalog
+from pipeline import PipelineCancelled
+
+
+@pytest.fixture
+def catalog_path(tmpdir):
+    path = tmpdir.join('catalog.xml')
+    with io.open(str(path), 'w', encoding='utf-8') as catalog_file:
+        synthetic_catalog.generate_catalog(catalog_file, 500, 0.5, seed=1)
+    return str(path)
+
+
+def stored_docs(item_store):
+    return [dict(item, change_seq=None) for item in item_store.export_scan()]
+
+
+def test_parallel_ingest_stores_the_same_items(tmpdir, catalog_path):
+    single_store = store.get_item_store('sqlite:///%s' % tmpdir.join('single.db'))
+    with open(catalog_path, 'rb') as catalog_xml:
+        ed_catalog.load_catalog_to_mongo(catalog_xml, single_store, ed_catalog.Counter(), parser_engine='lxml')
+
+    store_uri = 'sqlite:///%s' % tmpdir.join('parallel.db')
+    parallel_store = store.get_item_store(store_uri)
+    parallel_ingest.load_catalog_file_parallel(catalog_path, store_uri, ed_catalog.Counter(), 2,
+                                               parser_engine='lxml', num_shards=4)
+    assert stored_docs(parallel_store) == stored_docs(single_store)
+
+    # the stored digests reach the workers, so the unchanged items are skipped
+    counter = ed_catalog.Counter()
+    parallel_ingest.load_catalog_file_parallel(catalog_path, store_uri, counter, 2, parser_engine='lxml',
+                                               num_shards=4)
+    assert counter.selected > 0 and counter.unchanged == counter.selected
+    store.close()
+
+
+def test_cancelled_parallel_ingest(tmpdir, catalog_path):
+    store_uri = 'sqlite:///%s' % tmpdir.join('catalog.db')
+    item_store = store.get_item_store(store_uri)
+    with pytest.raises(PipelineCancelled):
+        parallel_ingest.load_catalog_file_parallel(catalog_path, store_uri, ed_catalog.Counter(), 2,
+                                                   parser_engine='lxml', is_cancelled=lambda: True)
+    # the change sequence of the cancelled ingest does not hold the cursor back
+    assert item_store.get_committed_change_seq() == item_store.get_change_seq() == 1
+    store.close()
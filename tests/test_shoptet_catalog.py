@@ -0,0 +1,29 @@
+import ed_catalog
+import store
+from shoptet_catalog import update_items_in_mongo
+
+
+def shoptet_items(*states):
+    return [{'CODE': code, 'VISIBLE': visible, 'AVAILABILITY_IN_STOCK': availability}
+            for (code, visible, availability) in states]
+
+
+def test_changed_items_are_marked(tmpdir):
+    store_uri = 'sqlite:///%s' % tmpdir.join('catalog.db')
+    item_store = store.get_item_store(store_uri)
+    item_store.create_indexes()
+    items = shoptet_items(('A', True, ''), ('B', False, 'Skladem'), ('C', True, 'Na dotaz'))
+    counter = ed_catalog.Counter()
+    assert update_items_in_mongo(items, store_uri, batch_size=2, counter=counter) == (3, 3)
+    assert (counter.inserted, counter.updated, counter.unchanged) == (3, 0, 0)
+
+    # D is repeated within a batch
+    items = shoptet_items(('A', True, ''), ('B', True, 'Skladem'), ('D', False, ''), ('D', True, ''),
+                          ('C', True, 'Na dotaz'))
+    counter = ed_catalog.Counter()
+    assert update_items_in_mongo(items, store_uri, batch_size=2, counter=counter)[0] == 5
+    assert (counter.inserted, counter.updated, counter.unchanged) == (1, 2, 2)
+    change_seqs = {item['code']: item['change_seq'] for item in item_store.get_by_codes('ABCD', ['change_seq'])}
+    assert change_seqs == {'A': 1, 'B': 2, 'C': 1, 'D': 2}
+    assert [item['shoptet']['VISIBLE'] for item in item_store.get_by_codes(['D'])] == [True]
+    store.close()
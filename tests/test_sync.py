@@ -0,0 +1,42 @@
+import pytest
+
+try:
+    from rq import Queue
+
+    import sync
+except (ImportError, SyntaxError) as e:
+    # eg. an old rq on a new Python
+    pytest.skip('the sync cannot be imported: %s' % e, allow_module_level=True)
+
+
+def test_state_is_written_before_the_updates_are_enqueued(redis_client, monkeypatch):
+    enqueued = []
+    enqueue_call = Queue.enqueue_call
+
+    def record_enqueue(queue, *args, **kwargs):
+        # a worker may finish the job right away
+        enqueued.append((kwargs['job_id'], redis_client.get(sync.pending_key(kwargs['kwargs']['sync_id'])),
+                         sync.get_sync(redis_client, kwargs['kwargs']['sync_id'])))
+        return enqueue_call(queue, *args, **kwargs)
+
+    monkeypatch.setattr(Queue, 'enqueue_call', record_enqueue)
+    sync_id = sync.start_sync(redis_client, 300)
+
+    state = sync.get_sync(redis_client, sync_id)
+    assert [job_id for (job_id, _, _) in enqueued] == [state['ed_job_id'], state['shoptet_job_id']]
+    for (_, pending, enqueued_state) in enqueued:
+        assert pending == b'2'
+        assert enqueued_state == state
+    assert Queue(connection=redis_client).job_ids == [state['ed_job_id'], state['shoptet_job_id']]
+    assert sync.recent_sync_ids(redis_client) == [sync_id]
+
+
+def test_last_finished_update_enqueues_the_export(redis_client):
+    sync_id = sync.start_sync(redis_client, 300)
+    assert sync.stage_finished(redis_client, sync_id, 'shoptet') is None
+    export_job = sync.stage_finished(redis_client, sync_id, 'ed')
+
+    assert export_job.func_name == 'tasks.export_catalog_job'
+    state = sync.get_sync(redis_client, sync_id)
+    assert state['export_job_id'] == export_job.id
+    assert 'ed_finished_at' in state and 'shoptet_finished_at' in state
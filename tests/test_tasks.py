@@ -0,0 +1,50 @@
+import pytest
+
+try:
+    from rq import Connection, Queue
+
+    import store
+    import tasks
+    from pipeline import PipelineCancelled
+except (ImportError, SyntaxError) as e:
+    # eg. an old rq on a new Python
+    pytest.skip('the tasks cannot be imported: %s' % e, allow_module_level=True)
+
+
+@pytest.fixture
+def item_store(tmpdir, monkeypatch):
+    monkeypatch.setattr(store, 'store_uri', 'sqlite:///%s' % tmpdir.join('catalog.db'))
+    monkeypatch.setattr(tasks, 'get_ed_catalog_url', lambda *args: 'http://localhost/catalog.zip')
+    item_store = store.get_item_store()
+    item_store.create_indexes()
+    yield item_store
+    store.close()
+
+
+def run_job(redis_client, func):
+    job = Queue(connection=redis_client).enqueue(func)
+    with Connection(redis_client):
+        job.perform()
+
+
+@pytest.mark.parametrize('error', [PipelineCancelled, IOError])
+def test_interrupted_ed_update_bumps_the_data_version(redis_client, item_store, monkeypatch, error):
+    def ingest(store_uri, catalog_url, counter, *args, **kwargs):
+        # a batch is written before the ingest is interrupted
+        with item_store.writer(counter=counter) as writer:
+            writer.add(('A', {'has_export': True}))
+        raise error()
+
+    monkeypatch.setattr(tasks, 'download_ed_catalog_to_mongo', ingest)
+    if error is PipelineCancelled:
+        run_job(redis_client, tasks.update_ed_catalog)
+    else:
+        with pytest.raises(error):
+            run_job(redis_client, tasks.update_ed_catalog)
+    assert item_store.get_data_version() == 1
+
+
+def test_unchanged_ed_update_keeps_the_data_version(redis_client, item_store, monkeypatch):
+    monkeypatch.setattr(tasks, 'download_ed_catalog_to_mongo', lambda *args, **kwargs: False)
+    run_job(redis_client, tasks.update_ed_catalog)
+    assert item_store.get_data_version() == 0
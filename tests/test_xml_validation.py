@@ -0,0 +1,21 @@
+import export_catalog
+from conftest import resource_path
+from test_export_catalog import load_small_catalog
+from xml_validation import SHOPTET_SCHEMA_PATH, ItemValidator, relax_ng_schema, validate_relax_ng
+
+
+def test_expected_export_is_valid():
+    validate_relax_ng(resource_path('shoptet_catalog_small_expected.xml'), relax_ng_schema(SHOPTET_SCHEMA_PATH))
+
+
+def test_exported_items_are_valid(item_store):
+    load_small_catalog(item_store, 'lxml')
+    codes = [item['code'] for item in item_store.export_scan()]
+    # the items already in Shoptet are exported in the short form
+    item_store.upsert_batch([
+        (codes[0], {'shoptet': {'CODE': codes[0], 'VISIBLE': True, 'AVAILABILITY_IN_STOCK': ''}}),
+        (codes[-1], {'shoptet': {'CODE': codes[-1], 'VISIBLE': False, 'AVAILABILITY_IN_STOCK': 'Na dotaz'}}),
+    ])
+    validator = ItemValidator()
+    export_catalog.export_catalog_from_mongo(item_store, validator=validator)
+    assert (validator.valid, validator.invalid, validator.errors) == (len(codes), 0, [])
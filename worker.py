@@ -11,11 +11,15 @@ import os
 import redis
 from rq import Queue, Worker, Connection
 
+import store
+
 redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
 
 redis_client = redis.from_url(redis_url)
 
 if __name__ == '__main__':
+    # once, the jobs run in processes forked from this one
+    store.ensure_indexes()
     with Connection(redis_client):
         worker = Worker(Queue())
         worker.work()
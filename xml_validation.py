@@ -1,33 +1,139 @@
+"""
+Validation of the Shoptet import XML by the RelaxNG schema.
+
+Besides the whole document, the SHOPITEM elements can be validated one
+by one - while the export is being generated, or incrementally from
+a file with bounded memory. Each item is validated against the schema
+of the whole document (wrapped in SHOP), the invalid ones are reported
+by CODE instead of failing the whole document.
+"""
+
 import argparse
+import copy
+import os
+import time
+from collections import Counter, OrderedDict
+from functools import lru_cache
 
 from lxml import etree
 
+SHOPTET_SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'resources', 'products-supplier-v10.rng')
+
 
 def relax_ng_schema(schema_path):
     relaxng_doc = etree.parse(schema_path)
     return etree.RelaxNG(relaxng_doc)
 
 
+@lru_cache()
+def cached_relax_ng_schema(schema_path=SHOPTET_SCHEMA_PATH):
+    """
+    The schema compiled once per process. Note that a compiled schema
+    must not be used by multiple threads at once.
+    """
+    return relax_ng_schema(schema_path)
+
+
 def validate_relax_ng(doc_path, schema):
     doc = etree.parse(doc_path)
 
     schema.assertValid(doc)
 
 
+class ItemValidator(object):
+    """
+    Validates SHOPITEM elements one by one and collects the statistics.
+
+    schema - compiled RelaxNG schema, the cached Shoptet one by default
+    max_errors - number of invalid items whose CODE and error are kept
+    """
+
+    def __init__(self, schema=None, max_errors=100):
+        self.schema = schema if schema is not None else cached_relax_ng_schema()
+        self.max_errors = max_errors
+        self.valid = 0
+        self.invalid = 0
+        # [(code, message)] of the first max_errors invalid items
+        self.errors = []
+        # message -> number of invalid items
+        self.error_counts = Counter()
+        self.validation_time = 0.0
+
+    def validate_xml(self, code, shop_item_xml):
+        """Validates a SHOPITEM serialized as a string."""
+        start = time.time()
+        shop = etree.fromstring(('<SHOP>%s</SHOP>' % shop_item_xml).encode('utf-8'))
+        self._validate(code, shop, start)
+
+    def validate_element(self, shop_item):
+        """Validates a SHOPITEM element (which is moved to a new document)."""
+        start = time.time()
+        shop = etree.Element('SHOP')
+        shop.append(shop_item)
+        self._validate(shop_item.findtext('CODE'), shop, start)
+
+    def _validate(self, code, shop, start):
+        if self.schema.validate(shop):
+            self.valid += 1
+        else:
+            self.invalid += 1
+            message = self.schema.error_log.last_error.message
+            self.error_counts[message] += 1
+            if len(self.errors) < self.max_errors:
+                self.errors.append((code, message))
+        self.validation_time += time.time() - start
+
+    def stats(self):
+        return OrderedDict([
+            ('valid_items', self.valid),
+            ('invalid_items', self.invalid),
+            ('validation_time', self.validation_time),
+            ('error_counts', OrderedDict(self.error_counts.most_common())),
+            ('errors', [OrderedDict([('code', code), ('error', message)]) for (code, message) in self.errors]),
+        ])
+
+
+def validate_relax_ng_items(doc_path, schema=None, max_errors=100):
+    """
+    Validates the SHOPITEM elements of a document incrementally, only
+    a single item is kept in memory. Returns the ItemValidator.
+    """
+    validator = ItemValidator(schema, max_errors)
+    for (_, shop_item) in etree.iterparse(doc_path, events=('end',), tag='SHOPITEM'):
+        validator.validate_element(copy.deepcopy(shop_item))
+        shop_item.clear()
+        # the already processed siblings would be kept by the root otherwise
+        while shop_item.getprevious() is not None:
+            del shop_item.getparent()[0]
+    return validator
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Validate XML document using a RelaxNG schema.')
     parser.add_argument('doc', metavar='DOCUMENT',
                         help='Path to XML document to be validated')
-    parser.add_argument('-s', '--schema',
-                        help='Path to RelaxNG schema')
+    parser.add_argument('-s', '--schema', default=SHOPTET_SCHEMA_PATH,
+                        help='Path to RelaxNG schema (the Shoptet one by default)')
+    parser.add_argument('-i', '--items', action='store_true',
+                        help='Validate each SHOPITEM separately and report the invalid ones by CODE')
 
     args = parser.parse_args()
 
     schema = relax_ng_schema(args.schema)
-    try:
-        validate_relax_ng(args.doc, schema)
-        print('Document is valid.')
-    except etree.DocumentInvalid as e:
-        print('Document is NOT valid:', e)
-        print(schema.error_log)
+    if args.items:
+        validator = validate_relax_ng_items(args.doc, schema)
+        print('Valid items: %d, invalid items: %d, validated in %.3f sec' % (
+            validator.valid, validator.invalid, validator.validation_time))
+        for (message, count) in validator.error_counts.most_common():
+            print('%6d x %s' % (count, message))
+        for (code, message) in validator.errors:
+            print('%s: %s' % (code, message))
+    else:
+        try:
+            validate_relax_ng(args.doc, schema)
+            print('Document is valid.')
+        except etree.DocumentInvalid as e:
+            print('Document is NOT valid:', e)
+            print(schema.error_log)
@@ -0,0 +1,97 @@
+"""
+Forward-only decompression of the first member of a ZIP archive.
+
+Unlike zipfile, which needs to seek to the central directory at the end of
+the archive, this reads just the local file header and then decompresses the
+member data as it arrives. So a ZIP can be processed while it is still being
+downloaded.
+"""
+
+import struct
+import zlib
+from zipfile import BadZipFile
+
+LOCAL_FILE_HEADER_SIGNATURE = b'PK\x03\x04'
+# signature, version, flags, method, time, date, CRC-32, compressed size,
+# uncompressed size, file name length, extra field length
+LOCAL_FILE_HEADER = struct.Struct('<4sHHHHHIIIHH')
+
+FLAG_ENCRYPTED = 0x1
+FLAG_DATA_DESCRIPTOR = 0x8
+METHOD_STORED = 0
+METHOD_DEFLATED = 8
+
+
+class ZipStreamReader(object):
+    """
+    File-like reading the uncompressed data of the first ZIP member
+    from a non-seekable input stream.
+    """
+
+    def __init__(self, input_stream, chunk_size=64 * 1024):
+        self.input_stream = input_stream
+        self.chunk_size = chunk_size
+        (signature, _, flags, method, _, _, crc, compressed_size, _, name_length, extra_length) = \
+            LOCAL_FILE_HEADER.unpack(_read_exactly(input_stream, LOCAL_FILE_HEADER.size))
+        if signature != LOCAL_FILE_HEADER_SIGNATURE:
+            raise BadZipFile('Not a ZIP local file header')
+        if flags & FLAG_ENCRYPTED:
+            raise BadZipFile('Encrypted ZIP members are not supported')
+        self.filename = _read_exactly(input_stream, name_length).decode('utf-8', 'replace')
+        _read_exactly(input_stream, extra_length)
+
+        # the sizes and CRC are only in the data descriptor after the data
+        self.expected_crc = None if flags & FLAG_DATA_DESCRIPTOR else crc
+        if method == METHOD_DEFLATED:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            self.remaining = None
+        elif method == METHOD_STORED and not flags & FLAG_DATA_DESCRIPTOR:
+            self.decompressor = None
+            self.remaining = compressed_size
+        else:
+            raise BadZipFile('Unsupported ZIP member (method %d, flags %#x)' % (method, flags))
+        self.crc = 0
+        self.buffer = b''
+        self.eof = False
+
+    def read(self, size=-1):
+        while (size is None or size < 0 or len(self.buffer) < size) and not self.eof:
+            self._fill()
+        if size is None or size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def _fill(self):
+        if self.decompressor is None:
+            data = self.input_stream.read(min(self.chunk_size, self.remaining))
+            if not data and self.remaining > 0:
+                raise BadZipFile('Truncated ZIP member')
+            self.remaining -= len(data)
+            finished = self.remaining == 0
+        else:
+            compressed = self.decompressor.unconsumed_tail
+            if not compressed:
+                compressed = self.input_stream.read(self.chunk_size)
+            # bounded output, the rest of the input waits in unconsumed_tail
+            data = self.decompressor.decompress(compressed, self.chunk_size)
+            finished = self.decompressor.eof
+            if not compressed and not data and not finished:
+                raise BadZipFile('Truncated ZIP member')
+        self.crc = zlib.crc32(data, self.crc)
+        self.buffer += data
+        if finished:
+            self.eof = True
+            if self.expected_crc is not None and self.crc != self.expected_crc:
+                raise BadZipFile('Bad CRC-32 of ZIP member %s' % self.filename)
+
+
+def _read_exactly(input_stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = input_stream.read(size - len(data))
+        if not chunk:
+            raise BadZipFile('Truncated ZIP local file header')
+        data += chunk
+    return data